@@ -1,41 +1,306 @@
+from collections import namedtuple
+
 import numpy as np
-from gcvspline import GCVSmoothedNSpline, SmoothedNSpline
+from gcvspline import GCVSmoothedNSpline, SmoothedNSpline, splderivative
+from gcvspline import _gcvspl
+
+from instrument import instrumented, count
+
+#gcvspl needs at least 2*M data points to fit a (M=2) cubic spline; shorter sections are left as gaps.
+MIN_SECTION = 4
+
+#half order of the splines (cubic) and the constants of gcvspl's GCV search (gcvspl.f, GCVSPL and SPLC)
+M = 2
+RATIO = 2.0
+TAU = 1.618033983
+TOL = 1e-6
+EPS = 1e-15
+
+#a smoothing spline fitted to the frames start:stop of one or more channels (channel = marker*3 + dimension).
+#column j of spline.c holds the coefficients for channels[j].
+Section = namedtuple('Section', ['channels', 'start', 'stop', 'spline'])
+
+#the spline of a Section: knots x (the section's frames), coefficients c (len(x) x nchannels) and the
+#smoothing parameter each column was fitted with
+SectionSpline = namedtuple('SectionSpline', ['x', 'c', 'p'])
+
+def continuous_runs(A):
+    """find the continuous (non-nan) sections of a series.
+
+    input: A = 1D array of position data, nan where missing
+    output: starts, stops = int arrays such that A[starts[i]:stops[i]] is the i-th continuous section"""
+    good = ~np.isnan(np.asarray(A))
+    edges = np.diff(np.concatenate(([0], good.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1)
+    return starts, stops
+
+def continuous_runs_batch(X):
+    """find the continuous sections of every channel of a trial at once.
+
+    input: X = array of position data, nframes x nchannels or nframes x nmarkers x 3dimensions
+    output: channels, starts, stops = int arrays, one entry per section, sorted by channel then time.
+    X2[starts[i]:stops[i], channels[i]] is the i-th section, where X2 = X.reshape(nframes, -1)
+    (so channel = marker*3 + dimension for a nframes x nmarkers x 3 array)"""
+    X = np.asarray(X)
+    good = ~np.isnan(X.reshape(X.shape[0], -1))
+    padded = np.zeros((good.shape[1], good.shape[0] + 2), dtype=np.int8)
+    padded[:, 1:-1] = good.T
+    edges = np.diff(padded, axis=1)
+    channels, starts = np.nonzero(edges == 1)
+    stops = np.nonzero(edges == -1)[1]
+    return channels, starts, stops
 
 def find_continuous_sections(A):
-    good = np.concatenate(np.argwhere(~np.isnan(A)))
-    for i in np.arange(len(A)):
-        good_indices = []
-        holding = []
-        for t in range(1,len(good)):
-            if good[t]-good[t-1] == 1:                                                  
-                holding.append(good[t-1])          #add indices corresponding to continuous section to a holding list
-            else:
-                holding.append(good[t-1])
-                good_indices.append(holding)
-                holding = []
-                #when there's a break: add the indices for the continuous section to good_indices, reset the holding list
-
-        if good[-1]-good[-2] == 1:                 #for the last entry.
-            holding.append(good[-1])
-            good_indices.append(holding)
-            
-    return good_indices
+    """list of index arrays, one per continuous (non-nan) section of A"""
+    starts, stops = continuous_runs(A)
+    return [np.arange(s, e) for s, e in zip(starts, stops)]
 
+@instrumented()
 def return_smoothed(A,pf):
-    conts = find_continuous_sections(A)
+    starts, stops = continuous_runs(A)
+    conts = []
     smoothed = []
-    
-    for i in np.arange(len(conts)): #go through each continuous section one at a time
-        section = [A[m] for m in conts[i]] #get all the raw position data corresponding to the section
-        section = np.asarray(section)
-        t = conts[i]
-        t = np.asarray(t) 
+
+    for s, e in zip(starts, stops): #go through each continuous section one at a time
+        if e - s < MIN_SECTION:
+            continue
+        section = A[s:e] #get all the raw position data corresponding to the section
+        t = np.arange(s, e)
         GCV_auto = GCVSmoothedNSpline(t, section) #can change parameters, spline function as necessary.
         p = GCV_auto.p * pf
         GCV_manual = SmoothedNSpline(t, section, p=p)
-        
+
+        conts.append(t)
         smoothed.append(GCV_manual)
-        
-    return conts, smoothed     
+        count('sections')
+        count('gcv_searches')
+        count('spline_fits')
+
+    return conts, smoothed
+
+class SectionDesign(object):
+    """gcvspl's natural spline design for one continuous section, shared by all the channels fitted on it.
+
+    GCVSmoothedNSpline and SmoothedNSpline rebuild the B-spline basis and penalty matrices on every call. Here
+    they are built once per section, and every channel fitted with the same p shares one banded factorization
+    (gcvspl's SPLC), which gives the same coefficients and GCV values as fitting the channels one at a time.
+
+    input parameters
+    t = knots, i.e. the frame indices of the section (strictly increasing, at least 2*M of them)"""
+
+    def __init__(self, t):
+        self.x = np.asarray(t, dtype=np.float64)
+        n = len(self.x)
+        self.b = np.zeros((2*M-1, n), order='F')
+        self.we = np.zeros((2*M+1, n), order='F')
+        self.bwe = np.zeros((2*M+1, n), order='F')
+        self.stat = np.zeros(6)
+        self.wx = np.ones(n)
+        _gcvspl.basis(self.x, self.b, 0.0, np.zeros(2*M))
+        we = np.zeros((2*M+1)*n)
+        _gcvspl.prep(M, self.x, self.wx, we, 0.0)
+        self.we[:] = we.reshape(self.we.shape, order='F')
+
+        #the f2py wrappers don't return BASIS and PREP's L1 norms; summed in the same order as the fortran
+        bl = np.add.accumulate(np.abs(self.b.ravel(order='F')))[-1]/n
+        self.el = np.add.accumulate(np.abs(we))[-1]/n/bl
+
+    def solve(self, Y, p):
+        """spline coefficients (len(x) x ncolumns) of every column of Y for smoothing parameter p, and gcvspl's
+        GCV value of the columns taken together"""
+        Y = np.asfortranarray(Y, dtype=np.float64).reshape(len(self.x), -1)
+        c = np.zeros(Y.shape, order='F')
+        gcv = _gcvspl.splc(Y, self.wx, np.ones(Y.shape[1]), 2, 0.0, p, EPS, c, self.stat, self.b, self.we, self.el,
+                           self.bwe)
+        count('factorizations')
+        return c, gcv
+
+    def gcv(self, Y, p):
+        """GCV value of each column of Y on its own for smoothing parameter p (one factorization for all of them)"""
+        Y = np.asfortranarray(Y, dtype=np.float64).reshape(len(self.x), -1)
+        c, gcv = self.solve(Y, p)
+        if Y.shape[1] == 1:
+            return np.array([gcv])
+
+        #SPLC's residuals, mean square and GCV ratio per column, in the fortran's order of operations
+        b = self.b
+        n = len(self.x)
+        dt = -Y
+        dt[1:] += b[0, 1:, None]*c[:-1]
+        dt += b[1, :, None]*c
+        dt[:-1] += b[2, :-1, None]*c[1:]
+        trn = self.stat[2]/n
+        return np.add.accumulate(dt*dt, axis=0)[-1]/n/trn/trn
+
+    def reported_p(self, p):
+        """the smoothing parameter gcvspl reports (wk[3], GCVSmoothedNSpline.p) after a fit with p"""
+        pel = p*self.el
+        if pel < EPS:
+            return 0.0
+        if pel*EPS > 1.0:
+            return 1.0/(self.el*EPS)
+        return p
+
+def _gcv_search(el):
+    """gcvspl's search for the p minimising the GCV value (MD = 2), as a generator: it yields the p to try
+    next and is sent back (GCV value, p used by SPLC); returns the p of the final fit.
+
+    input parameters
+    el = the design's penalty norm (SectionDesign.el), p starts at 1/el"""
+    r1 = 1.0/el
+    r2 = r1*RATIO
+    gf2, _ = yield r2
+    #bracket the minimum: halve p while the GCV value keeps decreasing...
+    while True:
+        gf1, used = yield r1
+        if gf1 > gf2:
+            break
+        if used <= 0:
+            return r1
+        r2, gf2 = r1, gf1
+        r1 = r1/RATIO
+    #...then double it
+    r3 = r2*RATIO
+    while True:
+        gf3, used = yield r3
+        if gf3 > gf2:
+            break
+        if used >= 1.0/EPS:
+            return r1
+        r2, gf2 = r3, gf3
+        r3 = r3*RATIO
+
+    #golden section search between r1 and r3
+    r2, gf2 = r3, gf3
+    alpha = (r2-r1)/TAU
+    r4 = r1+alpha
+    r3 = r2-alpha
+    gf3, _ = yield r3
+    gf4, _ = yield r4
+    while True:
+        if gf3 <= gf4:
+            r2, gf2 = r4, gf4
+            err = (r2-r1)/(r1+r2)
+            if err*err+1.0 == 1.0 or err <= TOL:
+                break
+            r4, gf4 = r3, gf3
+            alpha = alpha/TAU
+            r3 = r2-alpha
+            gf3, _ = yield r3
+        else:
+            r1, gf1 = r3, gf3
+            err = (r2-r1)/(r1+r2)
+            if err*err+1.0 == 1.0 or err <= TOL:
+                break
+            r3, gf3 = r4, gf4
+            alpha = alpha/TAU
+            r4 = r1+alpha
+            gf4, _ = yield r4
+    return 0.5*(r1+r2)
+
+def gcv_parameters(design, Y, joint=False):
+    """GCV smoothing parameters of the columns of Y, exactly as GCVSmoothedNSpline(t, Y[:,j]).p picks them.
+
+    The channels' searches run side by side, and whenever several of them try the same p (the bracketing steps
+    all start from the same p) they share one factorization.
+
+    input parameters
+    design = SectionDesign of the section
+    Y = len(t) x nchannels array of position data
+    joint = True: one search for all of the columns taken together, as GCVSmoothedNSpline(t, Y).p
+
+    output: array of p, one per column (a single one with joint=True)"""
+    Y = np.asfortranarray(Y, dtype=np.float64).reshape(len(design.x), -1)
+    searches = [_gcv_search(design.el) for j in range(1 if joint else Y.shape[1])]
+    pending = dict((j, search.send(None)) for j, search in enumerate(searches))
+    p = np.empty(len(searches))
+    count('gcv_searches', len(searches))
+
+    while pending:
+        by_p = {}
+        for j, pj in pending.items():
+            by_p.setdefault(pj, []).append(j)
+        pending = {}
+        for pj, js in by_p.items():
+            gcv = [design.solve(Y, pj)[1]] if joint else design.gcv(Y[:, js], pj)
+            used = design.reported_p(pj)
+            for j, gf in zip(js, gcv):
+                try:
+                    pending[j] = searches[j].send((gf, used))
+                except StopIteration as done:
+                    p[j] = design.reported_p(done.value)
+
+    return p
+
+def evaluate_section(section, x=None, nu=0):
+    """evaluate a Section's spline (or its nu-th derivative, per frame**nu) for all of its channels.
+
+    input parameters
+    section = a Section from smooth_trial
+    x = frame indices to evaluate at, defaults to every frame of the section
+    nu = derivative order
+
+    output: len(x) x len(section.channels) array"""
+    if x is None:
+        x = np.arange(section.start, section.stop)
+    x = np.asarray(x, dtype=np.float64)
+    spline = section.spline
+    c = spline.c.reshape(len(spline.x), -1)
+    return np.column_stack([splderivative(x, spline.x, np.ascontiguousarray(c[:, j]), IDER=nu)
+                            for j in range(c.shape[1])])
+
+@instrumented()
+def smooth_trial(snake, pf, joint=False):
+    """smooth every marker and dimension of a trial (what return_smoothed does for a single channel).
+
+    Each continuous section gets a GCV smoothing spline, whose smoothing parameter is then multiplied by pf
+    for the final fit. Channels are grouped by section: the spline design is built once per section and
+    every spline is evaluated on whole index arrays.
+
+    input parameters
+    snake = nframes x nmarkers x 3 array of position data (nan where missing)
+    pf = factor to multiply the GCV smoothing parameter by (p = 10000.0 in Notebook 1)
+    joint = False: GCV picks p for each channel on its own, as return_smoothed does (same p and same fits).
+            The channels only share the factorizations of the p they have in common (see gcv_parameters),
+            so most of the work is still done per channel.
+            True: one GCV search over all the channels sharing a section, and one final fit for the group.
+            This is about twice as fast, but the p picked for the group generally differs from the per channel
+            ones (positions move by up to ~40 mm on the real trials), so it is not used by the pipeline.
+
+    output:
+    smoothed = nframes x nmarkers x 3 array of smoothed positions, nan in gaps and sections too short to fit
+    sections = list of Sections (one per group of channels sharing a section), sorted by start frame"""
+    snake = np.asarray(snake, dtype=np.float64)
+    nframes = snake.shape[0]
+    X = snake.reshape(nframes, -1)
+    smoothed = np.full(X.shape, np.nan)
+
+    #channels that share a continuous section
+    channels, starts, stops = continuous_runs_batch(X)
+    groups = {}
+    for ch, s, e in zip(channels, starts, stops):
+        if e - s >= MIN_SECTION:
+            groups.setdefault((s, e), []).append(ch)
+
+    sections = []
+    for (s, e), chans in sorted(groups.items()):
+        design = SectionDesign(np.arange(s, e))
+        Y = X[s:e, chans]
+        p = gcv_parameters(design, Y, joint=joint)*pf
+
+        if joint:
+            c = design.solve(Y, p[0])[0]
+            p = np.repeat(p, len(chans))
+        else:
+            c = np.empty(Y.shape)
+            for j in range(len(chans)):
+                c[:, j] = design.solve(Y[:, j], p[j])[0][:, 0]
 
+        count('sections')
+        count('spline_fits', 1 if joint else len(chans))
+        section = Section(np.array(chans), s, e, SectionSpline(design.x, c, p))
+        smoothed[s:e, chans] = evaluate_section(section)
+        sections.append(section)
 
+    return smoothed.reshape(snake.shape), sections
@@ -1,5 +1,8 @@
 import numpy as np
 
+from instrument import instrumented
+
+@instrumented()
 def align(snake, origin, target):
     """align the coordinate system with the branches
     
@@ -0,0 +1,351 @@
+"""Timings of every pipeline stage, on synthetic trials and optionally real MOCAP files.
+
+usage: python benchmarks.py [--quick] [--real N] [--out results.json] [--baseline old.json] [--threshold 0.25]
+
+Results are saved as JSON (one entry per case, with the median and best of several runs). With --baseline, any
+case whose median is more than threshold slower than in the baseline, or that the baseline timed but that now
+fails or isn't run, is reported and the run exits with status 1.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from import_raw import get_raw_data, ORIGIN_OFFSET, TARGET_OFFSET
+from fill_and_shape import reshape_and_interp
+from align_coords import align
+from Piecewise_Smoothing import return_smoothed, smooth_trial
+from kinematics_fn import kins_fn, trial_kinematics, landing_fit
+from m_gncspline import global_natural_spline, global_natural_spline_batch, splinize_snake, SPLINE_CHUNK
+from trial_registry import TrialRegistry
+from ingest import MOCAP_DIR
+
+#smoothing factor used in Notebook 1
+P = 10000.0
+
+#branch markers in the MOCAP files, in column order
+BRANCH_MARKERS = ['OriginEnd', 'TargetEnd', 'OriginOther', 'TargetOther']
+
+
+def synthetic_trial(nframes=1500, frate=150, nmarkers=10, dropout=0.02, gap_lengths=(1, 40), gap=400.0, seed=0):
+    """an undulating snake crossing a gap, in the calibrated (unaligned) coordinates of a MOCAP file.
+
+    input parameters
+    nframes = number of frames
+    frate = frame rate
+    nmarkers = number of snake markers
+    dropout = fraction of each marker's frames lost in gaps
+    gap_lengths = (shortest, longest) gap in frames
+    gap = gap size (mm)
+    seed = random seed
+
+    output: dictionary with snake = nframes x nmarkers x 3 positions (mm, nan in gaps), branch = nframes x 4 x 3
+    branch marker positions, ms = marker spacings (cm, nosetip to first marker first), fr = frame rate"""
+
+    rng = np.random.RandomState(seed)
+    ms = [1.0] + [10.0]*(nmarkers-1)
+    s_marks = np.r_[0, np.cumsum(ms[1:])]*10 #mm along the body from the head marker
+    t = np.arange(nframes)*1.0/frate
+
+    #head moves from behind the origin end to the target, the body following along the same path
+    head = np.linspace(-250, gap, nframes)
+    along = head[:, np.newaxis]-s_marks
+    x = along
+    y = 60*np.sin(2*np.pi*(along/400.0-0.8*t[:, np.newaxis]))
+    z = -0.15*np.clip(along, 0, None)+5*np.sin(2*np.pi*(along/250.0-0.5*t[:, np.newaxis]))
+    snake = np.stack([x, y, z], axis=-1)+rng.normal(0, 0.5, (nframes, nmarkers, 3))
+
+    #branch ends at the origin and at the gap; markers sit at the recorded offsets from them
+    branch = np.full((nframes, 4, 3), np.nan)
+    branch[:, 0] = -ORIGIN_OFFSET
+    branch[:, 1] = np.array([gap, 0, 0])-TARGET_OFFSET
+    branch[:, :2] += rng.normal(0, 0.1, (nframes, 2, 3))
+
+    #rotate and shift into the calibrated coordinate system
+    theta = 0.3
+    rot = np.array([[np.cos(theta), -np.sin(theta), 0], [np.sin(theta), np.cos(theta), 0], [0, 0, 1]])
+    shift = np.array([800.0, -300.0, 1200.0])
+    snake = snake.dot(rot.T)+shift
+    branch = branch.dot(rot.T)+shift
+
+    #marker dropout
+    if dropout > 0:
+        mean_len = np.mean(gap_lengths)
+        for m in range(nmarkers):
+            for g in range(int(round(dropout*nframes/mean_len))):
+                length = rng.randint(gap_lengths[0], gap_lengths[1]+1)
+                start = rng.randint(0, max(nframes-length, 1))
+                snake[start:start+length, m] = np.nan
+
+    return {'snake': snake, 'branch': branch, 'ms': ms, 'fr': frate}
+
+
+def write_vicon_csv(path, trial, snake_ID=99):
+    """write a synthetic trial in the Vicon trajectories .csv format of the MOCAP files"""
+    snake, branch = trial['snake'], trial['branch']
+    nframes, nmarkers, _ = snake.shape
+    names = ['Snake_%d:M%d' % (snake_ID, m+1) for m in range(nmarkers)]+['Branch:'+b for b in BRANCH_MARKERS]
+    ncols = 3*len(names)
+
+    data = np.concatenate([snake.reshape(nframes, -1), branch.reshape(nframes, -1)], axis=1)
+    frames = np.arange(1, nframes+1)
+
+    with open(path, 'w', newline='') as f:
+        f.write('Trajectories\r\n%d\r\n' % trial['fr'])
+        f.write(',,'+','.join(n+',,' for n in names)+'\r\n')
+        f.write('Frame,Sub Frame,'+','.join(['X,Y,Z']*len(names))+'\r\n')
+        f.write(',,'+','.join(['mm']*ncols)+'\r\n')
+        for frame, row in zip(frames, data):
+            values = ['' if np.isnan(v) else '%.4f' % v for v in row]
+            f.write('%d,0,' % frame+','.join(values)+'\r\n')
+
+
+def synthetic_dataset(folder, ntrials=4, snake_ID=99, svl=85.0, mass=100.0, **kwargs):
+    """write ntrials synthetic MOCAP files and a matching reference_material.csv into folder.
+
+    output: list of the .csv files (read them with get_raw_data(path, registry=TrialRegistry(folder)))"""
+    paths = []
+    rows = []
+    for i in range(ntrials):
+        tn = i+1
+        trial = synthetic_trial(seed=tn, **kwargs)
+        path = os.path.join(folder, '%03d_Snake%02d_gap10_1.csv' % (tn, snake_ID))
+        write_vicon_csv(path, trial, snake_ID)
+        paths.append(path)
+        rows.append({'Trial': tn, 'Date': '', 'ID': snake_ID, 'Mass': mass, 'SVL': svl,
+                     'Spacings': ', '.join('%g' % s for s in trial['ms']), 'LF': len(trial['snake']),
+                     'DP': 'N/A', 'Notes': 'synthetic'})
+    pd.DataFrame(rows).to_csv(os.path.join(folder, 'reference_material.csv'), index=False)
+    return paths
+
+
+def _marker_frames(nmarkers):
+    #marker, density and chord tables in the format splinize_snake reads
+    marker_df = pd.DataFrame({'Dist to next, mm': [100.0]*(nmarkers-1)+[np.nan],
+                              'Marker type': ['head']+['body']*(nmarkers-2)+['vent'],
+                              'svl (mm)': 100.0*nmarkers, 'tail (mm)': 150.0})
+    s = np.linspace(0, 1.2, 50)
+    density_df = pd.DataFrame({'s': s, 'rho': 1+0.2*np.sin(np.pi*s)})
+    chord_df = pd.DataFrame({'s': s, 'chord': 0.02+0.005*np.cos(np.pi*s)})
+    return marker_df, density_df, chord_df
+
+
+def time_call(fn, repeat=3):
+    """run fn repeat times; returns (median, best) in seconds"""
+    times = []
+    for r in range(repeat):
+        tic = time.perf_counter()
+        fn()
+        times.append(time.perf_counter()-tic)
+    return float(np.median(times)), float(np.min(times))
+
+
+class Suite(object):
+    """collects the timings of a run"""
+
+    def __init__(self, repeat=3, verbose=True):
+        self.repeat = repeat
+        self.verbose = verbose
+        self.results = []
+
+    def case(self, name, fn, **params):
+        #one timing; failures are recorded instead of stopping the run
+        entry = {'name': name, 'params': params}
+        try:
+            entry['median'], entry['best'] = time_call(fn, self.repeat)
+        except Exception as e:
+            entry['error'] = '%s: %s' % (type(e).__name__, e)
+        self.results.append(entry)
+        if self.verbose:
+            shown = ', '.join('%s=%s' % kv for kv in sorted(params.items()))
+            if 'error' in entry:
+                print('%-28s %-40s error %s' % (name, shown, entry['error']))
+            else:
+                print('%-28s %-40s %10.4f s' % (name, shown, entry['median']))
+        return entry
+
+
+def legacy_smoothing(snake, frate):
+    """Notebook 1 step 4 as originally written: return_smoothed and kins_fn one channel at a time"""
+    for m in range(snake.shape[1]):
+        for d in range(3):
+            conts, smoothie = return_smoothed(snake[:, m, d], P)
+            if len(conts):
+                kins_fn(conts, smoothie, frate)
+
+
+def stage_cases(suite, nframes, frate=150, nmarkers=10, nspl=1000, dropout=0.02, folder=None):
+    """time each stage on one synthetic trial"""
+    trial = synthetic_trial(nframes=nframes, frate=frate, nmarkers=nmarkers, dropout=dropout)
+    params = {'sweep': 'frames', 'frames': nframes, 'markers': nmarkers}
+
+    if folder is not None and nmarkers == 10:
+        path = os.path.join(folder, '001_Snake99_gap10_1.csv')
+        write_vicon_csv(path, trial)
+        pd.DataFrame([{'Trial': 1, 'Date': '', 'ID': 99, 'Mass': 100.0, 'SVL': 85.0,
+                       'Spacings': ', '.join('%g' % s for s in trial['ms']), 'LF': nframes, 'DP': 'N/A',
+                       'Notes': ''}]).to_csv(os.path.join(folder, 'reference_material.csv'), index=False)
+        registry = TrialRegistry(folder)
+        suite.case('get_raw_data', lambda: get_raw_data(path, cache_dir=None, registry=registry), **params)
+
+    raw = trial['snake'].reshape(nframes, -1)
+    if nmarkers == 10:
+        suite.case('reshape_and_interp', lambda: reshape_and_interp(raw, list(trial['ms']), 0.2, frate), **params)
+
+    snake = trial['snake']
+    origin = trial['branch'][0, 0]+ORIGIN_OFFSET
+    target = trial['branch'][0, 1]+TARGET_OFFSET
+    suite.case('align', lambda: align(snake, origin, target), **params)
+
+    aligned = align(snake, origin, target)[0]
+    suite.case('return_smoothed+kins_fn', lambda: legacy_smoothing(aligned, frate), **params)
+    suite.case('smooth_trial+trial_kinematics',
+               lambda: trial_kinematics(smooth_trial(aligned, P)[1], aligned.shape, frate), **params)
+    #joint=True trades the per channel p (and positions) for speed, see smooth_trial
+    suite.case('smooth_trial joint+trial_kinematics',
+               lambda: trial_kinematics(smooth_trial(aligned, P, joint=True)[1], aligned.shape, frate), **params)
+
+    #splines are fit to complete frames
+    full = np.cumsum(np.random.RandomState(0).normal(0, 30, (nframes, nmarkers, 3)), axis=1)
+    t = np.full(nmarkers-1, 100.0)
+
+    #landing velocity window sweep of Notebook 4: a polyfit per window and dimension, against one landing_fit
+    head = full[:, 0]
+    windows = list(range(9, 19))
+    suite.case('polyfit landing sweep', lambda: [np.polyfit(np.arange(n)*1.0/frate, head[-n:, d], 1, full=True)
+                                                 for n in windows for d in range(3)], **params)
+    suite.case('landing_fit', lambda: landing_fit(head, frate, windows=windows), **params)
+
+    params = dict(params, nspl=nspl)
+    suite.case('global_natural_spline', lambda: [global_natural_spline(p, t, nspl) for p in full], **params)
+    suite.case('global_natural_spline_batch', lambda: global_natural_spline_batch(full, t, nspl), **params)
+
+    pfe = np.concatenate([full[:, :1]+[10.0, 0, 0], full], axis=1)
+    te = np.r_[10.0, t]
+    marker_df, density_df, chord_df = _marker_frames(nmarkers)
+    times = np.arange(nframes)*1.0/frate
+    suite.case('splinize_snake', lambda: splinize_snake(pfe, te, nspl, times, 0.1, marker_df, density_df, chord_df),
+               **params)
+    suite.case('splinize_snake R_I,Ro_I float32 chunked',
+               lambda: splinize_snake(pfe, te, nspl, times, 0.1, marker_df, density_df, chord_df,
+                                      fields=['R_I', 'Ro_I'], dtype=np.float32, chunk=SPLINE_CHUNK), **params)
+
+
+def run(quick=False, real=0, repeat=3, verbose=True):
+    """run the suite; returns the results dictionary"""
+    suite = Suite(repeat=repeat, verbose=verbose)
+    folder = tempfile.mkdtemp(prefix='snake_bench_')
+    try:
+        frames = [500, 1000] if quick else [500, 1000, 2000, 4000]
+        markers = [4, 10] if quick else [4, 6, 8, 10]
+        nspls = [250, 1000] if quick else [250, 500, 1000, 2000]
+        trial_counts = [1, 2] if quick else [1, 2, 4, 8]
+
+        #scaling over frames (all stages), then markers and nspl (spline stages)
+        for n in frames:
+            stage_cases(suite, n, folder=folder)
+        for m in markers:
+            full = np.cumsum(np.random.RandomState(0).normal(0, 30, (1000, m, 3)), axis=1)
+            t = np.full(m-1, 100.0)
+            suite.case('global_natural_spline_batch', lambda: global_natural_spline_batch(full, t, 1000),
+                       sweep='markers', frames=1000, markers=m, nspl=1000)
+        for nspl in nspls:
+            full = np.cumsum(np.random.RandomState(0).normal(0, 30, (1000, 10, 3)), axis=1)
+            t = np.full(9, 100.0)
+            suite.case('global_natural_spline_batch', lambda: global_natural_spline_batch(full, t, nspl),
+                       sweep='nspl', frames=1000, markers=10, nspl=nspl)
+
+        #scaling over trial count: import, reshape, align and smooth a synthetic dataset
+        for ntrials in trial_counts:
+            sub = os.path.join(folder, 'set%d' % ntrials)
+            os.makedirs(sub)
+            paths = synthetic_dataset(sub, ntrials, nframes=1000)
+            registry = TrialRegistry(sub)
+
+            def pipeline():
+                for path in paths:
+                    d = get_raw_data(path, cache_dir=None, registry=registry)
+                    shaped = reshape_and_interp(d['raw'], d['ms'], 0.2, d['fr'])[0]
+                    aligned = align(shaped, d['oe'], d['te'])[0]
+                    trial_kinematics(smooth_trial(aligned, P)[1], aligned.shape, d['fr'])
+            suite.case('pipeline', pipeline, sweep='trials', trials=ntrials, frames=1000)
+
+        #real files
+        for path in sorted(glob.glob(os.path.join(MOCAP_DIR, '*.csv')))[:real]:
+            suite.case('get_raw_data', lambda: get_raw_data(path, cache_dir=None), sweep='real', file=os.path.basename(path))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'quick': quick,
+            'results': suite.results}
+
+
+def _case_key(entry):
+    return entry['name'], json.dumps(entry['params'], sort_keys=True)
+
+
+def compare(results, baseline, threshold=0.25):
+    """cases slower than the baseline by more than threshold (a fraction), as (name, params, baseline, new) tuples.
+    Cases timed in the baseline that now fail or weren't run are regressions too, with new the error message
+    or None"""
+    new = dict((_case_key(e), e) for e in results['results'])
+    slower = []
+    for entry in baseline['results']:
+        if 'median' not in entry:
+            continue
+        now = new.get(_case_key(entry))
+        if now is None:
+            slower.append((entry['name'], entry['params'], entry['median'], None))
+        elif 'median' not in now:
+            slower.append((entry['name'], entry['params'], entry['median'], now.get('error', 'no timing')))
+        elif now['median'] > entry['median']*(1+threshold):
+            slower.append((entry['name'], entry['params'], entry['median'], now['median']))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='time the FlyingSnakeGaps processing pipeline')
+    parser.add_argument('--quick', action='store_true', help='fewer, smaller cases')
+    parser.add_argument('--real', type=int, default=0, help='also time get_raw_data on the first N MOCAP files')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case (the median is kept)')
+    parser.add_argument('--out', default='benchmark_results.json', help='where to save the results')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown vs the baseline (0.25 = 25%%)')
+    args = parser.parse_args(argv)
+
+    results = run(quick=args.quick, real=args.real, repeat=args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('saved ' + args.out)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.threshold)
+        for name, params, before, after in slower:
+            if after is None:
+                after = 'not run'
+            elif not isinstance(after, str):
+                after = '%.4f s' % after
+            print('REGRESSION %s %s: %.4f s -> %s' % (name, params, before, after))
+        if slower:
+            return 1
+        print('no regressions beyond %d%%' % (args.threshold*100))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
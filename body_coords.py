@@ -0,0 +1,237 @@
+import numpy as np
+
+from m_gncspline import marker_patterns, natural_spline_coefficients
+from torque_fn import DENSITY_FILE, load_density
+from instrument import instrumented, count
+
+#sub-intervals per spline segment in the arc length tables
+NSUB = 16
+
+#Gauss-Legendre nodes and weights on [0, 1] for integrating arc length over each sub-interval
+_GL_NODES = 0.5+0.5*np.array([-np.sqrt(3/5), 0, np.sqrt(3/5)])
+_GL_WEIGHTS = 0.5*np.array([5/9, 8/9, 5/9])
+
+
+class _Group(object):
+    #frames sharing the same present markers: spline coefficients and arc length table
+    def __init__(self, frames, knots, coeffs, nsub):
+        self.frames = frames
+        self.knots = knots
+        self.coeffs = coeffs #a, b, c, d, each (nframes, nseg, 3)
+
+        nseg = len(knots)-1
+        frac = np.arange(nsub)/nsub
+        self.grid = np.r_[(knots[:-1, np.newaxis]+np.diff(knots)[:, np.newaxis]*frac).ravel(), knots[-1]]
+        self.grid_seg = np.repeat(np.arange(nseg), nsub)
+
+        #arc length of each sub-interval, then cumulative from the first marker of the group
+        h = np.diff(self.grid)
+        nodes = (self.grid[:-1, np.newaxis]+h[:, np.newaxis]*_GL_NODES).ravel()
+        speed = np.linalg.norm(self.evaluate(nodes, 1, np.repeat(self.grid_seg, len(_GL_NODES))), axis=-1)
+        ds = (speed.reshape(len(frames), -1, len(_GL_NODES))*_GL_WEIGHTS).sum(axis=-1)*h
+        self.s = np.concatenate([np.zeros((len(frames), 1)), ds.cumsum(axis=1)], axis=1)
+
+    def segment(self, u):
+        return np.clip(np.searchsorted(self.knots, u, side='right')-1, 0, len(self.knots)-2)
+
+    def covers(self, u):
+        return (u >= self.knots[0]) & (u <= self.knots[-1])
+
+    def evaluate(self, u, deriv=0, seg=None):
+        #position (deriv=0) or derivative along the body coordinate at u, (nframes, len(u), 3)
+        if seg is None:
+            seg = self.segment(u)
+        a, b, c, d = [k[:, seg] for k in self.coeffs]
+        ti = (u-self.knots[seg])[:, np.newaxis]
+        if deriv == 0:
+            return a+ti*(b+ti*(c+ti*d))
+        if deriv == 1:
+            return b+ti*(2*c+3*ti*d)
+        return 2*c+6*ti*d
+
+
+class BodyCoords(object):
+    """Queries along the body (positions, tangents, curvature, arc length...) for every frame of a trial.
+
+    The markers of each frame are fit with a global natural spline (as in m_gncspline), keeping only the
+    cubic coefficients: queries are evaluated at the requested points instead of on nspl points per frame.
+    Frames are grouped by which markers are present and each group is queried as whole arrays.
+    The arc length of each frame is tabulated once, NSUB points per segment, integrated with Gauss-Legendre.
+
+    Positions along the body are given in %SVL of the body coordinate: the distance along the body from the
+    head marker, from the marker spacings (the ts/svl that the density profile is looked up with in
+    torque_fn and splinize_snake). Results are nan in frames where the point is outside the present markers
+    (e.g. before the first marker when the head is missing) and in frames with fewer than two markers.
+
+    For example, the position of 40% SVL, and the fraction of the body past the origin end, in every frame:
+
+        body = BodyCoords(sm_pos[i], spacings, svl, mass)
+        r40 = body.position(40)[:, 0]
+        in_gap = body.gap_fraction()
+
+    Parameters
+    ----------
+    positions : array, size (ntime, nmark, 3)
+        marker positions, nan where missing
+    spacings : array, size (nmark)
+        marker spacings, the distance from the nosetip to the first marker first (as in the trial data)
+    svl : float
+        snout vent length, in the units of the spacings
+    mass : float
+        snake mass (for the mass distribution queries)
+    density : tuple of arrays
+        (s, rho) density profile, s in fractions of svl; read from DENSITY_FILE by default
+    chord : tuple of arrays or DataFrame
+        (s, chord) chord length profile, s and chord in fractions of svl (or splinize_snake's chord_df)
+    nsub : int
+        points per spline segment in the arc length tables
+    """
+
+    @instrumented('body_coords')
+    def __init__(self, positions, spacings, svl, mass=None, density=None, chord=None, nsub=NSUB):
+        positions = np.asarray(positions, dtype=np.float64)
+        self.ntime = positions.shape[0]
+        self.svl = svl
+        self.mass = mass
+
+        #body coordinate of every marker
+        t = np.asarray(spacings, dtype=np.float64)[1:]
+        self.marker_coords = np.r_[0, t.cumsum()]
+
+        if density is None:
+            density = load_density(DENSITY_FILE)
+        self.s_rho, self.body_rho = [np.asarray(x, dtype=np.float64) for x in density]
+        if chord is not None and hasattr(chord, 'columns'):
+            chord = (chord['s'].values, chord['chord'].values)
+        self.chord_table = None if chord is None else tuple(np.asarray(x, dtype=np.float64) for x in chord)
+
+        self.groups = []
+        for present, frames in marker_patterns(positions):
+            count('frame_groups')
+            if present.sum() < 2:
+                continue
+            knots = self.marker_coords[present]
+            coeffs = natural_spline_coefficients(positions[frames][:, present], np.diff(knots))
+            self.groups.append(_Group(frames, knots, coeffs, nsub))
+
+    def _coords(self, svl_pct):
+        return np.atleast_1d(np.asarray(svl_pct, dtype=np.float64))*self.svl/100
+
+    def _query(self, svl_pct, fn, trailing=(3,)):
+        u = self._coords(svl_pct)
+        out = np.full((self.ntime, len(u))+trailing, np.nan)
+        for g in self.groups:
+            ok = g.covers(u)
+            if ok.any():
+                rows = np.ix_(g.frames, np.flatnonzero(ok))
+                out[rows] = fn(g, u[ok])
+        return out
+
+    def position(self, svl_pct):
+        """positions of points along the body, size (ntime, npoints, 3)"""
+        return self._query(svl_pct, lambda g, u: g.evaluate(u, 0))
+
+    def derivative(self, svl_pct, deriv=1):
+        """first or second derivative of the position along the body coordinate, size (ntime, npoints, 3)"""
+        return self._query(svl_pct, lambda g, u: g.evaluate(u, deriv))
+
+    def tangent(self, svl_pct):
+        """unit tangent vectors, pointing towards the tail, size (ntime, npoints, 3)"""
+        def fn(g, u):
+            dr = g.evaluate(u, 1)
+            return dr/np.linalg.norm(dr, axis=-1, keepdims=True)
+        return self._query(svl_pct, fn)
+
+    def curvature(self, svl_pct):
+        """curvature (1/length), size (ntime, npoints)"""
+        def fn(g, u):
+            dr, ddr = g.evaluate(u, 1), g.evaluate(u, 2)
+            return np.linalg.norm(np.cross(dr, ddr), axis=-1)/np.linalg.norm(dr, axis=-1)**3
+        return self._query(svl_pct, fn, ())
+
+    def arc_length(self, svl_pct):
+        """arc length along the spline from the first present marker, size (ntime, npoints)"""
+        def fn(g, u):
+            j = np.clip(np.searchsorted(g.grid, u, side='right')-1, 0, len(g.grid)-2)
+            w = (u-g.grid[j])/(g.grid[j+1]-g.grid[j])
+            return g.s[:, j]*(1-w)+g.s[:, j+1]*w
+        return self._query(svl_pct, fn, ())
+
+    @property
+    def length(self):
+        """arc length of the spline between the first and last present markers, size (ntime)"""
+        out = np.full(self.ntime, np.nan)
+        for g in self.groups:
+            out[g.frames] = g.s[:, -1]
+        return out
+
+    def at_arc_length(self, s):
+        """%SVL (body coordinate) at arc lengths s from the first present marker, size (ntime, npoints)
+        (nan past the end of the spline)"""
+        s = np.atleast_1d(np.asarray(s, dtype=np.float64))
+        out = np.full((self.ntime, len(s)), np.nan)
+        for g in self.groups:
+            #table interval of every query in every frame (the tables increase along each row)
+            j = (g.s[:, :, np.newaxis] <= s).sum(axis=1)-1
+            ok = (j >= 0) & (s <= g.s[:, -1:])
+            j = np.clip(j, 0, len(g.grid)-2)
+            s0 = np.take_along_axis(g.s, j, axis=1)
+            s1 = np.take_along_axis(g.s, j+1, axis=1)
+            u = g.grid[j]+(s-s0)/(s1-s0)*(g.grid[j+1]-g.grid[j])
+            out[g.frames] = np.where(ok, u*100/self.svl, np.nan)
+        return out
+
+    def density(self, svl_pct):
+        """normalized density (rho/rho_bar) at points along the body, the same in every frame"""
+        return np.interp(np.asarray(svl_pct, dtype=np.float64)/100, self.s_rho, self.body_rho)
+
+    def mass_per_length(self, svl_pct):
+        """mass per unit length at points along the body (needs mass): the density profile scaled so that
+        it integrates to the snake's mass over the svl"""
+        if self.mass is None:
+            raise ValueError('no mass given')
+        s = np.linspace(0, 1, 1001)
+        rho = np.interp(s, self.s_rho, self.body_rho)
+        total = ((rho[1:]+rho[:-1])/2*np.diff(s)).sum()*self.svl
+        return self.mass*self.density(svl_pct)/total
+
+    def chord(self, svl_pct):
+        """chord length at points along the body (needs a chord profile)"""
+        if self.chord_table is None:
+            raise ValueError('no chord profile given')
+        s_chord, body_chord = self.chord_table
+        return self.svl*np.interp(np.asarray(svl_pct, dtype=np.float64)/100, s_chord, body_chord)
+
+    def _table_fractions(self, g, x0, axis):
+        #fraction of each table interval past x0 along axis, from the ends of the interval, (nframes, nintervals)
+        x = g.evaluate(g.grid, 0, np.r_[g.grid_seg, g.grid_seg[-1]])[:, :, axis]-x0
+        x_a, x_b = x[:, :-1], x[:, 1:]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cross = np.where(x_a > 0, x_a/(x_a-x_b), x_b/(x_b-x_a))
+        return np.where((x_a > 0) & (x_b > 0), 1.0, np.where((x_a <= 0) & (x_b <= 0), 0.0, cross))
+
+    def gap_fraction(self, x0=0.0, axis=0, by_mass=False):
+        """part of the body past x0 along an axis (by default in the gap, X > 0, with the origin end at the origin),
+        in each frame: as a fraction of the svl of body coordinate, or with by_mass a fraction of the mass.
+        Only the spline between the present markers counts."""
+        out = np.full(self.ntime, np.nan)
+        for g in self.groups:
+            f = self._table_fractions(g, x0, axis)
+            h = np.diff(g.grid)
+            if by_mass:
+                mid = (g.grid[:-1]+g.grid[1:])/2*100/self.svl
+                dm = self.mass_per_length(mid)*h
+                out[g.frames] = (f*dm).sum(axis=1)/self.mass
+            else:
+                out[g.frames] = (f*h).sum(axis=1)/self.svl
+        return out
+
+    def center_of_mass(self):
+        """center of mass of the spline between the present markers, size (ntime, 3) (needs mass)"""
+        out = np.full((self.ntime, 3), np.nan)
+        for g in self.groups:
+            mid = (g.grid[:-1]+g.grid[1:])/2
+            dm = self.mass_per_length(mid*100/self.svl)*np.diff(g.grid)
+            r = g.evaluate(mid, 0, g.grid_seg)
+            out[g.frames] = np.einsum('ijk,j->ik', r, dm)/dm.sum()
+        return out
@@ -0,0 +1,158 @@
+import numpy as np
+
+from align_coords import align
+from instrument import instrumented
+
+#confidence flags, or'ed together in the 'flags' column of the event table
+NO_ORIGIN = 1 #no origin end: the data isn't aligned, so none of the x based events can be trusted
+NO_START = 2 #the head never passes the origin end
+NO_DROP = 4 #no drop frame in the metadata; the peak is searched from the start
+NO_TARGET = 8 #no target end: no arrival
+NO_ARRIVAL = 16 #the head never reaches the target end
+PEAK_AT_EDGE = 32 #the peak is at the first or last frame it was searched over (e.g. still rising at landing)
+LOW_AT_EDGE = 64 #the low point is at the first or last frame it was searched over
+LOW_GAP = 128 #the low point marker is missing within `window` frames of the low point
+LOW_ON_BRANCH = 256 #a marker still on the branch is lower than the low point (the old find_frames would have picked it)
+
+FLAGS = dict((name, value) for name, value in globals().items() if name.isupper() and isinstance(value, int))
+
+#flags that mean the event frames need checking by hand (LOW_ON_BRANCH is informative only)
+CHECK = NO_ORIGIN | NO_START | PEAK_AT_EDGE | LOW_AT_EDGE | LOW_GAP
+
+
+def describe_flags(flags):
+    """names of the flags set in a flags value"""
+    return [name for name, value in sorted(FLAGS.items(), key=lambda kv: kv[1]) if int(flags) & value]
+
+
+def drop_index(meta):
+    """index (into the trial's frames) of the drop frame of a get_raw_data dictionary, nan if there is none
+    or the drop frame isn't one of the trial's frames (where the notebooks' frames.index(dp) raises)"""
+    fn = np.asarray(meta['fn'])
+    if meta['dp'] is None or np.isnan(meta['dp']) or not len(fn):
+        return np.nan
+    dp = int(meta['dp'])
+    i = np.searchsorted(fn, dp)
+    #searchsorted gives the next frame (or len(fn)) when dp isn't in fn
+    return float(i) if i < len(fn) and fn[i] == dp else np.nan
+
+
+def aligned_target(meta):
+    """target end in the aligned coordinate system of a get_raw_data dictionary (nan unless both ends were found)"""
+    oe, te = np.asarray(meta['oe'], dtype=np.float64), np.asarray(meta['te'], dtype=np.float64)
+    if np.isnan(oe).any() or np.isnan(te).any():
+        return np.full(3, np.nan)
+    return align(np.zeros((1, 1, 3)), oe, te)[2]
+
+
+def event_inputs(metas):
+    """drops, targets and aligned (see detect_events) from a list of get_raw_data dictionaries"""
+    drops = np.array([drop_index(m) for m in metas])
+    targets = np.array([aligned_target(m) for m in metas]).reshape(len(metas), 3)
+    aligned = np.array([not np.isnan(np.asarray(m['oe'], dtype=np.float64)).any() for m in metas], dtype=bool)
+    return drops, targets, aligned
+
+
+def _first(ts, mask):
+    #first frame of each trial where mask is true, -1 if never
+    return ts.argmax(np.where(mask, 1.0, np.nan))
+
+
+@instrumented()
+def detect_events(ts, drops=None, targets=None, aligned=None, name='pos', clear=0.0, window=5):
+    """gap crossing events of every trial of a TrialSet of aligned, smoothed positions (mm, origin end at the
+    origin, x towards the target), all trials at once.
+
+    Events (frames within each trial, -1 where not found):
+    start = first frame the head is past the origin end (x > clear), the start of get_raw_data's crop
+    high = peak: frame of the highest head position after the drop frame (after start without one)
+    low = low point: frame of the lowest body (non-head) marker between start and the peak (the end of the trial
+          if that is the peak), counting a marker only once it has left the branch (x > clear); low_marker is
+          that marker and low_z its height
+    marker_low = per marker, the frame of its lowest position after leaving the branch (ntrials x nmarkers),
+                 with marker_low_z the height
+    arrival = first frame the head reaches the target end (x >= the target end's x)
+
+    input parameters
+    ts = TrialSet with the positions as quantity `name` (nframes x nmarkers x 3)
+    drops = per trial, index of the drop frame into the trial's frames (nan if none), see drop_index
+    targets = per trial, target end in the aligned coordinates (nan if unknown), see aligned_target
+    aligned = per trial, whether the data was aligned (False if the origin end is missing)
+    clear = x (mm) past which a marker is off the branch
+    window = frames either side of the low point checked for missing data
+
+    output: dictionary of event columns (one row per trial, with 'tn' if ts has it), plus 'flags' (see FLAGS)
+    and 'confident' (no flag in CHECK set)"""
+
+    n = len(ts)
+    pos = ts[name]
+    x, z = pos[:, :, 0], pos[:, :, 2]
+    frame = ts.local_frame
+    first = ts.offsets[:-1]
+    last = ts.lengths-1
+
+    drops = np.full(n, np.nan) if drops is None else np.asarray(drops, dtype=np.float64)
+    targets = np.full((n, 3), np.nan) if targets is None else np.asarray(targets, dtype=np.float64).reshape(n, 3)
+    aligned = np.ones(n, dtype=bool) if aligned is None else np.asarray(aligned, dtype=bool)
+
+    flags = np.zeros(n, dtype=np.int64)
+    flags[~aligned] |= NO_ORIGIN
+
+    #START: head past the origin end
+    start = _first(ts, x[:, 0] > clear)
+    flags[start < 0] |= NO_START
+    from_start = np.where(start < 0, 0, start)
+
+    #PEAK: highest head position after the drop frame
+    flags[np.isnan(drops)] |= NO_DROP
+    search = np.where(np.isnan(drops), from_start, np.nan_to_num(drops)).astype(np.int64)
+    head_z = np.where(frame >= ts.broadcast(search), z[:, 0], np.nan)
+    high = ts.argmax(head_z)
+    high_z = ts.max(head_z)
+    flags[(high >= 0) & ((high == search) | (high == last))] |= PEAK_AT_EDGE
+
+    #PER MARKER LOW POINTS: only once the marker has left the branch
+    in_gap = x > clear
+    gap_z = np.where(in_gap, z, np.nan)
+    marker_low = ts.argmin(gap_z)
+    marker_low_z = ts.min(gap_z)
+
+    #LOW POINT: lowest body marker in the gap between start and the peak. Where that is the peak itself (the body
+    #is still going down) it is looked for in the rest of the trial, as was done by hand for trials 247 and 248
+    body_low = np.fmin.reduce(gap_z[:, 1:], axis=1)
+    stop = np.where(high < 0, last, high)
+    between = (frame >= ts.broadcast(from_start)) & (frame <= ts.broadcast(stop))
+    low = ts.argmin(np.where(between, body_low, np.nan))
+    stop = np.where((low >= 0) & (low == stop), last, stop)
+    between = (frame >= ts.broadcast(from_start)) & (frame <= ts.broadcast(stop))
+    low = ts.argmin(np.where(between, body_low, np.nan))
+    low_z = ts.min(np.where(between, body_low, np.nan))
+    flags[(low >= 0) & ((low == from_start) | (low == stop))] |= LOW_AT_EDGE
+
+    low_marker = np.full(n, -1, dtype=np.int64)
+    found = np.flatnonzero(low >= 0)
+    rows = first[found]+low[found]
+    low_marker[found] = 1+np.nanargmin(gap_z[rows, 1:], axis=1)
+
+    #missing samples of the low point marker around the low point
+    offsets = np.arange(-window, window+1)
+    near = np.clip(low[found, np.newaxis]+offsets, 0, last[found, np.newaxis])+first[found, np.newaxis]
+    missing = np.isnan(z[near, low_marker[found, np.newaxis]]).any(axis=1)
+    flags[found[missing]] |= LOW_GAP
+
+    #the lowest body marker anywhere (on the branch too), as find_frames picked it
+    any_low = ts.min(np.where(between, np.fmin.reduce(z[:, 1:], axis=1), np.nan))
+    flags[(low >= 0) & (any_low < low_z)] |= LOW_ON_BRANCH
+
+    #ARRIVAL: head at the target end
+    flags[np.isnan(targets[:, 0])] |= NO_TARGET
+    arrival = _first(ts, x[:, 0] >= ts.broadcast(targets[:, 0]))
+    flags[~np.isnan(targets[:, 0]) & (arrival < 0)] |= NO_ARRIVAL
+
+    table = {'start': start, 'high': high, 'high_z': high_z, 'low': low, 'low_marker': low_marker, 'low_z': low_z,
+             'marker_low': marker_low, 'marker_low_z': marker_low_z, 'arrival': arrival, 'flags': flags,
+             'confident': (flags & CHECK) == 0}
+    if 'tn' in ts.meta:
+        table['tn'] = ts.meta['tn']
+
+    return table
@@ -1,50 +1,155 @@
 import numpy as np
-import pandas as pd
 
+from instrument import instrumented, count
 
-def reshape_and_interp(csv, mark_spaces, n, frate):
+
+def fill_gaps(X, limit, starts=None, partial=False):
+    """linearly interpolate, in place, the gaps (runs of nans) of up to limit frames in every column of X.
+
+    Runs of up to limit nans at the end of a trial are filled with the last valid value, as pandas'
+    interpolate('linear', limit=limit) did. Longer gaps, and nans at the start of a trial, are left alone.
+
+    input parameters
+    X = nframes x nchannels float array, modified in place
+    limit = longest gap to fill (frames). An int, or with starts, one per trial
+    starts = first row of each trial when several trials are stacked in X (gaps never span two trials)
+    partial = True: also fill the first limit frames of longer gaps and end runs, exactly like pandas'
+              interpolate(limit=limit) (the ends of those gaps stay nan, so the filled part is only a partial
+              line between the gap's end points)
+
+    output: boolean nframes x nchannels array of the values that were filled"""
+
+    A = X.shape[0]
+    missing = np.isnan(X)
+    if not missing.any():
+        return missing
+
+    #channels x frames, so the scans below run over contiguous memory
+    missing_t = np.ascontiguousarray(missing.T)
+    rows = np.arange(A, dtype=np.int32 if A < 2**31 else np.int64)
+    #last valid row at or before each row, and first valid row at or after it (-1 / A if none)
+    prev = np.maximum.accumulate(np.where(missing_t, -1, rows), axis=1)
+    nxt = np.minimum.accumulate(np.where(missing_t, A, rows)[:, ::-1], axis=1)[:, ::-1]
+
+    if starts is None:
+        first, last, limits = 0, A, limit
+    else:
+        trial = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, A]))
+        limits = np.broadcast_to(np.asarray(limit), (len(starts),))[trial]
+        first = np.asarray(starts)[trial]
+        last = np.r_[starts[1:], A][trial]
+
+    if partial:
+        ok = (prev >= first) & (rows-prev <= limits)
+    else:
+        #length of the gap, or of the run of nans up to the end of the trial
+        ok = (prev >= first) & (np.minimum(nxt, last)-prev-1 <= limits)
+
+    c, r = np.nonzero(missing_t & ok)
+    p, q = prev[c, r], nxt[c, r]
+    inside = q < (last if starts is None else last[r])
+
+    #same form as np.interp (what pandas' linear interpolation uses)
+    ci, ri, pi, qi = c[inside], r[inside], p[inside], q[inside]
+    slope = (X[qi, ci]-X[pi, ci])/(qi-pi)
+    X[ri, ci] = slope*(ri-pi)+X[pi, ci]
+    #past the last valid value np.interp (and pandas) keep it
+    end = ~inside
+    X[r[end], c[end]] = X[p[end], c[end]]
+
+    fill = np.zeros_like(missing)
+    fill[r, c] = True
+
+    return fill
+
+
+def drop_markers(snake, mark_spaces):
+    """remove markers that were never recorded, merging their spacings into the next marker's.
+
+    input parameters
+    snake = nframes x nmarkers x 3 array
+    mark_spaces = list of marker spacings, the first one from the nosetip to the first marker
+
+    output: snake without the dropped markers (the same array if none were dropped), list of dropped markers,
+    new list of marker spacings"""
+
+    keep = ~np.isnan(snake[:, :, 0]).all(axis=0)
+    dropped = np.flatnonzero(~keep).tolist()
+    if not dropped:
+        return snake, dropped, list(mark_spaces)
+
+    #each kept marker's spacing is summed from the one after the previous kept marker up to its own
+    #(markers after the last kept one, e.g. the vent, just lose theirs)
+    kept = np.flatnonzero(keep)
+    starts = np.r_[0, kept[:-1]+1]
+    mark_s = np.add.reduceat(np.asarray(mark_spaces, dtype=np.float64)[:kept[-1]+1], starts)
+
+    return snake[:, keep], dropped, mark_s.tolist()
+
+
+@instrumented()
+def reshape_and_interp(csv, mark_spaces, n, frate, dtype=None, partial=False):
     """
     input parameters:
     snake = a n-time*30 array of position data, corresponding to 10 markers in 3 dimensions
     mark_s = list of marker spacings
     n = how big a gap to fill with interpolation (in seconds)
     frate = frame rate of the trial
-    
-    output: 
+    dtype = dtype of the output, e.g. np.float32 (defaults to float64)
+    partial = True: also fill the first n*frate frames of longer gaps, like the pandas version did (see fill_gaps)
+
+    output:
     snake1 = reshaped position data, with missing markers dropped, and small gaps interpolated
     mark_s1 = new marker spacings relfecting dropped markers
     m = list of which markers have been dropped
     """
-    
-    
-    #linarly interpolates gaps that are less than n*fr frames, i.e. n seconds    
-    csv = pd.DataFrame(csv)
-    csv_int = csv.interpolate('linear',limit = np.int(n*frate)) 
-    
-    csv_int = np.asarray(csv_int)
-    (A,B) = csv_int.shape
-    snake1 = np.reshape(csv_int, (A,10,3)) #so snake's dimensions are [frame, marker, dimension]
-    
+
+    #linarly interpolates gaps that are at most n*fr frames, i.e. n seconds, and carries the last value over as
+    #many frames at the end. Longer gaps are left alone.
+    snake = np.array(csv, dtype=np.float64 if dtype is None else dtype) #the one copy; filled in place
+    filled = fill_gaps(snake, int(n*frate), partial=partial)
+    count('samples_interpolated', int(filled.sum())//3) #marker positions filled in
+
+    (A,B) = snake.shape
+    snake1 = snake.reshape(A,B//3,3) #so snake's dimensions are [frame, marker, dimension]
+
     #update snake, marker spacings if any markers are totally missing, creating a list of which markers are dropped.
-    dropped = []
-    mark_s = mark_spaces.copy() #otherwise function updates the variable put in.
-    for m in np.arange(9):
-        if all(np.isnan(snake1[:,m,0])): #check the first 9 markers (vent marker treated separately below)
-            #update marker spacings list
-            mark_s[m+1] = mark_s[m+1]+mark_s[m] 
-            dropped.append(m)
-            
-    if all(np.isnan(snake1[:,9,0])): 
-    #if the vent marker is to be dropped - spacings don't need to add, just last value dropped.
-        dropped.append(9)
-
-    for ele in sorted(dropped,reverse = True):
-        del mark_s[ele]
-    
-    #now delete the columns corresponding to the dropped data
-    m_snake = np.delete(snake1, dropped, axis=1)
-        
-    
+    m_snake, dropped, mark_s = drop_markers(snake1, mark_spaces)
+    count('markers_dropped', len(dropped))
+
     return m_snake, dropped, mark_s
-    
-    
\ No newline at end of file
+
+
+@instrumented()
+def reshape_and_interp_batch(csvs, mark_spaces, n, frates, dtype=None, partial=False):
+    """reshape_and_interp for many trials at once: the trials are stacked into one array and filled in one pass.
+
+    input parameters
+    csvs = list of n-time*30 arrays of position data (one per trial)
+    mark_spaces = list of the trials' marker spacing lists
+    n = how big a gap to fill with interpolation (in seconds)
+    frates = list of frame rates (or one for all trials)
+    dtype = dtype of the output, e.g. np.float32 (defaults to float64)
+    partial = fill the first n*frate frames of longer gaps too, see fill_gaps
+
+    output: lists (one entry per trial) of reshaped snakes, dropped markers and new marker spacings.
+    The snakes are views into the stacked array, unless markers were dropped."""
+
+    sizes = [len(c) for c in csvs]
+    starts = np.r_[0, np.cumsum(sizes)[:-1]].astype(int)
+    stacked = np.concatenate([np.asarray(c) for c in csvs]).astype(np.float64 if dtype is None else dtype, copy=False)
+
+    limits = (n*np.broadcast_to(np.asarray(frates), (len(csvs),))).astype(int)
+    filled = fill_gaps(stacked, limits, starts, partial=partial)
+    count('samples_interpolated', int(filled.sum())//3)
+
+    snakes, drops, spacings = [], [], []
+    for start, size, marks in zip(starts, sizes, mark_spaces):
+        snake1 = stacked[start:start+size].reshape(size, -1, 3)
+        m_snake, dropped, mark_s = drop_markers(snake1, marks)
+        snakes.append(m_snake)
+        drops.append(dropped)
+        spacings.append(mark_s)
+    count('markers_dropped', sum(len(d) for d in drops))
+
+    return snakes, drops, spacings
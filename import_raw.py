@@ -1,14 +1,114 @@
 import numpy as np
 import pandas as pd
 import os
+import json
+import hashlib
+
+from trial_registry import get_registry, parse_trial_filename
+from instrument import instrumented, count
+
+#binary copies of the parsed csvs are kept here (relative to the working directory), see read_mocap_csv
+CACHE_DIR = 'MOCAP cache'
+CACHE_VERSION = 1
+
+
+def _file_hash(path):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _parse_mocap_csv(path):
+    """parse the Vicon header block and all numeric columns in one pass over the file"""
+    with open(path, 'r') as f:
+        f.readline() #'Trajectories'
+        frate = int(f.readline().split(',')[0]) #sampling rate, 100 or 150
+        names = f.readline().rstrip().split(',')
+        ncols = len(f.readline().rstrip().split(',')) #Frame, Sub Frame, X, Y, Z, X, ...
+        f.readline() #units
+
+        data = pd.read_csv(f, header=None, names=range(ncols), usecols=range(ncols),
+                           dtype=np.float64).values
+
+    #one marker name for each X, Y, Z triplet of columns
+    markers = [names[i] if i < len(names) else '' for i in range(2, ncols, 3)]
+    header = {'frate': frate, 'markers': markers, 'shape': list(data.shape)}
+
+    return header, np.ascontiguousarray(data)
+
+
+def read_mocap_csv(path, cache_dir=CACHE_DIR):
+    """ read a raw Vicon trajectories .csv in a single pass.
+    
+        input parameters
+        path = .csv file exported from the motion capture system
+        cache_dir = folder for binary copies of the parsed files (relative to the working directory unless absolute).
+        The data is saved as a .npy file next to a small .json header, and memory mapped on later reads. The copy is
+        used as long as the .csv has the same size and modification time (or, failing that, the same sha1 hash).
+        None to always parse the .csv.
+        
+        Outputs:
+        header: dictionary with the frame rate ('frate'), marker names ('markers', one per X,Y,Z triplet) 
+        and the 'shape' of the data
+        data: nrows x ncolumns array with the frame number, sub frame, and then X,Y,Z of every marker (nan where missing)"""
+    
+    if cache_dir is None:
+        return _parse_mocap_csv(path)
+    
+    if not os.path.isabs(cache_dir):
+        cache_dir = os.path.join(os.getcwd(), cache_dir)
+    base = os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0])
+    npy_path, json_path = base + '.npy', base + '.json'
+    
+    stat = os.stat(path)
+    try:
+        with open(json_path, 'r') as f:
+            header = json.load(f)
+        valid = header['version'] == CACHE_VERSION and header['size'] == stat.st_size
+        if valid and header['mtime_ns'] != stat.st_mtime_ns:
+            #touched (e.g. checked out again) but possibly unchanged
+            valid = header['sha1'] == _file_hash(path)
+            if valid:
+                header['mtime_ns'] = stat.st_mtime_ns
+                with open(json_path, 'w') as f:
+                    json.dump(header, f)
+        if valid:
+            data = np.load(npy_path, mmap_mode='r')
+            return header, data
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    
+    header, data = _parse_mocap_csv(path)
+    header.update({'version': CACHE_VERSION, 'source': os.path.basename(path), 'size': stat.st_size,
+                   'mtime_ns': stat.st_mtime_ns, 'sha1': _file_hash(path)})
+    
+    #write to temporary files first so an interrupted run never leaves a half written copy behind
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    np.save(npy_path + '.tmp.npy', data)
+    os.replace(npy_path + '.tmp.npy', npy_path)
+    with open(json_path + '.tmp', 'w') as f:
+        json.dump(header, f)
+    os.replace(json_path + '.tmp', json_path)
+    
+    return header, data
+
 
 #OFFSETS FOR BRANCH MARKERS HAVE BEEN CHECKED IN IMAGEJ - DON'T CHANGE.
+#(mm, from the origin and target markers to the actual branch ends)
+ORIGIN_OFFSET = np.array([-4, 0, 6])
+TARGET_OFFSET = np.array([5, 0, 4])
 
-def get_raw_data(path):
+@instrumented()
+def get_raw_data(path, cache_dir=CACHE_DIR, registry=None):
     """ input parameters
         path = .csv file containing raw position data from motion capture, assuming 10 snake markers and up to 4 branch markers
         formatted as 'M1_X, M1_Y, M1_Z, M2_X..." as columns each row corresponding to a different frame.
         File name should be as follows: [trial#, 3 digits]_Snake[#, 2 digits]_gap[#, 2 digits]_[iteration#, 1 digit].csv
+        cache_dir = where to keep binary copies of the parsed .csv files, see read_mocap_csv. None to disable.
+        registry = TrialRegistry to take the trial metadata from. Defaults to the shared one from get_registry().
         
         Outputs: a dictionary of the following values
         frate: frame rate
@@ -25,36 +125,28 @@ def get_raw_data(path):
         drop point"""
     
     #GET TRIAL METADATA
-    #get the frame rate from the csv
-    with open(path,'r') as f:
-        for i in range(2):
-            out = f.readline()
+    #read the csv once: frame rate from the header, and all the columns
+    header, data = read_mocap_csv(path, cache_dir=cache_dir)
     
     #frame rate and trial number     
-    frate = np.int(out[0:3]) #sampling rate, 100 or 150
-    trial = np.int(path[-23:-20]) #trial number
-    
-    #rest of metadata
-    cwd = os.getcwd()
-    meta_path = cwd + '/Summary Datasets/reference_material.csv'
-    metadata = pd.read_csv(meta_path, delimiter=",")
+    frate = header['frate'] #sampling rate, 100 or 150
+    trial = parse_trial_filename(path)['trial'] #trial number
     
-    row = metadata[metadata.Trial==trial]
+    #rest of metadata, from the registry (reference_material.csv is only read once per session)
+    if registry is None:
+        registry = get_registry()
+    meta = registry.metadata(trial)
     
-    snk_ID = row.ID.values[0]
-    svl = row.SVL.values[0]
-    mass = row.Mass.values[0]
-    mark_s = row.Spacings.values[0]
-    land_frame = row.LF.values[0]
-    drop = row.DP.values[0]
-    
-    #change mark_s to a proper list of integers (from a string)
-    mark_s = [np.float(x) for x in mark_s.split(',')]
+    snk_ID = meta['ID']
+    svl = meta['svl']
+    mass = meta['mass']
+    mark_s = meta['ms'] #list of marker spacings
+    land_frame = meta['lf']
+    drop = meta['dp']
 
     #GET COLUMNS CORRESPONDING TO BRANCH
-    branch_csv = pd.read_csv(path, delimiter=",", skiprows = 4, usecols = [32,33,34,35,36,37,38,39,40,41,42,43])
-    (D,E) = branch_csv.shape
-    branch = np.reshape(branch_csv.values,(D,4,3))
+    (D,E) = data.shape
+    branch = np.reshape(data[:,32:44],(D,4,3))
 
     origin = np.nanmean(branch[:,0,:],0)
     target = np.nanmean(branch[:,1,:],0)
@@ -63,38 +155,36 @@ def get_raw_data(path):
         target_other = np.array([np.nan,np.nan,np.nan])
     else:
         target_other = np.nanmean(branch[:,3,:],0)
-    origin_end = np.array([origin[0]-4, origin[1], origin[2]+6]) #adjust for marker offset from actual branch
-    target_end = np.array([target[0]+5, target[1], target[2]+4]) 
+    origin_end = origin + ORIGIN_OFFSET #adjust for marker offset from actual branch
+    target_end = target + TARGET_OFFSET
     target_other = np.array([target_other[0],target_other[1], target_other[2]-5])
 
     
     #GET COLUMNS CORRESPONDING TO SNAKE
-    col_list = [0]    
-    for i in range(2,32):
-        col_list.append(i)
-
-    csv = pd.read_csv(path, delimiter=",", skiprows = 4, usecols = col_list, index_col = 0)
-    #drops rows or columns when every value in that row or column is Nan, but doesn't drop missing markers 
-    #(because heading is not empty). Basically just cleaning the fairly messy .csv files. 
-    csv = csv.dropna(how = 'all') 
-    f_index = csv.index.values
+    #drops rows when every snake value in that row is Nan, but doesn't drop missing markers 
+    #Basically just cleaning the fairly messy .csv files. 
+    snake = data[:,2:32]
+    keep = ~np.isnan(snake).all(axis=1)
+    snake = snake[keep]
+    f_index = data[keep,0].astype(int)
 
     #CHOP TO REGION OF INTEREST
     #convert to numpy array for easy slicing, chop to ROI (when snake is in gap, before landing.)
-    head_x = np.array(csv.iloc[:,0])
-    snake = csv.values
+    head_x = np.array(snake[:,0])
     
     #find start and end indices
     igood = np.where(~np.isnan(head_x))[0]
     start = np.argmax(head_x[igood] > origin_end[0]) #this shows the first time head_x is greater than origin_end[0] of frames where head is defined.
     start_i = igood[start] #switch back to index for all frames, not just non-nan frames.
-    end_i = np.where(f_index == np.int(land_frame))[0][0]
+    end_i = np.where(f_index == int(land_frame))[0][0]
 
 
 
     #crop snake and frame index to appropriate frames.
     snake1 = np.copy(snake[start_i:end_i+1,:])
     f_index = f_index[start_i:end_i+1]
+    count('frames_read', D)
+    count('frames_kept', len(f_index))
     
     
     import_results = {
@@ -0,0 +1,196 @@
+import os
+import glob
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+import import_raw
+import fill_and_shape
+import align_coords
+import trial_registry
+import Piecewise_Smoothing
+import kinematics_fn
+import m_gncspline
+from stage_cache import run_stage, file_digest
+import instrument
+
+#relative to the working directory, like the notebooks
+MOCAP_DIR = 'MOCAP files'
+
+#absolute gap sizes (m) entered manually based on lab notebook notes, for trials where a branch marker did not record correctly.
+GAP_SIZE_FIXES = {57: 0.310, 85: 0.608, 93: 0.667, 94: 0.710, 191: 0.490, 192: 0.530, 193: 0.530, 194: 0.530}
+
+#one entry per trial: position in the input list, the file, the processed trial (None on error) and the formatted traceback (None on success)
+TrialResult = namedtuple('TrialResult', ['index', 'path', 'value', 'error'])
+
+
+def _import_stage(path, summary_dir, cache_dir):
+    imported = import_raw.get_raw_data(path, cache_dir=cache_dir, registry=trial_registry.get_registry(summary_dir))
+
+    #use motion capture locations of target and origin ends to calculate gap size
+    te = imported['te']/1000.0 #positions recorded in mm, change to m
+    oe = imported['oe']/1000.0
+    svl = imported['svl']/100.0 #svl is recorded in cm, change to m
+    gap = np.linalg.norm(te-oe)
+    if imported['tn'] in GAP_SIZE_FIXES:
+        gap = GAP_SIZE_FIXES[imported['tn']]
+        imported['Notes'] = "Absolute gap size entered manually based on lab notebook notes"
+    imported['gs_m'] = gap
+    imported['gs_%'] = gap/svl*100
+
+    return imported
+
+
+def _shape_stage(imported, n):
+    #reshape and adjust for missing markers
+    return fill_and_shape.reshape_and_interp(imported['raw'], imported['ms'], n, imported['fr'])
+
+
+def _align_stage(shaped, imported):
+    #rotate coordinate system to align with vector pointing from origin to target
+    aligned, theta, _ = align_coords.align(shaped, imported['oe'], imported['te'])
+    return aligned, theta
+
+
+def _smooth_stage(aligned, frate, p):
+    smoothed, sections = Piecewise_Smoothing.smooth_trial(aligned, p)
+    return kinematics_fn.trial_kinematics(sections, aligned.shape, frate)
+
+
+def _spline_stage(pos, spacings, nspl):
+    #positions in mm and spacings in cm (including the nosetip to first marker distance), both to m
+    return m_gncspline.spline_frames(pos/1000.0, np.array(spacings[1:])/100.0, nspl)
+
+
+def process_trial(path, n=0.2, cache_dir=import_raw.CACHE_DIR, summary_dir=None, p=None, nspl=None, cache=None):
+    """import, reshape and align a single trial (steps 1-3 of Notebook 1), and optionally smooth it (step 4)
+    and fit a spline to every frame.
+
+    input parameters
+    path = raw .csv file from the motion capture system
+    n = how big a gap to fill with interpolation (in seconds), see reshape_and_interp
+    cache_dir = where get_raw_data keeps binary copies of the .csv files (None to disable)
+    summary_dir = folder with reference_material.csv, see trial_registry.get_registry
+    p = smoothing factor for smooth_trial (10000.0 in Notebook 1); None to stop after aligning
+    nspl = number of spline points per frame, see m_gncspline.spline_frames; None to skip (needs p)
+    cache = optional stage_cache.StageCache. Each stage (import, reshape, align, smooth, spline) is then
+            loaded from the cache unless the .csv, reference_material.csv, the stage's parameters, its code or
+            an upstream stage changed.
+
+    output: dictionary with
+    imported = the get_raw_data dictionary, with the gap size ('gs_m', 'gs_%'), corrected marker spacings ('cms')
+               and target end relative to the origin end ('nte') added like in Notebook 1
+    shaped = reshaped, interpolated position data
+    dropped = markers dropped because they were never recorded
+    aligned = position data in the branch coordinate system
+    theta = rotation between the calibrated and branch coordinate systems
+    kinematics = (pos, vel, acc, times) from trial_kinematics, if p was given
+    splines = (r, dr, ddr, ts, ss) from spline_frames (in m), if nspl was given
+    cached = dictionary of stage name: True if its output came from the cache"""
+
+    with instrument.trial(trial_registry.parse_trial_filename(path)['trial']), instrument.stage('process_trial'):
+        out = _process_trial(path, n, cache_dir, summary_dir, p, nspl, cache)
+        instrument.count('stages_cached', sum(out['cached'].values()))
+    return out
+
+
+def _process_trial(path, n, cache_dir, summary_dir, p, nspl, cache):
+    registry = trial_registry.get_registry(summary_dir)
+    ref_file = os.path.join(registry.folder, 'reference_material.csv')
+
+    imported = run_stage(cache, 'import', _import_stage, [file_digest(path), file_digest(ref_file), GAP_SIZE_FIXES],
+                         args=(path, summary_dir, cache_dir), code=(_import_stage, import_raw, trial_registry))
+    shaped = run_stage(cache, 'reshape', _shape_stage, [imported], {'n': n}, code=(_shape_stage, fill_and_shape))
+    aligned = run_stage(cache, 'align', _align_stage, [shaped, imported], args=(shaped.value[0], imported.value),
+                        code=(_align_stage, align_coords))
+    stages = {'import': imported, 'reshape': shaped, 'align': aligned}
+
+    out = {'imported': imported.value, 'shaped': shaped.value[0], 'dropped': shaped.value[1],
+           'aligned': aligned.value[0], 'theta': aligned.value[1]}
+    out['imported']['cms'] = shaped.value[2]
+    out['imported']['nte'] = out['imported']['te']-out['imported']['oe']
+
+    if p is not None:
+        kins = run_stage(cache, 'smooth', _smooth_stage, [aligned, imported], {'p': p},
+                         args=(out['aligned'], out['imported']['fr']),
+                         code=(_smooth_stage, Piecewise_Smoothing, kinematics_fn))
+        stages['smooth'] = kins
+        out['kinematics'] = kins.value
+
+        if nspl is not None:
+            splines = run_stage(cache, 'spline', _spline_stage, [kins, shaped], {'nspl': nspl},
+                                args=(kins.value[0], shaped.value[2]), code=(_spline_stage, m_gncspline))
+            stages['spline'] = splines
+            out['splines'] = splines.value
+
+    out['cached'] = dict((name, result.hit) for name, result in stages.items())
+
+    return out
+
+
+def _run(index, path, kwargs):
+    #errors are returned rather than raised, so one bad trial doesn't abort the batch
+    try:
+        return TrialResult(index, path, process_trial(path, **kwargs), None)
+    except Exception:
+        return TrialResult(index, path, None, traceback.format_exc())
+
+
+def _run_worker(index, path, kwargs):
+    #in a pool worker: the records made for the trial go back with its result (see instrument.init_worker)
+    return _run(index, path, kwargs), instrument.worker_records()
+
+
+def iter_ingest(paths, workers=None, **kwargs):
+    """process trials in a pool of worker processes, yielding each TrialResult as soon as it is done.
+
+    input parameters
+    paths = list of raw .csv files
+    workers = number of processes (defaults to the number of cpus). 1 runs everything in this process.
+    kwargs = passed on to process_trial
+
+    Results come back in order of completion; use their index to put them back in input order.
+    If instrument recording is on, the workers' records are added to the active Recorder."""
+
+    paths = list(paths)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        for i, path in enumerate(paths):
+            yield _run(i, path, kwargs)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, max(len(paths), 1)), initializer=instrument.init_worker,
+                             initargs=(instrument.worker_settings(),)) as pool:
+        futures = [pool.submit(_run_worker, i, path, kwargs) for i, path in enumerate(paths)]
+        for future in as_completed(futures):
+            result, records = future.result()
+            instrument.merge(records)
+            yield result
+
+
+def ingest_directory(path=MOCAP_DIR, workers=None, pattern='*.csv', progress=None, **kwargs):
+    """import, reshape and align every trial in a folder of MOCAP files, in parallel.
+
+    input parameters
+    path = folder with the raw .csv files
+    workers = number of processes, see iter_ingest
+    pattern = which files in the folder to process
+    progress = optional function called with each TrialResult as it completes (e.g. print)
+    kwargs = passed on to process_trial (n, cache_dir, summary_dir, p, nspl, cache)
+
+    output: list of TrialResults, one per file in sorted file name order (whatever order they finished in).
+    Trials that failed have value None and the traceback in error."""
+
+    files = sorted(glob.glob(os.path.join(path, pattern)))
+
+    results = [None]*len(files)
+    for result in iter_ingest(files, workers=workers, **kwargs):
+        if progress is not None:
+            progress(result)
+        results[result.index] = result
+
+    return results
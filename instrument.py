@@ -0,0 +1,309 @@
+"""Per-stage timing, memory and data-quality counters for the processing pipeline.
+
+Off by default; while off, the stage hooks and count() return straight away. Typical use:
+
+    import instrument
+    rec = instrument.enable('run.jsonl', memory=True, profile=['smooth_trial'])
+    results = ingest_directory(p=10000.0)
+    instrument.disable()
+    print(rec.summary())
+
+Each finished stage call is one record (one JSON line): stage, trial, wall and cpu time (s), peak traced memory
+(bytes, with memory=True) and the counts added while it ran (frames read, markers dropped, spline fits...).
+
+Process pools (ingest.iter_ingest, summary.summarize) record in their workers too: each worker is started with
+init_worker(worker_settings()), sends its records back with every task's result (worker_records), and the
+parent adds them to its Recorder with merge.
+"""
+import os
+import time
+import json
+import uuid
+import pstats
+import cProfile
+import tracemalloc
+import functools
+from contextlib import contextmanager
+
+_recorder = None
+
+
+class Recorder(object):
+    """Collects stage records for one run.
+
+    Parameters
+    ----------
+    path : str
+        JSON lines file the records are appended to as they finish (None to keep them in memory only)
+    memory : bool
+        trace allocations with tracemalloc to get the peak memory of each stage (slows the pipeline down)
+    profile : list of str
+        stages to run under cProfile; the stats of all calls of a stage are saved to profile_dir/<stage>.prof
+    profile_dir : str
+        where to save the cProfile stats
+    """
+
+    def __init__(self, path=None, memory=False, profile=(), profile_dir='profiles'):
+        self.run = uuid.uuid4().hex[:12]
+        self.path = path
+        self.memory = memory
+        self.profile = set(profile)
+        self.profile_dir = profile_dir
+        self.records = []
+        self._stack = []
+        self._trial = None
+        self._profiles = {}
+        self._profiling = False
+        self._started_tracing = False
+        #added to the .prof file names, so pool workers don't overwrite each other's stats
+        self.profile_suffix = ''
+
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    def _enter(self, name, trial):
+        frame = {'stage': name, 'trial': trial if trial is not None else self._trial, 'counts': {},
+                 'child_peak': 0, 'profiler': None}
+        if self.memory:
+            frame['mem_start'] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        if name in self.profile and not self._profiling:
+            frame['profiler'] = cProfile.Profile()
+            self._profiling = True
+        self._stack.append(frame)
+        frame['cpu'] = time.process_time()
+        frame['wall'] = time.perf_counter()
+        if frame['profiler'] is not None:
+            frame['profiler'].enable()
+        return frame
+
+    def _exit(self, frame, error):
+        if frame['profiler'] is not None:
+            frame['profiler'].disable()
+        wall = time.perf_counter()-frame['wall']
+        cpu = time.process_time()-frame['cpu']
+        self._stack.pop()
+
+        record = {'run': self.run, 'stage': frame['stage'], 'trial': frame['trial'], 'wall': wall, 'cpu': cpu,
+                  'counts': frame['counts'], 'pid': os.getpid()}
+        if self.memory:
+            #the peak since the last nested stage finished, or the peak of the nested stages
+            peak = max(tracemalloc.get_traced_memory()[1], frame['child_peak'])
+            record['peak_mem'] = peak-frame['mem_start']
+            if self._stack:
+                self._stack[-1]['child_peak'] = max(self._stack[-1]['child_peak'], peak)
+        if error is not None:
+            record['error'] = error
+
+        if frame['profiler'] is not None:
+            self._profiling = False
+            self._save_profile(frame['stage'], frame['profiler'])
+
+        self.records.append(record)
+        self._write([record])
+
+    def _write(self, records):
+        if self.path is not None and records:
+            with open(self.path, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record, default=_jsonable)+'\n')
+
+    def merge(self, records):
+        """add records made elsewhere (e.g. by pool workers, see worker_records) to this run"""
+        records = list(records)
+        self.records.extend(records)
+        self._write(records)
+
+    def _save_profile(self, name, profiler):
+        if name in self._profiles:
+            self._profiles[name].add(profiler)
+        else:
+            self._profiles[name] = pstats.Stats(profiler)
+        if not os.path.isdir(self.profile_dir):
+            os.makedirs(self.profile_dir)
+        self._profiles[name].dump_stats(os.path.join(self.profile_dir, name+self.profile_suffix+'.prof'))
+
+    def count(self, key, n=1):
+        if self._stack:
+            counts = self._stack[-1]['counts']
+            counts[key] = counts.get(key, 0)+n
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def summary(self, records=None):
+        """table of calls, total and mean wall time, cpu time, max peak memory and summed counts per stage"""
+        return summary_table(self.records if records is None else records)
+
+
+def _jsonable(value):
+    #numpy scalars (e.g. trial numbers) in records
+    if hasattr(value, 'item'):
+        return value.item()
+    return str(value)
+
+
+def enable(path=None, memory=False, profile=(), profile_dir='profiles'):
+    """start recording (see Recorder for the parameters); returns the Recorder"""
+    global _recorder
+    disable()
+    _recorder = Recorder(path, memory=memory, profile=profile, profile_dir=profile_dir)
+    return _recorder
+
+
+def disable():
+    """stop recording; returns the Recorder that was active (or None)"""
+    global _recorder
+    rec = _recorder
+    _recorder = None
+    if rec is not None:
+        rec.close()
+    return rec
+
+
+def enabled():
+    return _recorder is not None
+
+
+def worker_settings():
+    """the settings pool workers need to record like this process (None if recording is off), for init_worker"""
+    if _recorder is None:
+        return None
+    return {'run': _recorder.run, 'memory': _recorder.memory, 'profile': sorted(_recorder.profile),
+            'profile_dir': _recorder.profile_dir}
+
+
+def init_worker(settings):
+    """process pool initializer: record in the worker with the settings of worker_settings (or not at all if
+    None). The worker keeps its records in memory until worker_records; a recorder inherited from the parent
+    (fork) is dropped, as its records would never reach the parent. Profiles are saved as <stage>.<pid>.prof"""
+    global _recorder
+    _recorder = None
+    if settings is not None:
+        _recorder = Recorder(None, memory=settings['memory'], profile=settings['profile'],
+                             profile_dir=settings['profile_dir'])
+        _recorder.run = settings['run']
+        _recorder.profile_suffix = '.%d' % os.getpid()
+
+
+def worker_records():
+    """the records made in this process since the last call (empty if recording is off), to send back to the
+    parent with a task's result"""
+    if _recorder is None:
+        return []
+    records = _recorder.records
+    _recorder.records = []
+    return records
+
+
+def merge(records):
+    """add records sent back by pool workers to the active Recorder (nothing if recording is off)"""
+    if _recorder is not None:
+        _recorder.merge(records)
+
+
+def count(key, n=1):
+    """add n to a counter of the stage that is running (nothing if recording is off)"""
+    if _recorder is not None:
+        _recorder.count(key, n)
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL = _NullStage()
+
+
+class _Stage(object):
+    def __init__(self, recorder, name, trial):
+        self.recorder = recorder
+        self.name = name
+        self.trial = trial
+
+    def __enter__(self):
+        self.frame = self.recorder._enter(self.name, self.trial)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        error = None if exc_type is None else '%s: %s' % (exc_type.__name__, exc)
+        self.recorder._exit(self.frame, error)
+        return False
+
+
+def stage(name, trial=None):
+    """context manager recording a stage; trial defaults to the one set with trial()"""
+    if _recorder is None:
+        return _NULL
+    return _Stage(_recorder, name, trial)
+
+
+def instrumented(name=None):
+    """decorator recording every call of a function as a stage (named after the function by default)"""
+    def decorate(fn):
+        stage_name = fn.__name__ if name is None else name
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return fn(*args, **kwargs)
+            with _Stage(_recorder, stage_name, None):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def trial(tn):
+    """tag the stages run inside with a trial number"""
+    if _recorder is None:
+        yield
+        return
+    rec = _recorder
+    previous = rec._trial
+    rec._trial = tn
+    try:
+        yield
+    finally:
+        rec._trial = previous
+
+
+def read_records(path):
+    """records from a JSON lines file"""
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summary_table(records):
+    """per stage: calls, total and mean wall time, cpu time, max peak memory and summed counts, as text"""
+    stages = {}
+    for r in records:
+        s = stages.setdefault(r['stage'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak': None, 'errors': 0,
+                                           'counts': {}})
+        s['calls'] += 1
+        s['wall'] += r['wall']
+        s['cpu'] += r['cpu']
+        if 'peak_mem' in r:
+            s['peak'] = max(s['peak'] or 0, r['peak_mem'])
+        if 'error' in r:
+            s['errors'] += 1
+        for k, v in r['counts'].items():
+            s['counts'][k] = s['counts'].get(k, 0)+v
+
+    lines = ['%-28s %7s %10s %10s %10s %10s  %s' % ('stage', 'calls', 'wall (s)', 'mean (s)', 'cpu (s)',
+                                                    'peak (MB)', 'counts')]
+    for name, s in sorted(stages.items(), key=lambda kv: -kv[1]['wall']):
+        peak = '' if s['peak'] is None else '%.1f' % (s['peak']/1e6)
+        counts = ', '.join('%s=%d' % kv for kv in sorted(s['counts'].items()))
+        if s['errors']:
+            counts = ('errors=%d, ' % s['errors'])+counts
+        lines.append('%-28s %7d %10.3f %10.4f %10.3f %10s  %s' % (name, s['calls'], s['wall'], s['wall']/s['calls'],
+                                                                 s['cpu'], peak, counts))
+    return '\n'.join(lines)
@@ -1,31 +1,35 @@
 import numpy as np
 
+from instrument import instrumented
+
+#landing velocity: linear fit to the last 0.07 s of a trial (from the window sensitivity sweep in Notebook 4)
+LANDING_WINDOW = 0.07
+
+#least squares window weights by (window length, frame rate, order, where in the window), see window_weights
+_WINDOW_WEIGHTS = {}
+
 
 def kins_fn(conts, smoothie, frate):
     """input parameters: (conts and smoothie are results of running "return_smoothed" function on raw position data)
     conts = list of indices at which to evaluate the kinematics [i.e. continuous values, no nans]
     smoothie = spline function of the position data smoothed, such that smoothie(conts(t)) = smoothed position value at t
     frate = frame rate, e.g. 150
-    
-    output: an array of data, ntimex4 with data[:,0] = times, data[:,1] = positions, data[:,2] = velocities, data[:,3] = 
+
+    output: an array of data, ntimex4 with data[:,0] = times, data[:,1] = positions, data[:,2] = velocities, data[:,3] =
     accelerations. (note: velocity and acceleration columns have nans as first and last values)."""
 
     data_arrays = []
     for t in np.arange(len(conts)):
-        ts = [n for n in conts[t]]
+        ts = np.asarray(conts[t])
         data = np.zeros((len(ts),4))
 
-        res = np.asarray([smoothie[t](n) for n in ts])
+        res = smoothie[t](ts) #evaluate the spline at all the indices at once
         data[:,1] = res
 
-        ts = np.asarray([n*1.0/frate for n in conts[t]])
-        data[:,0] = np.asarray(ts)
+        data[:,0] = ts*1.0/frate
 
-        for i in range(1,len(ts)-1):
-            v = (res[i+1]-res[i-1])/(2*1.0/frate)
-            a = (res[i+1]-2*res[i]+res[i-1])/(1.0/frate)**2
-            data[i,2] = v
-            data[i,3] = a
+        data[1:-1,2] = (res[2:]-res[:-2])/(2*1.0/frate)
+        data[1:-1,3] = (res[2:]-2*res[1:-1]+res[:-2])/(1.0/frate)**2
 
         data[0,2:3] = np.nan
         data[-1,2:3] = np.nan
@@ -36,5 +40,230 @@ def kins_fn(conts, smoothie, frate):
         smoothed_ks = np.vstack(data_arrays)
     else:
         smoothed_ks = data_arrays[0]
-        
-    return smoothed_ks
\ No newline at end of file
+
+    return smoothed_ks
+
+
+@instrumented()
+def trial_kinematics(sections, shape, frate, analytic=False):
+    """position, velocity and acceleration of every marker of a trial, from the splines of smooth_trial.
+
+    input parameters
+    sections = list of Sections from Piecewise_Smoothing.smooth_trial
+    shape = shape of the trial's position data, (nframes, nmarkers, 3)
+    frate = frame rate, e.g. 150
+    analytic = False: central differences of the smoothed positions, as in kins_fn (nan in the first and last
+               frame of each section). True: derivatives of the smoothing splines themselves.
+
+    output: pos, vel, acc, times = nframes x nmarkers x 3 arrays (mm, mm/s, mm/s^2, s), written directly by frame
+    index, with nan wherever the channel has no smoothed data."""
+
+    #imported here so the rest of the module (landing_fit, sliding_velocity...) only needs numpy, not gcvspline
+    from Piecewise_Smoothing import evaluate_section
+
+    nframes = shape[0]
+    pos = np.full((nframes, int(np.prod(shape[1:]))), np.nan)
+    vel = np.full_like(pos, np.nan)
+    acc = np.full_like(pos, np.nan)
+
+    for section in sections:
+        frames = np.arange(section.start, section.stop)
+        pos[section.start:section.stop, section.channels] = evaluate_section(section, frames)
+        if analytic:
+            #splines are in frame units; convert to per second
+            vel[section.start:section.stop, section.channels] = evaluate_section(section, frames, nu=1)*frate
+            acc[section.start:section.stop, section.channels] = evaluate_section(section, frames, nu=2)*frate**2
+
+    if not analytic:
+        #sections are separated by nan frames, so differences across section ends come out nan
+        vel[1:-1] = (pos[2:]-pos[:-2])/(2*1.0/frate)
+        acc[1:-1] = (pos[2:]-2*pos[1:-1]+pos[:-2])/(1.0/frate)**2
+
+    times = np.where(np.isnan(pos), np.nan, (np.arange(nframes)*1.0/frate)[:, np.newaxis])
+
+    return pos.reshape(shape), vel.reshape(shape), acc.reshape(shape), times.reshape(shape)
+
+
+def polyfit_weights(x, order, x0=0.0, nderiv=2):
+    """weights of a least squares polynomial fit (a Savitzky-Golay filter when x is a regular window).
+
+    input parameters
+    x = sample positions, e.g. frame offsets from the frame of interest
+    order = polynomial order (needs at least order+1 samples)
+    x0 = where to evaluate the fit
+    nderiv = highest derivative wanted
+
+    output: (nderiv+1) x len(x) array W, such that W.dot(y) = the fit of y and its derivatives (per unit of x) at x0"""
+
+    x = np.asarray(x, dtype=np.float64) - x0
+    V = np.vander(x, order+1, increasing=True)
+    coeffs = np.linalg.pinv(V) #row j gives the x**j coefficient
+
+    W = np.zeros((nderiv+1, len(x)))
+    factorial = 1.0
+    for j in range(min(nderiv, order)+1):
+        if j > 0:
+            factorial *= j
+        W[j] = factorial*coeffs[j]
+
+    return W
+
+
+def window_weights(n, frate, order=1, at='end'):
+    """weights of a least squares polynomial fit over a window of n frames, computed once per frame rate.
+
+    input parameters
+    n = window length (frames), at least order+1
+    frate = frame rate, e.g. 100 or 150
+    order = polynomial order (1 = a line, as np.polyfit(t, y, 1))
+    at = where the velocity is evaluated: 'end' (the last frame of the window), 'center' or 'start'
+
+    output: w = n velocity weights, w.dot(y) = fitted velocity (per second) of samples y;
+    Q = n x (order+1) orthonormal basis of the polynomials on the window (for the residuals)"""
+
+    key = (int(n), float(frate), int(order), at)
+    if key not in _WINDOW_WEIGHTS:
+        x = np.arange(n, dtype=np.float64)
+        x0 = {'end': n-1.0, 'center': (n-1)/2.0, 'start': 0.0}[at]
+        w = polyfit_weights(x, order, x0=x0, nderiv=1)[1]*frate
+        Q = np.linalg.qr(np.vander(x-x0, order+1, increasing=True))[0]
+        w.flags.writeable = False
+        Q.flags.writeable = False
+        _WINDOW_WEIGHTS[key] = (w, Q)
+    return _WINDOW_WEIGHTS[key]
+
+
+def _window_sums(y, w):
+    #sum over j of w[j]*y[k+j], for every window start k (one pass over y per weight)
+    m = len(y)-len(w)+1
+    out = w[0]*y[:m]
+    for j in range(1, len(w)):
+        out += w[j]*y[j:j+m]
+    return out
+
+
+def _fit(y, frate, n, order, at):
+    #velocity and sum of squared residuals of the fits over every window of n frames of y (nframes x ...)
+    w, Q = window_weights(n, frate, order, at)
+    vel = _window_sums(y, w)
+    rss = _window_sums(y**2, np.ones(n))
+    for k in range(Q.shape[1]):
+        rss -= _window_sums(y, Q[:, k])**2
+    return vel, np.maximum(rss, 0)
+
+
+@instrumented()
+def sliding_velocity(pos, frate, windows, order=1, at='end'):
+    """least squares (Savitzky-Golay style) velocity and fit residuals over sliding windows of several lengths,
+    for every marker and dimension at once.
+
+    input parameters
+    pos = nframes x ... array of positions (e.g. nframes x nmarkers x 3), nan where missing
+    frate = frame rate
+    windows = window lengths (frames), e.g. range(9, 19)
+    order = polynomial order of the fit
+    at = where in the window the velocity is evaluated, see window_weights
+
+    output: vel, res = len(windows) x nframes x ... arrays; vel[k, f] is the velocity (per second) of the fit
+    over the windows[k] frames ending at frame f, res[k, f] its sum of squared residuals (np.polyfit's residuals).
+    nan where the window starts before the first frame or has missing data."""
+
+    pos = np.asarray(pos, dtype=np.float64)
+    #residuals don't depend on an offset; removing the mean keeps the sums of squares small
+    valid = ~np.isnan(pos)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(valid, pos, 0).sum(axis=0)/valid.sum(axis=0)
+    y = pos-np.nan_to_num(mean)
+
+    vel = np.full((len(windows),)+pos.shape, np.nan)
+    res = np.full_like(vel, np.nan)
+    for k, n in enumerate(windows):
+        if n <= len(pos):
+            vel[k, n-1:], res[k, n-1:] = _fit(y, frate, n, order, at)
+    return vel, res
+
+
+def landing_fit(pos, frate, windows=None, seconds=LANDING_WINDOW, order=1):
+    """velocity of a line fit to the last frames of a trial (the landing velocity of Notebook 4).
+
+    input parameters
+    pos = nframes x ... array of positions, e.g. sm_pos[i][:, 0, :] for the head
+    frate = frame rate
+    windows = window lengths (frames) to fit; by default the last int(frate*seconds) frames
+    seconds = length of the default window (s)
+    order = polynomial order of the fit
+
+    output: vel, res = velocity (per second) and sum of squared residuals of each fit, ... arrays
+    (len(windows) x ... with windows)"""
+
+    pos = np.asarray(pos, dtype=np.float64)
+    lengths = [int(frate*seconds)] if windows is None else list(windows)
+    fits = [n for n in lengths if n <= len(pos)]
+
+    vel = np.full((len(lengths),)+pos.shape[1:], np.nan)
+    res = np.full_like(vel, np.nan)
+    if fits:
+        #the weights of all the windows, aligned on the last frame, so every fit is one matrix product
+        last = max(fits)
+        W = np.zeros((len(fits), last))
+        P = []
+        for k, n in enumerate(fits):
+            w, Q = window_weights(n, frate, order, 'end')
+            W[k, last-n:] = w
+            Qk = np.zeros((last, Q.shape[1]))
+            Qk[last-n:] = Q
+            P.append(Qk.T)
+        P = np.concatenate(P)
+
+        y = pos[len(pos)-last:]
+        y = (y-y.mean(axis=0)).reshape(last, -1)
+        #sum of squares of the last n frames, for every n
+        tail = np.cumsum((y**2)[::-1], axis=0)[::-1]
+        proj = P.dot(y).reshape(len(fits), -1, y.shape[1])
+
+        rows = [k for k, n in enumerate(lengths) if n <= len(pos)]
+        vel[rows] = W.dot(y).reshape((len(fits),)+pos.shape[1:])
+        rss = tail[last-np.array(fits)]-(proj**2).sum(axis=1)
+        res[rows] = np.maximum(rss, 0).reshape((len(fits),)+pos.shape[1:])
+
+    if windows is None:
+        return vel[0], res[0]
+    return vel, res
+
+
+@instrumented()
+def landing_fits(ts, frates, windows=None, seconds=LANDING_WINDOW, order=1, name='pos'):
+    """landing_fit for every trial of a TrialSet at once.
+
+    input parameters
+    ts = TrialSet (see trial_set) with the positions as quantity `name`
+    frates = frame rate of each trial
+    windows, seconds, order = as in landing_fit
+
+    output: vel, res = ntrials x ... arrays (ntrials x len(windows) x ... with windows)"""
+
+    frates = np.broadcast_to(np.asarray(frates, dtype=np.float64), (len(ts),))
+    buf = ts[name]
+    nwin = 1 if windows is None else len(windows)
+    vel = np.full((len(ts), nwin)+buf.shape[1:], np.nan)
+    res = np.full_like(vel, np.nan)
+
+    for k in range(nwin):
+        lengths = (frates*seconds).astype(int) if windows is None else np.full(len(ts), int(windows[k]))
+        #trials with the same window and frame rate share the weights
+        for n, frate in set(zip(lengths.tolist(), frates.tolist())):
+            trials = np.flatnonzero((lengths == n) & (frates == frate) & (ts.lengths >= n))
+            if not len(trials):
+                continue
+            rows = ts.offsets[trials+1][:, np.newaxis]-n+np.arange(n)
+            y = buf[rows]
+            y = y-y.mean(axis=1, keepdims=True)
+            w, Q = window_weights(n, frate, order, 'end')
+            vel[trials, k] = np.tensordot(y, w, axes=([1], [0]))
+            proj = np.tensordot(y, Q, axes=([1], [0]))
+            res[trials, k] = np.maximum((y**2).sum(axis=1)-(proj**2).sum(axis=-1), 0)
+
+    if windows is None:
+        return vel[:, 0], res[:, 0]
+    return vel, res
+
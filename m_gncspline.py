@@ -1,43 +1,30 @@
 from __future__ import division
 
+import os
+from collections import OrderedDict
+
 import numpy as np
 
+from instrument import instrumented, count
 
-def global_natural_spline(p, t, nspl):
-    """Fit 3rd order global natural splines to the data.
+
+def _tangent_system(t):
+    """Construct the C and D matrices of the tangent system Dm = Cp.
 
     Parameters
     ----------
-    p : array, size (nmark, 3)
-        Measured data points
     t : array, size (nmark - 1)
-        arc length distance between markers. Note that these don't have to
-        be exact (and can be less than arc length between them),
-        and can be modified to change the tangent angle at
-        a given measurement point.
-    nspl : int
-        number of points to evaluate the spline at
+        arc length distance between markers
 
     Returns
     -------
-    r, dr, ddr, dddr : arrays, size (nspl, 3)
-        x, y, z and the associated derivatives of the spline
-    ts : array, size (nspl)
-        cumulatve coordinate spine was **evaluated** at
-    ss : array, size (nspl)
-        cumulative **arc length** coordinate
-    spl_ds : array, size (nspl)
-        lengths of individual spline segments (in physical units)
-    lengths_total : array, size (nmark - 1)
-        the integrated length of the spline between the points
-    idx_pts : array, size (nmark - 1)
-        indices into the ts and ss for the measured points
+    C, D : arrays, size (nmark, nmark)
+        the tangents m (nmark x 3) solve Dm = Cp. Both matrices only
+        depend on the marker spacings, not on the marker positions.
     """
 
-    # from scipy.integrate import cumtrapz
-
     # number of measured points
-    n = p.shape[0]
+    n = len(t) + 1
 
     # construct C and D matries: Dm = Cp, solve for m (n x 3) matrix
     C = np.zeros((n, n))
@@ -62,19 +49,95 @@ def global_natural_spline(p, t, nspl):
     D[n - 1, n - 2] = 1  # x_{n-1}(t_{n-1})
     D[n - 1, n - 1] = 2  # x_{n-1}(t_{n-1})
 
-    # solve for the tangent angles m
-    m = np.linalg.solve(D, np.dot(C, p))
+    return C, D
+
+
+def natural_spline_coefficients(p, t):
+    """Cubic coefficients of the global natural spline through the markers.
+
+    Parameters
+    ----------
+    p : array, size (nmark, 3) or (ntime, nmark, 3)
+        Measured data points, for a single frame or stacked frames
+    t : array, size (nmark - 1)
+        arc length distance between markers, shared by all frames
+
+    Returns
+    -------
+    a, b, c, d : arrays, size (nmark - 1, 3) or (ntime, nmark - 1, 3)
+        coefficients of each segment, r(ti) = a + b ti + c ti**2 + d ti**3
+    """
+
+    p = np.asarray(p, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    n = p.shape[-2]
+
+    C, D = _tangent_system(t)
+
+    # every frame shares C and D, so stack the frames as columns of a single
+    # right-hand side; D is then factored once and all tangents solved together
+    rhs = np.moveaxis(p, -2, 0).reshape(n, -1)
+    m = np.linalg.solve(D, np.dot(C, rhs))
+    m = np.moveaxis(m.reshape(np.moveaxis(p, -2, 0).shape), 0, -2)
 
     # cubic spline coefficients
-    a = p[:-1]
-    b = m[:-1]
-    c = (3 * (p[1:] - p[:-1]).T / t**2 - (2 * m[:-1] + m[1:]).T / t).T
-    d = (2 * (p[:-1] - p[1:]).T / t**3 + (m[:-1] + m[1:]).T / t**2).T
+    tt = t[:, np.newaxis]
+    a = p[..., :-1, :]
+    b = m[..., :-1, :]
+    c = 3 * (p[..., 1:, :] - p[..., :-1, :]) / tt**2 - \
+        (2 * m[..., :-1, :] + m[..., 1:, :]) / tt
+    d = 2 * (p[..., :-1, :] - p[..., 1:, :]) / tt**3 + \
+        (m[..., :-1, :] + m[..., 1:, :]) / tt**2
+
+    return a, b, c, d
+
+
+# sampling layouts are reused for every frame (and trial) with the same
+# marker spacings, so keep the most recently used ones around
+_LAYOUT_CACHE = OrderedDict()
+_LAYOUT_CACHE_SIZE = 64
+
+
+def _sampling_layout(t, nspl):
+    """Where along each segment the spline is evaluated.
+
+    The layout only depends on the spacings and nspl, so it is memoized
+    (keyed on both) with least-recently-used eviction. The cached arrays
+    are read-only.
+
+    Parameters
+    ----------
+    t : array, size (nmark - 1)
+        arc length distance between markers
+    nspl : int
+        number of points to evaluate the spline at
+
+    Returns
+    -------
+    Dictionary with:
+    seg : array, size (nspl)
+        segment each spline point belongs to
+    ti : array, size (nspl)
+        local coordinate of each spline point within its segment
+    ts : array, size (nspl)
+        cumulatve coordinate spine was **evaluated** at
+    dts : array, size (nspl)
+        segment parameter lengths
+    idx_pts : array, size (nmark - 1)
+        indices into the ts and ss for the measured points
+    int_seg : array, size (nmark)
+        indices to integrate the segment lengths between
+    """
+
+    key = (t.tobytes(), int(nspl))
+    if key in _LAYOUT_CACHE:
+        _LAYOUT_CACHE.move_to_end(key)
+        return _LAYOUT_CACHE[key]
 
     # number of spline points per segment, taking care so we have nspl total
     mm_per_spl_bit = t.sum() / nspl
     bits_per_seg_float = t / mm_per_spl_bit
-    bits_per_seg = np.round(bits_per_seg_float).astype(np.int)
+    bits_per_seg = np.round(bits_per_seg_float).astype(int)
 
     nbits = bits_per_seg.sum()
     if nbits > nspl:
@@ -83,66 +146,446 @@ def global_natural_spline(p, t, nspl):
         bits_per_seg[-1] += nspl - nbits
     nspl_seg = bits_per_seg.copy()
 
-    nspl_seg[:-1] += 1  # because of the inertior points we skip with
-                        # jj > 0 below
+    nspl_seg[:-1] += 1  # because of the inertior points we skip
+                        # for all but the first segment
 
     # indices in ts for the measured points
     # e.g. ts[idx_pts] == t.cumsum()
     idx_pts = (nspl_seg - 1).cumsum()
 
-    # empty arrays to store the spline values
-    r = np.zeros((nspl, 3))
-    dr = np.zeros((nspl, 3))
-    ddr = np.zeros((nspl, 3))
-    dddr = np.zeros((nspl, 3))
-    ts = np.zeros(nspl)
-
-    # iterate through the (n - 1) segments and fit the spline
-    cnt = 0
-    for jj in np.arange(n - 1):
-        ti = np.linspace(0, t[jj], nspl_seg[jj])
-        if jj > 0:
-            ti = ti[1:]
-
-        for k in np.arange(len(ti)):
-            ri = a[jj] + b[jj] * ti[k] + c[jj] * ti[k]**2 + d[jj] * ti[k]**3
-            dri = b[jj] + 2 * c[jj] * ti[k] + 3 * d[jj] * ti[k]**2
-            ddri = 2 * c[jj] + 6 * d[jj] * ti[k]
-            dddri = 6 * d[jj]
-            r[cnt] = ri
-            dr[cnt] = dri
-            ddr[cnt] = ddri
-            dddr[cnt] = dddri
-            ts[cnt] = t[:jj].sum() + ti[k]
-            cnt += 1
-
-    assert cnt == nspl
-
-    # segment parameter lengths
-    dts = np.gradient(ts, edge_order=2)
+    # each segment is sampled at np.linspace(0, t[jj], nspl_seg[jj]),
+    # dropping the first point (the end of the previous segment) if jj > 0
+    npts_seg = nspl_seg.copy()
+    npts_seg[1:] -= 1
+    assert npts_seg.sum() == nspl
+
+    seg = np.repeat(np.arange(len(t)), npts_seg)
+    first = np.r_[0, npts_seg.cumsum()[:-1]]
+    k = np.arange(nspl) - first[seg] + (seg > 0)
+    ti = k * (t / (nspl_seg - 1))[seg]
+    ti[k == nspl_seg[seg] - 1] = t[seg][k == nspl_seg[seg] - 1]
+    ts = np.r_[0, t.cumsum()][seg] + ti
+
+    layout = dict(seg=seg, ti=ti, ts=ts, dts=np.gradient(ts, edge_order=2),
+                  idx_pts=idx_pts, int_seg=np.r_[0, bits_per_seg.cumsum()])
+    for arr in layout.values():
+        arr.flags.writeable = False
+
+    _LAYOUT_CACHE[key] = layout
+    if len(_LAYOUT_CACHE) > _LAYOUT_CACHE_SIZE:
+        _LAYOUT_CACHE.popitem(last=False)
+
+    return layout
+
+
+def _evaluate_spline(a, b, c, d, t, nspl, want=None):
+    """Evaluate spline coefficients at nspl points, for one or many frames.
+
+    See global_natural_spline and global_natural_spline_batch for the
+    returned values. With want (a set of 'ddr', 'dddr'), the higher
+    derivatives not in it are not computed and returned as None.
+    """
+
+    layout = _sampling_layout(t, nspl)
+    seg = layout['seg']
+    ti = layout['ti'][:, np.newaxis]
+
+    # coefficients of the segment each spline point is in
+    a, b, c, d = a[..., seg, :], b[..., seg, :], c[..., seg, :], d[..., seg, :]
+
+    # Horner form of the cubic and its derivatives
+    r = a + ti * (b + ti * (c + ti * d))
+    dr = b + ti * (2 * c + 3 * ti * d)
+    ddr = 2 * c + 6 * ti * d if want is None or 'ddr' in want else None
+    dddr = 6 * d if want is None or 'dddr' in want else None
 
     # integrate arc length between the measured points
-    ds = np.sqrt(np.sum(dr**2, axis=1))
+    ds = np.sqrt(np.sum(dr**2, axis=-1))
 
     # length of each nspl segment
-    seg_lens = ds * dts
+    seg_lens = ds * layout['dts']
 
     # arc length coordinate for the spline
-    ss = seg_lens.cumsum()
+    ss = seg_lens.cumsum(axis=-1)
 
     # integrate arc length between points
-    int_seg = np.r_[0, bits_per_seg.cumsum()]  # indices to integrate between
-    lengths_total = np.zeros(n - 1)  # total length of each segment
-    for jj in np.arange(n - 1):
-        i0, i1 = int_seg[jj], int_seg[jj + 1]
-        assert i1 <= nspl
-        lens = seg_lens[i0:i1].cumsum()
-        lengths_total[jj] = lens[-1]
+    lengths_total = np.add.reduceat(seg_lens, layout['int_seg'][:-1], axis=-1)
+
+    ts = layout['ts'].copy()
+    idx_pts = layout['idx_pts'].copy()
 
     return r, dr, ddr, dddr, ts, ss, seg_lens, lengths_total, idx_pts
 
 
-def splinize_snake(pfe, te, nspl, times, mass, marker_df, density_df, chord_df):
+def global_natural_spline(p, t, nspl):
+    """Fit 3rd order global natural splines to the data.
+
+    Parameters
+    ----------
+    p : array, size (nmark, 3)
+        Measured data points
+    t : array, size (nmark - 1)
+        arc length distance between markers. Note that these don't have to
+        be exact (and can be less than arc length between them),
+        and can be modified to change the tangent angle at
+        a given measurement point.
+    nspl : int
+        number of points to evaluate the spline at
+
+    Returns
+    -------
+    r, dr, ddr, dddr : arrays, size (nspl, 3)
+        x, y, z and the associated derivatives of the spline
+    ts : array, size (nspl)
+        cumulatve coordinate spine was **evaluated** at
+    ss : array, size (nspl)
+        cumulative **arc length** coordinate
+    spl_ds : array, size (nspl)
+        lengths of individual spline segments (in physical units)
+    lengths_total : array, size (nmark - 1)
+        the integrated length of the spline between the points
+    idx_pts : array, size (nmark - 1)
+        indices into the ts and ss for the measured points
+    """
+
+    t = np.asarray(t, dtype=np.float64)
+    a, b, c, d = natural_spline_coefficients(p, t)
+
+    return _evaluate_spline(a, b, c, d, t, nspl)
+
+
+@instrumented()
+def global_natural_spline_batch(p, t, nspl):
+    """Fit global natural splines to every frame of a trial at once.
+
+    The tangent system only depends on the marker spacings, so it is
+    solved once for all frames (see natural_spline_coefficients).
+
+    Parameters
+    ----------
+    p : array, size (ntime, nmark, 3)
+        Measured data points for each frame
+    t : array, size (nmark - 1)
+        arc length distance between markers, shared by all frames
+    nspl : int
+        number of points to evaluate the spline at
+
+    Returns
+    -------
+    r, dr, ddr, dddr : arrays, size (ntime, nspl, 3)
+        x, y, z and the associated derivatives of the spline
+    ts : array, size (nspl)
+        cumulatve coordinate spine was **evaluated** at (same for all frames)
+    ss : array, size (ntime, nspl)
+        cumulative **arc length** coordinate
+    spl_ds : array, size (ntime, nspl)
+        lengths of individual spline segments (in physical units)
+    lengths_total : array, size (ntime, nmark - 1)
+        the integrated length of the spline between the points
+    idx_pts : array, size (nmark - 1)
+        indices into the ts and ss for the measured points
+    """
+
+    t = np.asarray(t, dtype=np.float64)
+    a, b, c, d = natural_spline_coefficients(p, t)
+
+    return _evaluate_spline(a, b, c, d, t, nspl)
+
+
+def marker_patterns(pos):
+    """Group the frames of a trial by which markers are present.
+
+    Parameters
+    ----------
+    pos : array, size (ntime, nmark, 3)
+        Marker positions, nan where a marker is missing
+
+    Returns
+    -------
+    patterns : list of (present, frames)
+        present is a boolean array, size (nmark), of the markers found in
+        every frame listed in frames
+    """
+
+    present = ~np.isnan(np.asarray(pos)[:, :, 0])
+    uniq, inverse = np.unique(present, axis=0, return_inverse=True)
+    inverse = inverse.ravel()
+
+    return [(uniq[k], np.flatnonzero(inverse == k)) for k in range(len(uniq))]
+
+
+@instrumented()
+def spline_frames(pos, t, nspl):
+    """Fit global natural splines to every frame of a trial with missing markers.
+
+    Frames are grouped by which markers are present, and each group is fit
+    with global_natural_spline_batch over the markers it has. The spacing
+    between two present markers is the sum of the spacings between them.
+
+    Parameters
+    ----------
+    pos : array, size (ntime, nmark, 3)
+        Marker positions, nan where a marker is missing
+    t : array, size (nmark - 1)
+        arc length distance between markers
+    nspl : int
+        number of points to evaluate the spline at
+
+    Returns
+    -------
+    r, dr, ddr : arrays, size (ntime, nspl, 3)
+        x, y, z and the associated derivatives of the spline
+    ts : array, size (ntime, nspl)
+        cumulative coordinate the spline was **evaluated** at
+    ss : array, size (ntime, nspl)
+        cumulative **arc length** coordinate
+    All outputs are nan in frames with fewer than two markers.
+    """
+
+    pos = np.asarray(pos, dtype=np.float64)
+    t = np.asarray(t, dtype=np.float64)
+    ntime = pos.shape[0]
+
+    # position of every marker along the body
+    t_coord = np.r_[0, t.cumsum()]
+
+    r = np.full((ntime, nspl, 3), np.nan)
+    dr = np.full((ntime, nspl, 3), np.nan)
+    ddr = np.full((ntime, nspl, 3), np.nan)
+    ts = np.full((ntime, nspl), np.nan)
+    ss = np.full((ntime, nspl), np.nan)
+
+    for present, frames in marker_patterns(pos):
+        count('frame_groups')
+        if present.sum() < 2:
+            continue
+        t_i = np.diff(t_coord[present])
+        out = global_natural_spline_batch(pos[frames][:, present], t_i, nspl)
+        r[frames], dr[frames], ddr[frames] = out[0], out[1], out[2]
+        ts[frames] = out[4]
+        ss[frames] = out[5]
+
+    return r, dr, ddr, ts, ss
+
+
+# per-frame outputs of splinize_snake, and how their shapes follow from
+# (ntime, nspl, nmark)
+_FRAME_FIELDS = OrderedDict([
+    ('Ro_I', lambda ntime, nspl, nmark: (ntime, 3)),
+    ('R_I', lambda ntime, nspl, nmark: (ntime, nspl, 3)),
+    ('dRds_I', lambda ntime, nspl, nmark: (ntime, nspl, 3)),
+    ('ddRds_I', lambda ntime, nspl, nmark: (ntime, nspl, 3)),
+    ('dddRds_I', lambda ntime, nspl, nmark: (ntime, nspl, 3)),
+    ('spl_ds', lambda ntime, nspl, nmark: (ntime, nspl)),
+    ('s_coord', lambda ntime, nspl, nmark: (ntime, nspl)),
+    ('spl_len_errors', lambda ntime, nspl, nmark: (ntime, nmark - 1)),
+])
+
+# outputs that are the same in every frame (or the same in every spline
+# point); read-only broadcast views when splinize_snake is given fields or
+# a dtype, full (ntime, nspl) arrays otherwise
+_ROW_FIELDS = ('mass_spl', 'chord_spl', 'times2D', 't_coord')
+
+SPLINE_FIELDS = tuple(_FRAME_FIELDS) + _ROW_FIELDS
+
+# frames fit at once by splinize_snake; bounds its temporary arrays
+SPLINE_CHUNK = 256
+
+
+def _check_fields(fields):
+    if fields is None:
+        return list(SPLINE_FIELDS)
+    fields = list(fields)
+    unknown = set(fields) - set(SPLINE_FIELDS)
+    if unknown:
+        raise ValueError('unknown splinize_snake fields: %s' % ', '.join(sorted(unknown)))
+    return fields
+
+
+def spline_constants(te, nspl, mass, marker_df, density_df, chord_df):
+    """The parts of splinize_snake that are the same for every frame.
+
+    Parameters
+    ----------
+    te, nspl, mass, marker_df, density_df, chord_df
+        as in splinize_snake
+
+    Returns
+    -------
+    Dictionary with:
+    ts : array, size (nspl)
+        coordinate the spline is evaluated at
+    idx_pts : array, size (nmark)
+        indices into ts for the measured points
+    vent_idx_spl : int
+        index into the spline of the vent
+    mass_spl_i, chord_spl_i : arrays, size (nspl)
+        mass and chord length of each spline point
+    dist_btn_markers : array, size (nmark - 1)
+        measured distances between the markers
+    SVL, VTL : float
+        snout vent length and tail length
+    """
+
+    te = np.asarray(te, dtype=np.float64)
+
+    # marker information
+    dist_btn_markers = marker_df['Dist to next, mm'].dropna().values
+    vent_idx = np.where(marker_df['Marker type'] == 'vent')[0][0]
+    SVL = marker_df['svl (mm)'].values[0]
+    VTL = marker_df['tail (mm)'].values[0]
+
+    layout = _sampling_layout(te, nspl)
+    ts = layout['ts'].copy()
+    idx_pts = layout['idx_pts'].copy()
+
+    # mass distribution
+    mass_spl_i = np.interp(ts / SVL, density_df['s'].values, density_df['rho'].values)
+    mass_spl_i = mass * mass_spl_i / mass_spl_i.sum()
+
+    # chord length distribution
+    chord_spl_i = SVL * np.interp(ts / SVL, chord_df['s'].values, chord_df['chord'].values)
+
+    # index into arc length coord where vent measurement is closest
+    # based on segment parameters (maybe arc length would be better,
+    # but it is making the tail too short). The spline is evaluated at the
+    # same ts for all frames, so the vent is at the same place for all splines
+    vent_idx_spl = idx_pts[vent_idx]
+
+    return dict(ts=ts, idx_pts=idx_pts, vent_idx_spl=vent_idx_spl,
+                mass_spl_i=mass_spl_i, chord_spl_i=chord_spl_i,
+                dist_btn_markers=dist_btn_markers, SVL=SVL, VTL=VTL)
+
+
+def spline_buffers(ntime, nspl, nmark, fields=None, dtype=np.float64, folder=None):
+    """Output arrays for splinize_snake_chunks (per-frame fields only).
+
+    Parameters
+    ----------
+    ntime, nspl : int
+        number of frames and spline points
+    nmark : int
+        number of markers on the actual snake (without the virtual marker)
+    fields : list of str
+        which per-frame fields (default all of them)
+    dtype : dtype
+        storage type, e.g. np.float32 to halve the memory
+    folder : str
+        if given, the arrays are memory mapped .npy files <field>.npy in
+        this folder (created if needed), so they don't have to fit in memory
+
+    Returns
+    -------
+    Dictionary of arrays by field name
+    """
+
+    fields = [f for f in _check_fields(fields) if f in _FRAME_FIELDS]
+    if folder is not None and not os.path.isdir(folder):
+        os.makedirs(folder)
+
+    buffers = {}
+    for field in fields:
+        shape = _FRAME_FIELDS[field](ntime, nspl, nmark)
+        if folder is None:
+            buffers[field] = np.empty(shape, dtype=dtype)
+        else:
+            path = os.path.join(folder, field + '.npy')
+            buffers[field] = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    return buffers
+
+
+def splinize_snake_chunks(pfe, te, nspl, times, mass, marker_df, density_df, chord_df,
+                          fields=None, dtype=np.float64, chunk=SPLINE_CHUNK, out=None, consts=None):
+    """Fit splines to the frames of a trial a chunk of frames at a time.
+
+    The per-frame fields of splinize_snake are computed for `chunk` frames
+    at once and written to the `out` buffers (or to new arrays for each
+    chunk), so the memory used stays the same however long the trial is.
+    Only the requested fields are computed. See spline_constants for the
+    fields that don't change between frames.
+
+    Parameters
+    ----------
+    pfe, te, nspl, times, mass, marker_df, density_df, chord_df
+        as in splinize_snake
+    fields : list of str
+        per-frame fields to compute (default all of them)
+    dtype : dtype
+        storage type of the new arrays when out is None
+    chunk : int
+        number of frames fit at once
+    out : dict or str
+        arrays to write into, from spline_buffers or the caller's own
+        (ntime x ... arrays by field name), or a folder for spline_buffers
+        to create memory mapped arrays in
+    consts : dict
+        the output of spline_constants, if the caller already has it
+
+    Yields
+    ------
+    frames : slice
+        the frames of the chunk
+    results : dict
+        the chunk's fields, views into out when given
+    """
+
+    pfe = np.asarray(pfe)
+    te = np.asarray(te, dtype=np.float64)
+    fields = [f for f in _check_fields(fields) if f in _FRAME_FIELDS]
+    ntime, nmark_e, _ = pfe.shape  # number of markers on 'extended' neck snake
+    nmark = nmark_e - 1  # number of markers on acutal snake
+
+    if isinstance(out, str):
+        out = spline_buffers(ntime, nspl, nmark, fields, dtype, folder=out)
+
+    if consts is None:
+        consts = spline_constants(te, nspl, mass, marker_df, density_df, chord_df)
+    want = set()
+    if 'ddRds_I' in fields:
+        want.add('ddr')
+    if 'dddRds_I' in fields:
+        want.add('dddr')
+
+    for start in range(0, ntime, chunk):
+        frames = slice(start, min(start + chunk, ntime))
+        n = frames.stop - frames.start
+
+        # fit splines to all the chunk's frames at once (te is the arc
+        # length coordinate of the markers, the same for every frame)
+        a, b, c, d = natural_spline_coefficients(pfe[frames], te)
+        R_I, dRds_I, ddRds_I, dddRds_I, ts, s_coord, spl_ds, lengths_total_e, idx_pts = \
+            _evaluate_spline(a, b, c, d, te, nspl, want)
+
+        computed = dict(R_I=R_I, dRds_I=dRds_I, ddRds_I=ddRds_I, dddRds_I=dddRds_I,
+                        spl_ds=spl_ds, s_coord=s_coord)
+
+        if 'spl_len_errors' in fields:
+            # exclude the virtual marker for error calculations
+            lengths_total = np.zeros((n, nmark - 1))
+            lengths_total[:, 0] = lengths_total_e[:, 0] + lengths_total_e[:, 1]
+            lengths_total[:, 1:] = lengths_total_e[:, 2:]
+
+            # arc length coordinate differences (% along spline) of markers (no virtual marker)
+            # %SVL of arc length coordinate
+            computed['spl_len_errors'] = (consts['dist_btn_markers'] - lengths_total) / consts['SVL'] * 100
+
+        if 'Ro_I' in fields:
+            # center of mass
+            computed['Ro_I'] = np.dot(np.swapaxes(R_I, 1, 2), consts['mass_spl_i']) / mass
+
+        if out is None:
+            res = dict((f, computed[f].astype(dtype, copy=False)) for f in fields)
+        else:
+            res = dict((f, out[f][frames]) for f in fields)
+            for f in fields:
+                res[f][...] = computed[f]
+
+        yield frames, res
+
+
+@instrumented()
+def splinize_snake(pfe, te, nspl, times, mass, marker_df, density_df, chord_df,
+                   fields=None, dtype=np.float64, chunk=None, out=None):
     """Fit a spline to the recorded IR markers to model the backbone of the snake.
     Also overlay the mass and chord length distributions.
 
@@ -164,104 +607,64 @@ def splinize_snake(pfe, te, nspl, times, mass, marker_df, density_df, chord_df):
         [s, rho] Normalized density (by average density) distribution
     chord_df : DataFrame
         [s, chord] Normalized chord length (by SVL) distribution
+    fields : list of str
+        outputs to compute (default all of them, see SPLINE_FIELDS), e.g.
+        ['R_I', 'Ro_I'] when only the backbone and center of mass are needed
+    dtype : dtype
+        storage type of the per-frame outputs, e.g. np.float32
+    chunk : int
+        number of frames fit at once (see splinize_snake_chunks); by
+        default all of them, which is fastest but needs the temporary
+        arrays for the whole trial. SPLINE_CHUNK keeps them small.
+    out : dict or str
+        buffers or a folder for memory mapped outputs, see splinize_snake_chunks
 
     Returns
     -------
-    Dictionary with:
+    Dictionary with the requested fields of:
     out = dict(Ro_I=Ro_I, R_I=R_I, dRds_I=ddRds_I, ddRds_I=ddRds_I, dddRds_I=dddRds_I,
            spl_ds=spl_ds, mass_spl=mass_spl, chord_spl=chord_spl,
            vent_idx_spl=vent_idx_spl, times2D=times2D, t_coord=t_coord,
            s_coord=s_coord, spl_len_errors=spl_len_errors,
            idx_pts=idx_pts, SVL=SVL, VTL=VTL)
+    vent_idx_spl, idx_pts, SVL and VTL are always included. mass_spl,
+    chord_spl, times2D and t_coord repeat the same row (or column) in every
+    frame. By default they are ordinary (ntime, nspl) arrays; when fields or
+    dtype is given they are read-only broadcast views instead, which take
+    no memory per frame (copy them before modifying them in place).
     """
 
-    # marker information
-    dist_btn_markers = marker_df['Dist to next, mm'].dropna().values
-    vent_idx = np.where(marker_df['Marker type'] == 'vent')[0][0]
-    SVL = marker_df['svl (mm)'].values[0]
-    VTL = marker_df['tail (mm)'].values[0]
-
-    # density distribution
-    s_rho = density_df['s'].values
-    body_rho = density_df['rho'].values
-
-    # chord length distribution
-    s_chord  = chord_df['s'].values
-    body_chord = chord_df['chord'].values
-
-    ntime, nmark_e, _ = pfe.shape  # number of markers on 'extended' neck snake
-    nmark = nmark_e - 1  # number of markers on acutal snake
-
-    Ro_I = np.zeros((ntime, 3))
-    times2D = np.zeros((ntime, nspl))
-    t_coord = np.zeros((ntime, nspl))
-    s_coord = np.zeros((ntime, nspl))
-    vent_idx_spls = np.zeros(ntime, dtype=np.int)
-    R_I = np.zeros((ntime, nspl, 3))  # spl
-    dRds_I = np.zeros((ntime, nspl, 3))  # dspl
-    ddRds_I = np.zeros((ntime, nspl, 3))  # ddspl
-    dddRds_I = np.zeros((ntime, nspl, 3))
-    spl_ds = np.zeros((ntime, nspl))  # length of each segment in mm
-    mass_spl = np.zeros((ntime, nspl))  # in g
-    chord_spl = np.zeros((ntime, nspl))
-    #spl_len_totals = np.zeros(ntime)
-    spl_len_errors = np.zeros((ntime, nmark - 1))  # -1 because difference b/n
-
-    for i in np.arange(ntime):
-
-        # fit spline (fpe is the arc length coordinate of the markers)
-        out = global_natural_spline(pfe[i], te, nspl)
-        r, dr, ddr, dddr, ts, ss, seg_lens, lengths_total_e, idx_pts = out
-
-        # exclude the virtual marker for error calculations
-        lengths_total = np.zeros(nmark - 1)
-        lengths_total[0] = lengths_total_e[0] + lengths_total_e[1]
-        lengths_total[1:] = lengths_total_e[2:]
-
-        # arc length coordinate differences (% along spline) of markers (no virtual marker)
-         # %SVL of arc length coordinate
-        spl_len_error = (dist_btn_markers - lengths_total) / SVL * 100
-
-        # index into arc length coord where vent measurement is closest
-        # based on segment parameters (maybe arc length would be better,
-        # but it is making the tail too short)
-        vent_idx_spl = idx_pts[vent_idx]
-
-        # mass distribution
-        mass_spl_i = np.interp(ts / SVL, s_rho, body_rho)
-        mass_spl_i = mass * mass_spl_i / mass_spl_i.sum()
-
-        # chord length distribution
-        chord_spl[i] = SVL * np.interp(ts / SVL, s_chord, body_chord)
-
-        # center of mass
-        Ro_I[i] = np.sum((r.T * mass_spl_i).T, axis=0) / mass
-
-        # store the spline and its derivative (for tangent angle calculations)
-        R_I[i] = r
-        dRds_I[i] = dr
-        ddRds_I[i] = ddr
-        dddRds_I[i] = dddr
-        spl_ds[i] = seg_lens
-        mass_spl[i] = mass_spl_i
-        vent_idx_spls[i] = vent_idx_spl
-        times2D[i] = times[i]
-        t_coord[i] = ts
-        s_coord[i] = ss
-        spl_len_errors[i] = spl_len_error
-
-    # the vent should be located at the same place for all splines
-    assert(np.sum(vent_idx_spls == vent_idx_spls[0]) == ntime)
-
-    # just use the one vent index into the spline
-    # idx_pts should also be good then
-    vent_idx_spl = vent_idx_spls[0]
-
-    out = dict(Ro_I=Ro_I, R_I=R_I, dRds_I=dRds_I, ddRds_I=ddRds_I, dddRds_I=dddRds_I,
-               spl_ds=spl_ds, mass_spl=mass_spl, chord_spl=chord_spl,
-               vent_idx_spl=vent_idx_spl, times2D=times2D, t_coord=t_coord,
-               s_coord=s_coord, spl_len_errors=spl_len_errors,
-               idx_pts=idx_pts, SVL=SVL, VTL=VTL)
-
-    return out
-
+    pfe = np.asarray(pfe)
+    # the row fields stay full writable arrays unless the caller opted in
+    # to the selectable fields / storage type
+    views = fields is not None or np.dtype(dtype) != np.float64
+    fields = _check_fields(fields)
+    frame_fields = [f for f in fields if f in _FRAME_FIELDS]
+    ntime, nmark_e, _ = pfe.shape
+
+    if chunk is None:
+        chunk = max(ntime, 1)
+    if isinstance(out, str) or (out is None and chunk < ntime):
+        out = spline_buffers(ntime, nspl, nmark_e - 1, frame_fields, dtype, folder=out)
+
+    consts = spline_constants(te, nspl, mass, marker_df, density_df, chord_df)
+
+    result = {}
+    for frames, res in splinize_snake_chunks(pfe, te, nspl, times, mass, marker_df, density_df, chord_df,
+                                             fields=frame_fields, dtype=dtype, chunk=chunk, out=out,
+                                             consts=consts):
+        # without buffers there is a single chunk, the whole trial
+        result = res if out is None else dict((f, out[f]) for f in frame_fields)
+
+    rows = dict(mass_spl=consts['mass_spl_i'], chord_spl=consts['chord_spl_i'],
+                t_coord=consts['ts'], times2D=np.asarray(times)[:, np.newaxis])
+    for f in fields:
+        if f in rows:
+            result[f] = np.broadcast_to(rows[f].astype(dtype, copy=False), (ntime, nspl))
+            if not views:
+                result[f] = result[f].copy()
+
+    result.update(vent_idx_spl=consts['vent_idx_spl'], idx_pts=consts['idx_pts'],
+                  SVL=consts['SVL'], VTL=consts['VTL'])
+
+    return result
@@ -0,0 +1,218 @@
+import os
+import glob
+import pickle
+import hashlib
+import inspect
+from collections import namedtuple
+
+import numpy as np
+
+#relative to the working directory, like the notebooks
+STAGE_CACHE_DIR = 'Pipeline cache'
+
+#2 GB
+MAX_BYTES = 2*1024**3
+
+#once past max_bytes, the cache is trimmed back to this fraction of it, so a full cache isn't rescanned on every write
+TRIM_TO = 0.9
+
+#value = output of the stage, key = hash it is cached under (what downstream stages are keyed on), hit = whether it came from the cache
+StageResult = namedtuple('StageResult', ['key', 'value', 'hit'])
+
+
+def file_digest(path):
+    """sha1 of a file's contents, to key a stage on a file rather than its name"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _update(h, value):
+    #feed a value into the hash in a form that doesn't depend on object identity or dictionary order
+    if isinstance(value, StageResult):
+        h.update(b'stage' + value.key.encode())
+    elif isinstance(value, np.ndarray):
+        h.update(('array%s%s' % (value.dtype.str, value.shape)).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        h.update(b'dict%d' % len(value))
+        for k in sorted(value, key=repr):
+            _update(h, k)
+            _update(h, value[k])
+    elif isinstance(value, (list, tuple)):
+        h.update(b'seq%d' % len(value))
+        for v in value:
+            _update(h, v)
+    else:
+        h.update(repr(value).encode())
+
+
+def data_hash(*values):
+    """sha1 of any mix of arrays, scalars, strings, lists, dictionaries and StageResults (hashed by their key)"""
+    h = hashlib.sha1()
+    for value in values:
+        _update(h, value)
+    return h.hexdigest()
+
+
+#code_version results, by tuple of code objects; the source is only read and hashed once per process
+_CODE_VERSIONS = {}
+
+
+def code_version(*code):
+    """sha1 of the source of the functions or modules a stage runs, so editing them invalidates the stage.
+    Memoized per process: edits made after the first call (e.g. reloading a module) need a new process,
+    or _CODE_VERSIONS.clear()"""
+    if code in _CODE_VERSIONS:
+        return _CODE_VERSIONS[code]
+    h = hashlib.sha1()
+    for obj in code:
+        try:
+            h.update(inspect.getsource(obj).encode())
+        except (OSError, TypeError):
+            h.update(repr(obj).encode())
+    _CODE_VERSIONS[code] = h.hexdigest()
+    return _CODE_VERSIONS[code]
+
+
+class StageCache(object):
+    """Disk cache of pipeline stage outputs, keyed on content.
+
+    A stage's key is the hash of its name, its code, its parameters and its inputs. Inputs that are
+    themselves StageResults are hashed by their key, so changing a file or a parameter changes the keys
+    of that stage and everything downstream of it, and nothing else. Entries are pickles; once the
+    folder grows past max_bytes the least recently used ones are deleted. The size of the folder is
+    read once and then tracked as entries are written (other processes writing to the same folder are
+    only accounted for when the cache is next trimmed).
+
+    Parameters
+    ----------
+    root : str
+        folder of the cache
+    max_bytes : int
+        size limit; a write that takes the cache past it trims it back to TRIM_TO of it
+    """
+
+    def __init__(self, root=STAGE_CACHE_DIR, max_bytes=MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        #bytes used by the entries, read on the first write and kept up to date after that
+        self._bytes = None
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + '.pkl')
+
+    def key(self, stage, code, inputs, params):
+        """cache key of a stage run (see run)"""
+        return data_hash(stage, code_version(*code), inputs, params)
+
+    def get(self, key):
+        """(True, value) if key is cached, (False, None) otherwise"""
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return False, None
+        #mark as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return True, value
+
+    def put(self, key, value):
+        """cache a value, then trim the cache to max_bytes if it grew past it"""
+        path = self._path(key)
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder, exist_ok=True)
+        if self._bytes is None:
+            self._bytes = self.size()
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        #write to a temporary file first, so other processes never read a partial entry
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self._bytes += os.path.getsize(tmp) - replaced
+        os.replace(tmp, path)
+        if self._bytes > self.max_bytes:
+            self.evict(int(self.max_bytes*TRIM_TO))
+
+    def evict(self, max_bytes=None):
+        """delete the least recently used entries until the cache is under max_bytes (self.max_bytes by default)"""
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        entries = []
+        for path in glob.glob(os.path.join(self.root, '*', '*.pkl')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        total = sum(e[1] for e in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        self._bytes = total
+
+    def size(self):
+        """bytes used by the cache"""
+        return sum(os.path.getsize(p) for p in glob.glob(os.path.join(self.root, '*', '*.pkl')))
+
+    def clear(self):
+        """delete every entry"""
+        for path in glob.glob(os.path.join(self.root, '*', '*.pkl')):
+            os.remove(path)
+        self._bytes = 0
+
+    def run(self, stage, fn, inputs, params=None, code=None, args=None):
+        """run a stage, or load its output if it was run before on the same inputs.
+
+        input parameters
+        stage = name of the stage, e.g. 'smooth'
+        fn = the stage function, called as fn(*args, **params)
+        inputs = what the output depends on: StageResults of upstream stages, arrays, file digests...
+        params = dictionary of the stage's parameters
+        code = functions or modules whose source the stage depends on (defaults to fn)
+        args = arguments for fn, defaults to inputs (with StageResults replaced by their values)
+
+        output: StageResult"""
+
+        params = {} if params is None else params
+        code = (fn,) if code is None else tuple(code)
+        key = self.key(stage, code, inputs, params)
+
+        hit, value = self.get(key)
+        if hit:
+            self.hits += 1
+            return StageResult(key, value, True)
+
+        self.misses += 1
+        if args is None:
+            args = [x.value if isinstance(x, StageResult) else x for x in inputs]
+        value = fn(*args, **params)
+        self.put(key, value)
+        return StageResult(key, value, False)
+
+
+def run_stage(cache, stage, fn, inputs, params=None, code=None, args=None):
+    """StageCache.run, or just fn when cache is None"""
+    if cache is not None:
+        return cache.run(stage, fn, inputs, params=params, code=code, args=args)
+    if args is None:
+        args = [x.value if isinstance(x, StageResult) else x for x in inputs]
+    return StageResult(None, fn(*args, **({} if params is None else params)), False)
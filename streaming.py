@@ -0,0 +1,292 @@
+import time
+from collections import namedtuple, OrderedDict, deque
+
+import numpy as np
+
+from import_raw import read_mocap_csv, CACHE_DIR, ORIGIN_OFFSET, TARGET_OFFSET
+from align_coords import align
+from kinematics_fn import polyfit_weights
+
+#a block of consecutive Vicon frames: frame numbers (k), snake markers (k x nmarkers x 3, mm) and branch markers (k x 4 x 3, mm)
+Chunk = namedtuple('Chunk', ['frames', 'snake', 'branch'])
+
+#smoothed, aligned kinematics of one frame (mm, mm/s, mm/s^2, nmarkers x 3 each), and the gap crossing events in it
+StreamFrame = namedtuple('StreamFrame', ['frame', 'time', 'pos', 'vel', 'acc', 'events'])
+
+#'start' = head passes the origin end (x > 0), the start of a trial's region of interest in get_raw_data.
+#'reach' = head reaches the target end
+Event = namedtuple('Event', ['kind', 'frame', 'time'])
+
+
+class ReplaySource(object):
+    """Plays a MOCAP .csv back as if it came from the motion capture system, a chunk of frames at a time.
+
+    Parameters
+    ----------
+    path : str
+        raw .csv file from the motion capture system
+    chunk : int
+        frames per chunk (1 for frame by frame)
+    realtime : bool
+        wait between chunks to keep to the frame rate; False plays back as fast as possible
+    rate : float
+        playback frame rate, defaults to the file's (100 or 150 Hz)
+    cache_dir : str
+        see import_raw.read_mocap_csv
+    """
+
+    def __init__(self, path, chunk=1, realtime=True, rate=None, cache_dir=CACHE_DIR):
+        header, data = read_mocap_csv(path, cache_dir=cache_dir)
+        self.frate = header['frate']
+        self.rate = self.frate if rate is None else rate
+        self.chunk = chunk
+        self.realtime = realtime
+
+        n = data.shape[0]
+        self.frames = data[:, 0].astype(int)
+        self.snake = np.reshape(data[:, 2:32], (n, 10, 3))
+        self.branch = np.reshape(data[:, 32:44], (n, 4, 3))
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __iter__(self):
+        start = time.perf_counter()
+        for i in range(0, len(self.frames), self.chunk):
+            j = min(i+self.chunk, len(self.frames))
+            if self.realtime:
+                #a chunk is available once its last frame has been recorded
+                wait = start + (j-1)*1.0/self.rate - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            yield Chunk(self.frames[i:j], self.snake[i:j], self.branch[i:j])
+
+
+class StreamProcessor(object):
+    """Online smoothing, alignment and kinematics, fed a chunk of frames at a time.
+
+    Each frame is smoothed with a fixed lag: once `lag` more frames have arrived, a polynomial is fit by least
+    squares to every marker over the 2*lag+1 frame window centred on it (a Savitzky-Golay filter), giving its
+    position, velocity and acceleration. Missing samples are left out of the fit, so short gaps are bridged;
+    frames without enough data on both sides stay nan. State is a ring buffer of one window, so memory and
+    work per frame are fixed and the output latency is lag/frate plus the processing time.
+
+    Positions are put in the branch coordinate system like align_coords.align, using running means of the
+    branch markers (or fixed origin and target ends, if given).
+
+    Parameters
+    ----------
+    frate : int
+        frame rate (100 or 150)
+    nmarkers : int
+        snake markers per frame
+    lag : int
+        frames of delay, defaults to about 100 ms
+    order : int
+        polynomial order of the fit
+    origin, target : arrays, size (3)
+        origin and target ends (mm, calibrated coordinates, offsets included), if known beforehand
+    """
+
+    def __init__(self, frate, nmarkers=10, lag=None, order=2, origin=None, target=None):
+        self.frate = frate
+        self.nmarkers = nmarkers
+        self.lag = int(round(0.1*frate)) if lag is None else lag
+        self.order = order
+        self.window = 2*self.lag+1
+
+        #ring buffer of the last `window` frames
+        self._buf = np.full((self.window, nmarkers, 3), np.nan)
+        self._frames = np.zeros(self.window, dtype=int)
+        self._arrived = np.zeros(self.window)
+        self._count = 0
+
+        #running sums of the origin and target branch markers, unless the ends are given
+        self._fixed = origin is not None and target is not None
+        self._origin = np.asarray(origin, dtype=np.float64) if self._fixed else np.full(3, np.nan)
+        self._target = np.asarray(target, dtype=np.float64) if self._fixed else np.full(3, np.nan)
+        self._branch_sum = np.zeros((2, 3))
+        self._branch_n = np.zeros((2, 3))
+
+        #fit weights for each pattern of missing samples, most recently used kept
+        self._weights = OrderedDict()
+        self._weights_size = 256
+
+        self._started = False
+        self._reached = False
+        self.latencies = deque(maxlen=100000)
+        self.busy = 0.0
+        self.emitted = 0
+
+    @property
+    def origin(self):
+        """current origin end estimate (mm)"""
+        return self._origin
+
+    @property
+    def target(self):
+        """current target end estimate (mm)"""
+        return self._target
+
+    def _update_branch(self, branch):
+        if self._fixed:
+            return
+        ends = branch[:, :2]
+        good = ~np.isnan(ends)
+        self._branch_sum += np.where(good, ends, 0).sum(axis=0)
+        self._branch_n += good.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._branch_sum/self._branch_n
+        self._origin = mean[0] + ORIGIN_OFFSET
+        self._target = mean[1] + TARGET_OFFSET
+
+    def _fit_weights(self, valid, at):
+        #weights for the valid samples of a window, evaluated at position `at`; None if the fit isn't supported there
+        key = (valid.tobytes(), at)
+        if key in self._weights:
+            self._weights.move_to_end(key)
+            return self._weights[key]
+
+        x = np.flatnonzero(valid)
+        W = None
+        if len(x) >= self.order+1 and x[0] <= at <= x[-1]:
+            W = polyfit_weights(x, self.order, x0=at)
+            W[1] *= self.frate
+            W[2] *= self.frate**2
+
+        self._weights[key] = (x, W)
+        if len(self._weights) > self._weights_size:
+            self._weights.popitem(last=False)
+        return x, W
+
+    def _smooth(self, order, at):
+        #position, velocity and acceleration of every marker at window position `at`
+        win = self._buf[order]
+        kins = np.full((3, self.nmarkers, 3), np.nan)
+
+        valid = ~np.isnan(win[:, :, 0])
+        patterns = {}
+        for m in range(self.nmarkers):
+            patterns.setdefault(valid[:, m].tobytes(), []).append(m)
+
+        for key, marks in patterns.items():
+            x, W = self._fit_weights(valid[:, marks[0]], at)
+            if W is None:
+                continue
+            #(3 x nsamples) . (nsamples x (markers*3))
+            kins[:, marks] = W.dot(win[x][:, marks].reshape(len(x), -1)).reshape(3, len(marks), 3)
+
+        return kins
+
+    def _emit(self, order, at):
+        kins = self._smooth(order, at)
+        frame = self._frames[order[at]]
+        t = frame*1.0/self.frate
+
+        if np.isnan(self._origin).any():
+            pos, vel, acc = kins
+        else:
+            #same transform as align_coords.align; derivatives only rotate
+            pos, vel, acc = kins[0], kins[1], kins[2]
+            if np.isnan(self._target).any():
+                pos = pos-self._origin
+            else:
+                nte = self._target-self._origin
+                pos = align(pos[np.newaxis], self._origin, self._target)[0][0]
+                vel = align(vel[np.newaxis], np.zeros(3), nte)[0][0]
+                acc = align(acc[np.newaxis], np.zeros(3), nte)[0][0]
+
+        events = []
+        head_x = pos[0, 0]
+        if not np.isnan(self._origin).any() and not np.isnan(head_x):
+            if not self._started and head_x > 0:
+                self._started = True
+                events.append(Event('start', frame, t))
+            if self._started and not self._reached and not np.isnan(self._target).any():
+                nte = align(np.zeros((1, 1, 3)), self._origin, self._target)[2]
+                if head_x >= nte[0]:
+                    self._reached = True
+                    events.append(Event('reach', frame, t))
+
+        self.latencies.append(time.perf_counter()-self._arrived[order[at]])
+        self.emitted += 1
+        return StreamFrame(frame, t, pos, vel, acc, events)
+
+    def process(self, chunk):
+        """add a Chunk of frames; returns the StreamFrames that became ready (each lag frames behind the input)"""
+        tic = time.perf_counter()
+        out = []
+        self._update_branch(np.asarray(chunk.branch, dtype=np.float64))
+
+        for frame, snake in zip(chunk.frames, np.asarray(chunk.snake, dtype=np.float64)):
+            i = self._count % self.window
+            self._buf[i] = snake
+            self._frames[i] = frame
+            self._arrived[i] = tic
+            self._count += 1
+
+            if self._count >= self.window:
+                #oldest to newest; the centre of the window is ready
+                order = (np.arange(self.window)+self._count) % self.window
+                out.append(self._emit(order, self.lag))
+            elif self._count > self.lag:
+                #not a full window yet: the first frames are fit from the ones after them
+                order = np.arange(self._count)
+                out.append(self._emit(order, self._count-1-self.lag))
+
+        self.busy += time.perf_counter()-tic
+        return out
+
+    def flush(self):
+        """emit the last lag frames (fit with the frames before them only)"""
+        n = min(self._count, self.window)
+        order = (np.arange(n)+self._count-n) % self.window
+        first = max(n-self.lag, 0)
+        tic = time.perf_counter()
+        self._arrived[order[first:]] = tic
+        out = [self._emit(order, at) for at in range(first, n)]
+        self.busy += time.perf_counter()-tic
+        return out
+
+    def stats(self):
+        """latency (s, from a frame's arrival to its output: the lag frames in real time, plus processing),
+        processing time per frame (s) and the sustained frame rate the processing allows"""
+        lat = np.array(self.latencies)
+        if len(lat) == 0:
+            lat = np.array([np.nan])
+        per_frame = self.busy/self.emitted if self.emitted > 0 else np.nan
+        return {'frames': self.emitted,
+                'lag': self.lag*1.0/self.frate,
+                'latency_mean': lat.mean(),
+                'latency_p99': np.percentile(lat, 99),
+                'latency_max': lat.max(),
+                'processing': per_frame,
+                'frame_rate': 1.0/per_frame}
+
+
+def replay(path, chunk=1, realtime=True, rate=None, callback=None, **kwargs):
+    """play a MOCAP .csv through a StreamProcessor.
+
+    input parameters
+    path = raw .csv file
+    chunk, realtime, rate = see ReplaySource
+    callback = optional function called with every StreamFrame as it comes out
+    kwargs = passed on to StreamProcessor (lag, order, origin, target)
+
+    output: processor (with its stats()), list of the gap crossing Events"""
+
+    source = ReplaySource(path, chunk=chunk, realtime=realtime, rate=rate)
+    processor = StreamProcessor(source.frate, **kwargs)
+    events = []
+
+    def handle(frames):
+        for f in frames:
+            events.extend(f.events)
+            if callback is not None:
+                callback(f)
+
+    for c in source:
+        handle(processor.process(c))
+    handle(processor.flush())
+
+    return processor, events
@@ -0,0 +1,356 @@
+"""Per-trial summary tables for the R analyses (bdata, tdata and vdata in R files/Summary Datasets), from the
+processed trials of a TrialStore, in one command:
+
+    python summary.py [--store "Processed trials"] [--out "R files/Summary Datasets"] [--workers N]
+
+The metrics are functions registered with @metric: each takes a TrialContext (one trial's arrays and metadata,
+plus what several metrics share: units, drop frame, behavior code, low and high points, head speed) and returns
+a dictionary of columns. summarize_trial runs every registered metric on a trial, so its arrays are read and
+the shared quantities computed once per trial; summarize does this for all trials, in parallel processes.
+tables then picks the columns of each table, and write_tables saves them as the notebooks did.
+
+The metrics are the ones of the notebooks' loops:
+Notebook 2 (bdata): behavior codes, arc height and loop depth at the low and high points, max curvature,
+                    average Y and Z excursion, distance travelled, overshoot
+Notebook 3 (tdata): torque at the drop frame and head position at the drop frame
+Notebook 4 (vdata): max, landing and average forward head speed
+"""
+import os
+import argparse
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from trial_store import TrialStore, STORE_DIR
+from trial_registry import SUMMARY_DIR, behavior_code
+from kinematics_fn import landing_fit, LANDING_WINDOW
+from m_gncspline import global_natural_spline
+from torque_fn import trial_torques
+from instrument import instrumented
+import instrument
+
+#low points picked by hand in Notebook 2, for trials where the lowest marker is still on the branch
+LOW_POINT_FIXES = {125: 909, 220: 11616, 247: 473, 248: 265, 249: 178}
+
+#spline points for the arc height and loop depth
+NSPL = 1000
+
+#forward head speed (m/s) above which a frame counts towards the average forward moving speed
+FORWARD_THRESHOLD = 0.025
+
+#columns of each table: a summary column, or (table column, summary column)
+TABLES = OrderedDict([
+    ('bdata', ['tn', 'gsr', 'gs_bin', 'ID', 'svl', 'beh_c', 'beh', 'ldl', 'ldh', 'ahh', 'ahl', 'maxC', 'rel_maxC',
+               'avg_ydev', 'avg_zdev', 'dist', 'over']),
+    ('tdata', [('Trial', 'tn'), 'ID', 'gsm', 'gsr', 'gs_bin', 'TNorm', 'x_torq', 'y_torq', 'res', 'hpt',
+               ('svl', 'svl_m'), ('mass', 'mass_kg')]),
+    ('vdata', ['tn', 'gsr', 'gs_bin', 'ID', ('svl', 'svl_m'), 'beh', 'mhv', 'landv', 'axv', 'slv', 'smv', 'sav']),
+])
+
+#to_csv arguments of each table, as the notebooks saved them
+_WRITE = {'bdata': {'index': False, 'na_rep': 'NaN'}, 'tdata': {'index': False}, 'vdata': {}}
+
+#name -> metric function, in registration order
+METRICS = OrderedDict()
+
+
+def metric(fn):
+    """register a metric: a function of a TrialContext returning a dictionary of columns"""
+    METRICS[fn.__name__] = fn
+    return fn
+
+
+def low_high_points(pos, drop):
+    """Notebook 2's find_frames: the high point is the highest head position after the drop frame, the low
+    point the lowest body (non-head) marker position from the first frame up to the high point.
+    (events.detect_events only counts markers that have left the branch, which moves the low point by a few
+    frames in many trials; the tables keep the rule the R analyses were run with.)"""
+    head_z = pos[drop:, 0, 2]
+    high = drop+int(np.nanargmax(head_z))
+    body_low = np.fmin.reduce(pos[:high+1, 1:, 2], axis=1)
+    return int(np.nanargmin(body_low)), high
+
+
+class TrialContext(object):
+    """What the metrics of one trial work from: its arrays and metadata, and the quantities several metrics
+    share, each computed once.
+
+    Parameters
+    ----------
+    meta : dict
+        the trial's metadata (TrialStore.meta)
+    pos, vel : arrays, size (nframes, nmarkers, 3)
+        smoothed positions (mm) and velocities (mm/s), origin end at the origin
+    """
+
+    def __init__(self, meta, pos, vel):
+        self.meta = meta
+        self.tn = int(meta['tn'])
+        self.pos = np.asarray(pos, dtype=np.float64)
+        self.vel = np.asarray(vel, dtype=np.float64)
+        self.pos_m = self.pos/1000.0 #mm to m
+
+        self.svl_cm = meta['svl']
+        self.svl_m = meta['svl']/100.0 #cm to m
+        self.mass_kg = meta['mass']/1000.0 #g to kg
+        spaces = np.asarray(meta['cms'], dtype=np.float64)/100.0 #cm to m
+        self.spaces_m = spaces
+        self.t_coord = np.r_[0, spaces[1:].cumsum()] #position of every marker along the body (m)
+        self.has_origin = not np.isnan(np.asarray(meta['oe'], dtype=np.float64)).any()
+
+        #index of the drop frame into the trial's frames (None if there is none)
+        dp = meta['dp']
+        at = [] if dp is None or np.isnan(dp) else np.flatnonzero(np.asarray(meta['fn']) == int(dp))
+        self.drop = int(at[0]) if len(at) else None
+
+        self.beh_c, self.beh = behavior_code(self.tn, dp)
+
+        self.low = self.high = None
+        if self.drop is not None:
+            self.low, self.high = low_high_points(self.pos, self.drop)
+            self.low = LOW_POINT_FIXES.get(self.tn, self.low)
+
+        self.head_speed = np.linalg.norm(self.vel[:, 0], axis=1)/1000.0 #mm/s to m/s
+        self._shapes = {}
+
+    def shape(self, frame):
+        """arc height and loop depth (m) in a frame, from a spline through the markers present (Notebook 2's
+        snake_shape): the height of the head above the lowest point of the rest of the body, and the depth of
+        that point below the origin end"""
+        if frame not in self._shapes:
+            snake = self.pos_m[frame]
+            present = ~np.isnan(snake[:, 0])
+            if present.sum() < 2:
+                self._shapes[frame] = (np.nan, np.nan)
+            else:
+                r = global_natural_spline(snake[present], np.diff(self.t_coord[present]), NSPL)[0]
+                low_z = r[1:, 2].min()
+                self._shapes[frame] = (r[0, 2]-low_z, -low_z)
+        return self._shapes[frame]
+
+
+@metric
+def trial_info(c):
+    m = c.meta
+    return {'tn': c.tn, 'ID': m['ID'], 'gsr': m['gs_%'], 'gsm': m['gs_m'], 'gs_bin': 5*round(m['gs_%']/5),
+            'svl': c.svl_cm, 'svl_m': c.svl_m, 'mass_kg': c.mass_kg}
+
+
+@metric
+def behavior(c):
+    return {'beh_c': c.beh_c, 'beh': c.beh}
+
+
+@metric
+def arc_height(c):
+    """head height above the lowest body point at the low and high points (%SVL)"""
+    if c.low is None:
+        return {'ahl': np.nan, 'ahh': np.nan}
+    return {'ahl': c.shape(c.low)[0]/c.svl_m*100, 'ahh': c.shape(c.high)[0]/c.svl_m*100}
+
+
+@metric
+def loop_depth(c):
+    """depth of the lowest body point below the origin end at the low and high points (%SVL), nan where the
+    origin end was not recorded"""
+    if c.low is None or not c.has_origin:
+        return {'ldl': np.nan, 'ldh': np.nan}
+    return {'ldl': c.shape(c.low)[1]/c.svl_m*100, 'ldh': c.shape(c.high)[1]/c.svl_m*100}
+
+
+@metric
+def max_curvature(c):
+    """largest difference over frames between the length along the body and the straight line distance from
+    the first to the last marker present (m, and %SVL). Not defined for recovery trials, which curl up as they
+    fall."""
+    if c.beh_c == 2:
+        return {'maxC': np.nan, 'rel_maxC': np.nan}
+    present = ~np.isnan(c.pos_m[:, :, 0])
+    nmark = present.shape[1]
+    first = present.argmax(axis=1)
+    last = nmark-1-present[:, ::-1].argmax(axis=1)
+    frames = np.arange(len(present))
+    straight = np.linalg.norm(c.pos_m[frames, first]-c.pos_m[frames, last], axis=1)
+    curve = c.t_coord[last]-c.t_coord[first]
+    dev = np.where(present.any(axis=1), curve-straight, np.nan)
+    max_c = np.fmax.reduce(dev)
+    return {'maxC': max_c, 'rel_maxC': max_c/c.svl_m*100}
+
+
+@metric
+def deviation(c):
+    """average over markers of the range of Y and Z positions over the trial (mm)"""
+    ranges = np.fmax.reduce(c.pos, axis=0)-np.fmin.reduce(c.pos, axis=0)
+    with np.errstate(invalid='ignore'):
+        avg = np.nanmean(ranges, axis=0)
+    return {'avg_ydev': avg[1], 'avg_zdev': avg[2]}
+
+
+@metric
+def distance(c):
+    """straight line distance travelled by the head from the low point to landing (%SVL)"""
+    if c.low is None:
+        return {'dist': np.nan}
+    return {'dist': np.linalg.norm(c.pos_m[-1, 0]-c.pos_m[c.low, 0])/c.svl_m*100}
+
+
+@metric
+def overshoot(c):
+    """distance of the head from the origin end at landing past the gap size, for non-cantilevers (fraction of
+    svl)"""
+    if c.beh != 1:
+        return {'over': np.nan}
+    landing = np.linalg.norm(c.pos[-1, 0])/10.0 #mm to cm
+    return {'over': (landing-c.meta['gs_m']*100)/c.svl_cm}
+
+
+@metric
+def torque(c):
+    """torque about the origin end at the drop frame (Nm), its horizontal part normalized by weight and svl,
+    and the head's distance from the origin end at the drop frame (% of the gap size). nan without a drop
+    frame or origin end, or when the head marker is missing."""
+    if c.drop is None or not c.has_origin:
+        return dict((k, np.nan) for k in ['TNorm', 'x_torq', 'y_torq', 'res', 'hpt'])
+    tq = trial_torques(c.pos_m[c.drop][np.newaxis], c.spaces_m, c.svl_m, c.mass_kg)[0]
+    return {'TNorm': np.hypot(tq[0], tq[1])/(9.8*c.mass_kg*c.svl_m), 'x_torq': tq[0], 'y_torq': tq[1],
+            'res': np.linalg.norm(tq), 'hpt': np.linalg.norm(c.pos_m[c.drop, 0])/c.meta['gs_m']*100}
+
+
+@metric
+def max_speed(c):
+    """maximum head speed (m/s, and svl/s)"""
+    mhv = np.fmax.reduce(c.head_speed)
+    return {'mhv': mhv, 'smv': mhv/c.svl_m}
+
+
+@metric
+def landing_speed(c):
+    """head speed from a line fit to the last LANDING_WINDOW seconds (m/s, and svl/s)"""
+    landv = np.linalg.norm(landing_fit(c.pos[:, 0], c.meta['fr'], seconds=LANDING_WINDOW)[0])/1000.0
+    return {'landv': landv, 'slv': landv/c.svl_m}
+
+
+@metric
+def forward_speed(c):
+    """average head speed over the frames where the head moves forward (m/s, and svl/s)"""
+    with np.errstate(invalid='ignore'):
+        moving = c.head_speed[c.vel[:, 0, 0]/1000.0 > FORWARD_THRESHOLD]
+        axv = np.nanmean(moving) if len(moving) else np.nan
+    return {'axv': axv, 'sav': axv/c.svl_m}
+
+
+@instrumented()
+def summarize_trial(meta, pos, vel, metrics=None):
+    """every metric (or the named ones) of one trial, as one dictionary of columns"""
+    context = TrialContext(meta, pos, vel)
+    row = OrderedDict()
+    for name in (METRICS if metrics is None else metrics):
+        row.update(METRICS[name](context))
+    return row
+
+
+def _run(root, tn, metrics):
+    #errors are returned rather than raised, so one bad trial doesn't abort the table
+    store = TrialStore(root)
+    try:
+        with instrument.trial(tn):
+            row = summarize_trial(store.meta(tn), store.load(tn, 'pos'), store.load(tn, 'vel'), metrics)
+        row['error'] = ''
+    except Exception:
+        row = OrderedDict([('tn', tn), ('error', traceback.format_exc())])
+    return row
+
+
+def _run_worker(root, tn, metrics):
+    #in a pool worker: the records made for the trial go back with its row (see instrument.init_worker)
+    return _run(root, tn, metrics), instrument.worker_records()
+
+
+def summarize(store=None, trials=None, metrics=None, workers=None, progress=None):
+    """the metrics of every trial of a TrialStore, one pass over each trial, in parallel.
+
+    input parameters
+    store = TrialStore of processed trials (the one in STORE_DIR by default)
+    trials = trial numbers to summarize (all trials in the store by default)
+    metrics = names of the metrics to compute (all of METRICS by default)
+    workers = number of processes (defaults to the number of cpus). 1 runs everything in this process.
+    progress = optional function called with each trial's row as it completes
+
+    output: DataFrame with one row per trial, in trial order: the metrics' columns, and error (the traceback
+    where a trial failed, '' otherwise)"""
+
+    if store is None:
+        store = TrialStore()
+    if trials is None:
+        trials = store.trials
+    trials = [int(tn) for tn in trials]
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    rows = []
+    if workers == 1:
+        for tn in trials:
+            row = _run(store.root, tn, metrics)
+            if progress is not None:
+                progress(row)
+            rows.append(row)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, max(len(trials), 1)), initializer=instrument.init_worker,
+                                 initargs=(instrument.worker_settings(),)) as pool:
+            futures = [pool.submit(_run_worker, store.root, tn, metrics) for tn in trials]
+            for future in as_completed(futures):
+                row, records = future.result()
+                instrument.merge(records)
+                if progress is not None:
+                    progress(row)
+                rows.append(row)
+
+    table = pd.DataFrame(rows)
+    return table.sort_values('tn').reset_index(drop=True)
+
+
+def tables(summary):
+    """bdata, tdata and vdata from the output of summarize, with the notebooks' columns, units and rows:
+    tdata only has the non-cantilevers with a torque, in reverse trial order as Notebook 3 built it"""
+    out = OrderedDict()
+    for name, columns in TABLES.items():
+        pairs = [c if isinstance(c, tuple) else (c, c) for c in columns]
+        rows = summary
+        if name == 'tdata':
+            rows = summary[(summary['beh'] != 0) & summary['TNorm'].notna()].iloc[::-1]
+        table = pd.DataFrame(OrderedDict((col, rows[src].values) for col, src in pairs))
+        out[name] = table
+    return out
+
+
+def write_tables(tabs, folder=SUMMARY_DIR):
+    """save the tables as csv files (e.g. bdata.csv) in folder; returns the paths"""
+    paths = []
+    for name, table in tabs.items():
+        path = os.path.join(folder, name + '.csv')
+        table.to_csv(path, **_WRITE[name])
+        paths.append(path)
+    return paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='write the summary tables of the R analyses (bdata, tdata, vdata)')
+    parser.add_argument('--store', default=STORE_DIR, help='folder of the processed trials (a TrialStore)')
+    parser.add_argument('--out', default=SUMMARY_DIR, help='folder to write the tables to')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: one per cpu)')
+    args = parser.parse_args(argv)
+
+    summary = summarize(TrialStore(args.store), workers=args.workers)
+    failed = summary[summary['error'] != '']
+    for tn, error in zip(failed['tn'], failed['error']):
+        print('trial %d failed:\n%s' % (tn, error))
+    for path in write_tables(tables(summary[summary['error'] == '']), args.out):
+        print('saved ' + path)
+    return 1 if len(failed) else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
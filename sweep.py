@@ -0,0 +1,312 @@
+"""Parameter sensitivity sweeps over the processing settings of Notebook 1 and the analyses.
+
+A sweep reprocesses every trial from its raw data for each point of a parameter grid and collects summary
+metrics into one table (one row per trial and setting). The raw trials are imported once and put in a shared
+memory block that the worker processes map, instead of being pickled for every task. Settings that only
+differ after smoothing (nspl, landing window) share the smoothing of a trial. Typical use:
+
+    from sweep import grid, run_sweep, by_setting
+    table = run_sweep(grid(p=[5000.0, 10000.0, 20000.0], nspl=[500, 1000]))
+    by_setting(table)
+
+Parameters (defaults are the values used in the notebooks):
+n = gap fill limit of reshape_and_interp (s)
+p = smoothing multiplier of smooth_trial
+nspl = spline points per frame for the torque and spline length errors
+landing = landing velocity window (s), see kinematics_fn.landing_fit
+
+Metrics:
+max_speed = maximum head speed (m/s)
+landing_speed = head speed from the landing fit (m/s)
+torque_peak = maximum over frames of the horizontal torque normalized by weight and svl, as in Notebook 3
+torque_drop = the same at the drop frame (the last frame without one), Notebook 3's torque
+len_error_max, len_error_mean = largest and mean absolute spline length error between markers (%SVL), the
+                                spl_len_errors of splinize_snake
+"""
+import os
+import glob
+import itertools
+import traceback
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+from import_raw import get_raw_data, CACHE_DIR
+from fill_and_shape import reshape_and_interp
+from align_coords import align
+from Piecewise_Smoothing import smooth_trial
+from kinematics_fn import trial_kinematics, landing_fit, LANDING_WINDOW
+from m_gncspline import marker_patterns, global_natural_spline_batch
+from torque_fn import trial_torques, CHUNK
+from trial_registry import get_registry
+from ingest import MOCAP_DIR
+
+#the settings used in the notebooks
+DEFAULTS = OrderedDict([('n', 0.2), ('p', 10000.0), ('nspl', 1000), ('landing', LANDING_WINDOW)])
+
+METRICS = ['max_speed', 'landing_speed', 'torque_peak', 'torque_drop', 'len_error_max', 'len_error_mean']
+
+
+def grid(**axes):
+    """every combination of the given parameter values, e.g. grid(p=[5000.0, 10000.0], n=[0.1, 0.2]);
+    parameters not given keep their DEFAULTS value. Returns a list of settings dictionaries."""
+    unknown = set(axes)-set(DEFAULTS)
+    if unknown:
+        raise ValueError('unknown parameters: %s' % ', '.join(sorted(unknown)))
+    values = [list(axes[k]) if k in axes else [v] for k, v in DEFAULTS.items()]
+    return [OrderedDict(zip(DEFAULTS, combo)) for combo in itertools.product(*values)]
+
+
+def load_trials(path=MOCAP_DIR, pattern='*.csv', cache_dir=CACHE_DIR, summary_dir=None):
+    """get_raw_data dictionaries of every trial in a folder of MOCAP files, in file name order"""
+    registry = get_registry(summary_dir)
+    files = sorted(glob.glob(os.path.join(path, pattern)))
+    return [get_raw_data(f, cache_dir=cache_dir, registry=registry) for f in files]
+
+
+class SharedTrials(object):
+    """The raw data of a list of imported trials in one shared memory block (all trials' frames stacked, with
+    offsets), with their metadata (without the raw data) alongside.
+
+    Parameters
+    ----------
+    trials : list of dict
+        get_raw_data dictionaries
+    """
+
+    def __init__(self, trials):
+        raws = [np.asarray(t['raw'], dtype=np.float64) for t in trials]
+        ncols = raws[0].shape[1] if raws else 0
+        self.offsets = np.r_[0, np.cumsum([len(r) for r in raws])].astype(np.int64)
+        self.shape = (int(self.offsets[-1]), ncols)
+        self.metas = [dict((k, v) for k, v in t.items() if k != 'raw') for t in trials]
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(self.shape))*8, 1))
+        self._owner = True
+        self._data = np.ndarray(self.shape, dtype=np.float64, buffer=self._shm.buf)
+        for r, start in zip(raws, self.offsets[:-1]):
+            self._data[start:start+len(r)] = r
+
+    @property
+    def handle(self):
+        """what a worker needs to attach (see attach): the block's name, shape, offsets and the metadata"""
+        return (self._shm.name, self.shape, self.offsets, self.metas)
+
+    @classmethod
+    def attach(cls, handle):
+        """map the block created by another process (read only)"""
+        name, shape, offsets, metas = handle
+        shared = cls.__new__(cls)
+        try:
+            #the creating process owns (and unlinks) the block
+            shared._shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            shared._shm = shared_memory.SharedMemory(name=name)
+        shared._owner = False
+        shared.shape, shared.offsets, shared.metas = shape, offsets, metas
+        shared._data = np.ndarray(shape, dtype=np.float64, buffer=shared._shm.buf)
+        shared._data.flags.writeable = False
+        return shared
+
+    def __len__(self):
+        return len(self.metas)
+
+    def raw(self, i):
+        """trial i's raw data (a view into the shared block)"""
+        return self._data[self.offsets[i]:self.offsets[i+1]]
+
+    def close(self):
+        """unmap the block, and free it in the process that created it"""
+        self._data = None
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+
+def spline_length_errors(pos, spacings, svl, nspl):
+    """spline length errors (%SVL) of every frame: measured distance minus integrated spline length between
+    consecutive present markers, as splinize_snake's spl_len_errors.
+
+    input parameters
+    pos = nframes x nmarkers x 3 positions (m), nan where missing
+    spacings = marker spacings (m), including the nosetip to first marker distance as first entry
+    svl = snout vent length (m)
+    nspl = spline points per frame
+
+    output: list of (frames, errors) per group of frames with the same present markers,
+    errors = len(frames) x (present markers - 1)"""
+
+    t_coord = np.r_[0, np.asarray(spacings, dtype=np.float64)[1:].cumsum()]
+    out = []
+    for present, frames in marker_patterns(pos):
+        if present.sum() < 2:
+            continue
+        t_i = np.diff(t_coord[present])
+        errors = np.empty((len(frames), len(t_i)))
+        for start in range(0, len(frames), CHUNK):
+            chunk = frames[start:start+CHUNK]
+            lengths_total = global_natural_spline_batch(pos[chunk][:, present], t_i, nspl)[7]
+            errors[start:start+len(chunk)] = (t_i-lengths_total)/svl*100
+        out.append((frames, errors))
+    return out
+
+
+def evaluate(raw, meta, n, p, variants):
+    """process one trial from its raw data with gap fill limit n and smoothing p, and compute the METRICS for
+    each of the variants (settings dictionaries with nspl and landing). Returns one dictionary per variant."""
+
+    frate = meta['fr']
+    snake, dropped, spacings = reshape_and_interp(raw, meta['ms'], n, frate)
+    aligned = align(snake, meta['oe'], meta['te'])[0]
+    pos, vel, acc, times = trial_kinematics(smooth_trial(aligned, p)[1], aligned.shape, frate)
+
+    pos_m = pos/1000.0 #mm to m
+    spaces = np.array(spacings)/100.0 #cm to m
+    svl = meta['svl']/100.0 #cm to m
+    mass = meta['mass']/1000.0 #g to kg
+
+    head_speed = np.linalg.norm(vel[:, 0], axis=1)/1000.0
+    max_speed = np.nanmax(head_speed) if not np.isnan(head_speed).all() else np.nan
+
+    #frame Notebook 3 measures the torque at: the drop frame, or the landing (last) frame
+    fn = np.asarray(meta['fn'])
+    at = np.flatnonzero(fn == meta['dp']) if not np.isnan(meta['dp']) else []
+    drop_i = at[0] if len(at) else len(fn)-1
+
+    by_nspl, by_landing = {}, {}
+    rows = []
+    for v in variants:
+        nspl, landing = v['nspl'], v['landing']
+        if nspl not in by_nspl:
+            if np.isnan(np.asarray(meta['oe'], dtype=np.float64)).any():
+                #not aligned to the origin end, so no torque about it
+                torque_peak = torque_drop = np.nan
+            else:
+                tq = trial_torques(pos_m, spaces, svl, mass, nspl)
+                normed = np.hypot(tq[:, 0], tq[:, 1])/(9.8*mass*svl)
+                torque_peak = np.nanmax(normed) if not np.isnan(normed).all() else np.nan
+                torque_drop = normed[drop_i]
+            errors = spline_length_errors(pos_m, spaces, svl, nspl)
+            err = np.abs(np.concatenate([e.ravel() for f, e in errors])) if errors else np.array([])
+            err = err[~np.isnan(err)]
+            by_nspl[nspl] = {'torque_peak': torque_peak, 'torque_drop': torque_drop,
+                             'len_error_max': err.max() if len(err) else np.nan,
+                             'len_error_mean': err.mean() if len(err) else np.nan}
+        if landing not in by_landing:
+            by_landing[landing] = np.linalg.norm(landing_fit(pos[:, 0], frate, seconds=landing)[0])/1000.0
+
+        row = dict(v)
+        row.update(by_nspl[nspl])
+        row['max_speed'] = max_speed
+        row['landing_speed'] = by_landing[landing]
+        rows.append(row)
+
+    return rows
+
+
+#the worker's view of the shared trials, set by _init_worker (or by run_sweep when running in this process)
+_trials = None
+
+
+class _LocalTrials(object):
+    #the same interface as SharedTrials, over the trial dictionaries themselves
+    def __init__(self, trials):
+        self.trials = trials
+        self.metas = trials
+
+    def __len__(self):
+        return len(self.trials)
+
+    def raw(self, i):
+        return self.trials[i]['raw']
+
+
+def _init_worker(handle):
+    global _trials
+    _trials = SharedTrials.attach(handle)
+
+
+def _run_task(i, n, p, variants):
+    #errors are returned rather than raised, so one bad trial doesn't abort the sweep
+    meta = _trials.metas[i]
+    base = {'tn': meta['tn'], 'ID': meta['ID'], 'fr': meta['fr']}
+    try:
+        rows = evaluate(_trials.raw(i), meta, n, p, variants)
+        error = ''
+    except Exception:
+        rows = [dict(v) for v in variants]
+        error = traceback.format_exc()
+    for row in rows:
+        row.update(base)
+        row['error'] = error
+    return rows
+
+
+def run_sweep(settings, trials=None, workers=None, progress=None, **load_kwargs):
+    """run every trial through every setting, in parallel.
+
+    input parameters
+    settings = list of settings dictionaries, see grid
+    trials = list of get_raw_data dictionaries (e.g. all_imported from Notebook 1); by default load_trials(**load_kwargs)
+    workers = number of processes (defaults to the number of cpus). 1 runs everything in this process.
+    progress = optional function called with the rows of each finished task
+
+    output: DataFrame with one row per trial and setting: tn, ID, fr, the parameters, the METRICS and error
+    (the traceback where a trial failed, '' otherwise)"""
+
+    global _trials
+    settings = [OrderedDict((k, s.get(k, v)) for k, v in DEFAULTS.items()) for s in settings]
+    if trials is None:
+        trials = load_trials(**load_kwargs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    #one task per trial and (n, p): the smoothing is shared by the settings that differ only after it
+    groups = OrderedDict()
+    for s in settings:
+        groups.setdefault((s['n'], s['p']), []).append(s)
+    tasks = [(i, n, p, variants) for (n, p), variants in groups.items() for i in range(len(trials))]
+
+    rows = []
+    if workers == 1:
+        previous = _trials
+        _trials = _LocalTrials(trials)
+        try:
+            for task in tasks:
+                result = _run_task(*task)
+                if progress is not None:
+                    progress(result)
+                rows.extend(result)
+        finally:
+            _trials = previous
+    else:
+        shared = SharedTrials(trials)
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, max(len(tasks), 1)), initializer=_init_worker,
+                                     initargs=(shared.handle,)) as pool:
+                futures = [pool.submit(_run_task, *task) for task in tasks]
+                for future in as_completed(futures):
+                    result = future.result()
+                    if progress is not None:
+                        progress(result)
+                    rows.extend(result)
+        finally:
+            shared.close()
+
+    columns = ['tn', 'ID', 'fr']+list(DEFAULTS)+METRICS+['error']
+    table = pd.DataFrame(rows, columns=columns)
+    #float metric columns even when there are no rows (or every trial failed), so by_setting can aggregate them
+    table[METRICS] = table[METRICS].astype(np.float64)
+    return table.sort_values(list(DEFAULTS)+['tn']).reset_index(drop=True)
+
+
+def by_setting(table, stat='median'):
+    """one row per setting: the metric (median by default) over the trials that didn't fail, and the number
+    of failed trials"""
+    ok = table[table['error'] == ''].astype(dict((m, np.float64) for m in METRICS))
+    summary = getattr(ok.groupby(list(DEFAULTS))[METRICS], stat)()
+    summary['failed'] = (table['error'] != '').groupby([table[k] for k in DEFAULTS]).sum()
+    return summary.reset_index()
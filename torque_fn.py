@@ -0,0 +1,80 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from m_gncspline import marker_patterns, global_natural_spline_batch
+from instrument import instrumented, count
+
+#relative to the working directory, like the notebooks
+DENSITY_FILE = os.path.join('R files', 'Summary Datasets', 'snake_density.csv')
+
+#frames fit at once; bounds the (frames x spline points x 3) arrays
+CHUNK = 256
+
+_densities = {}
+
+
+def load_density(path=DENSITY_FILE):
+    """body density profile (s_rho = position along the body in fractions of svl, body_rho = density),
+    read once per file"""
+    key = os.path.abspath(path)
+    if key not in _densities:
+        density_df = pd.read_csv(path, index_col=0)
+        s_rho, body_rho = density_df.values.T
+        _densities[key] = (s_rho, body_rho)
+    return _densities[key]
+
+
+@instrumented()
+def trial_torques(positions, spacings, svl, mass, nspl=1000, density_file=DENSITY_FILE):
+    """torque of the weight of the part of the body in the gap about the origin end, for every frame of a trial
+    (the torque function of Notebook 3, for a whole trial).
+
+    A spline is fit through the markers of each frame. The body mass is spread along it following the density
+    profile, and the torque is summed over the spline points past the origin end (x > 0).
+    Frames are grouped by which markers are present, and each group is fit and reduced as whole arrays.
+
+    input parameters
+    positions = nframes x nmarkers x 3 array of smoothed position data (m), origin end at the origin, nan where missing
+    spacings = marker spacings (m), including the distance from the nosetip to the first marker as first entry
+    svl = snout vent length (m)
+    mass = snake mass (kg)
+    nspl = number of spline points per frame
+    density_file = csv with the density profile, see load_density
+
+    output: nframes x 3 array of torques (Nm), nan in frames where the head marker or all but one marker are missing"""
+
+    positions = np.asarray(positions, dtype=np.float64)
+    t = np.asarray(spacings, dtype=np.float64)[1:] #cut out the space from nosetip
+    s_rho, body_rho = load_density(density_file)
+
+    #position of every marker along the body
+    t_coord = np.r_[0, t.cumsum()]
+
+    torques = np.full((positions.shape[0], 3), np.nan)
+
+    for present, frames in marker_patterns(positions):
+        count('frame_groups')
+        #can't calculate the torque effectively if the head marker is missing
+        if not present[0] or present.sum() < 2:
+            continue
+        t_i = np.diff(t_coord[present])
+
+        for start in range(0, len(frames), CHUNK):
+            chunk = frames[start:start+CHUNK]
+            r, dr, ddr, dddr, ts, ss, seg_lens, lengths_total, idx_pts = \
+                global_natural_spline_batch(positions[chunk][:, present], t_i, nspl)
+
+            density_body = np.interp(ts / svl, s_rho, body_rho)
+            mass_body = mass * density_body / density_body.sum()
+
+            #weight of the spline points in the gap (x > 0; the origin end is the origin), along -z
+            weight = np.where(r[:, :, 0] > 0, -mass_body * 9.81, 0) #N
+
+            #r x (0, 0, w) = (r_y w, -r_x w, 0), summed over the body
+            torques[chunk, 0] = np.einsum('ij,ij->i', r[:, :, 1], weight)
+            torques[chunk, 1] = -np.einsum('ij,ij->i', r[:, :, 0], weight)
+            torques[chunk, 2] = 0
+
+    return torques
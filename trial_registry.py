@@ -0,0 +1,165 @@
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+#relative to the working directory, like the notebooks
+SUMMARY_DIR = os.path.join('R files', 'Summary Datasets')
+
+#[trial#, 3 digits]_Snake[#, 2 digits]_gap[#, 2 digits]_[iteration#].csv, e.g. 038_Snake94_gap02_1.csv
+FILE_PATTERN = re.compile(r'(\d+)_[Ss]nake(\d+)_gap([0-9A-Za-z]+)_(\d+)\.csv$')
+
+#per-trial statistics tables written by notebooks 2-4, and the column holding the trial number
+SUMMARY_TABLES = {'bdata': 'tn', 'tdata': 'Trial', 'vdata': 'tn'}
+
+#behavior codes set by hand in Notebook 2 (beh_c): recovery trials are 2, and these non-cantilevers have no
+#drop frame recorded. Otherwise trials with a drop frame are non-cantilevers (1), the rest cantilevers (0).
+RECOVERY_TRIALS = [67, 68, 70, 71, 72, 73, 74]
+NO_DROP_TRIALS = [275, 276, 277, 281, 282, 283, 289]
+
+
+def parse_trial_filename(path):
+    """get the trial, snake and gap numbers out of a MOCAP file name.
+
+    input parameters
+    path = path to (or name of) a raw .csv, e.g. 'MOCAP files/038_Snake94_gap02_1.csv'
+
+    output: dictionary with 'trial', 'snake', 'gap' and 'rep' (the iteration number).
+    gap is None when the file name doesn't give a number for it (e.g. 'gap0d')."""
+
+    match = FILE_PATTERN.search(os.path.basename(path))
+    if match is None:
+        raise ValueError('not a MOCAP trial file name: ' + path)
+
+    trial, snake, gap, rep = match.groups()
+
+    return {'trial': int(trial),
+            'snake': int(snake),
+            'gap': int(gap) if gap.isdigit() else None,
+            'rep': int(rep)}
+
+
+def behavior_code(tn, dp):
+    """behavior codes of a trial from its number and drop frame (None or nan if there is none).
+
+    output: beh_c, beh = Notebook 2's codes: beh_c is 0 cantilever, 1 non-cantilever, 2 recovery;
+    beh is the same with the recovery trials counted as non-cantilevers (1)"""
+
+    if tn in RECOVERY_TRIALS:
+        beh_c = 2
+    elif tn in NO_DROP_TRIALS:
+        beh_c = 1
+    else:
+        beh_c = 0 if dp is None or np.isnan(dp) else 1
+
+    return beh_c, min(beh_c, 1)
+
+
+class TrialRegistry(object):
+    """Trial metadata from the summary datasets, loaded once.
+
+    reference_material.csv is kept as typed arrays (one entry per trial, in file order) with the
+    marker spacings already parsed, and indexed by trial number and snake ID. bdata, tdata and vdata
+    are loaded when present (they are outputs of notebooks 2-4).
+
+    Parameters
+    ----------
+    folder : str
+        folder holding reference_material.csv and the per-trial statistics tables.
+        Relative paths are relative to the working directory.
+    """
+
+    def __init__(self, folder=SUMMARY_DIR):
+        self.folder = folder
+
+        ref = pd.read_csv(os.path.join(folder, 'reference_material.csv'), delimiter=",")
+        ref = ref[ref.Trial.notna()]
+
+        #some trials are listed twice; the first entry is the one that has always been used
+        ref = ref[~ref.Trial.duplicated(keep='first')]
+
+        self.trials = ref.Trial.values.astype(int)
+        self.ids = ref.ID.values.astype(int)
+        self.mass = ref.Mass.values.astype(float)
+        self.svl = ref.SVL.values.astype(float)
+        self.lf = pd.to_numeric(ref.LF, errors='coerce').values.astype(float) #landing frame, nan if unknown
+        self.dp = pd.to_numeric(ref.DP, errors='coerce').values.astype(float) #drop (transition) frame, nan for cantilevers
+        self.notes = ref.Notes.values
+        self.spacings = [np.array([float(x) for x in s.split(',')]) for s in ref.Spacings.values]
+
+        self._rows = dict((tn, i) for i, tn in enumerate(self.trials))
+        self._snakes = dict((snk, np.flatnonzero(self.ids == snk)) for snk in np.unique(self.ids))
+
+        #per-trial statistics, as dictionaries of column arrays
+        self.tables = {}
+        self._table_rows = {}
+        for name, key in SUMMARY_TABLES.items():
+            path = os.path.join(folder, name + '.csv')
+            if not os.path.exists(path):
+                continue
+            table = pd.read_csv(path)
+            table = table.drop(columns=[c for c in table.columns if c.startswith('Unnamed')])
+            self.tables[name] = dict((c, table[c].values) for c in table.columns)
+            self._table_rows[name] = dict((tn, i) for i, tn in enumerate(table[key].values))
+
+    def __len__(self):
+        return len(self.trials)
+
+    def __contains__(self, trial):
+        return trial in self._rows
+
+    def index(self, trial):
+        """row of a trial in the registry arrays"""
+        try:
+            return self._rows[trial]
+        except KeyError:
+            raise KeyError('trial %s is not in reference_material.csv' % trial)
+
+    def snake_trials(self, snk_ID):
+        """trial numbers recorded for a snake"""
+        return self.trials[self._snakes.get(snk_ID, np.array([], dtype=int))]
+
+    def metadata(self, trial):
+        """metadata for a trial, with the keys used in the import dictionaries:
+        tn, ID, svl (cm), mass (g), ms (list of marker spacings, cm), lf (landing frame), dp (drop frame)"""
+        i = self.index(trial)
+        return {'tn': self.trials[i],
+                'ID': self.ids[i],
+                'svl': self.svl[i],
+                'mass': self.mass[i],
+                'ms': self.spacings[i].tolist(),
+                'lf': self.lf[i],
+                'dp': self.dp[i]}
+
+    def metadata_for_file(self, path):
+        """metadata for the trial a MOCAP file belongs to"""
+        return self.metadata(parse_trial_filename(path)['trial'])
+
+    def summary(self, name, trial):
+        """row of a trial in one of the statistics tables ('bdata', 'tdata' or 'vdata') as a dictionary"""
+        if name not in self.tables:
+            raise KeyError('no %s.csv in %s' % (name, self.folder))
+        i = self._table_rows[name][trial]
+        return dict((c, col[i]) for c, col in self.tables[name].items())
+
+
+_registries = {}
+
+
+def _default_folder():
+    #older setups keep the summary datasets right in the working directory
+    if os.path.exists(os.path.join('Summary Datasets', 'reference_material.csv')):
+        return 'Summary Datasets'
+    return SUMMARY_DIR
+
+
+def get_registry(folder=None):
+    """the TrialRegistry for a folder, loaded on first use and shared afterwards.
+    folder defaults to 'Summary Datasets' if the working directory has one, otherwise SUMMARY_DIR."""
+    if folder is None:
+        folder = _default_folder()
+    key = os.path.abspath(folder)
+    if key not in _registries:
+        _registries[key] = TrialRegistry(folder)
+    return _registries[key]
@@ -0,0 +1,217 @@
+import numpy as np
+
+from trial_store import scalar_items, metadata_columns, match
+
+
+class TrialSet(object):
+    """All trials' data in one array per quantity, so per-trial results come from one array operation.
+
+    Each quantity (pos, vel, acc, times...) is one buffer with the frames of every trial stacked along the
+    first axis; trial i is rows offsets[i]:offsets[i+1]. Trials with dropped markers are padded with nan up
+    to the largest marker count. Metadata is a struct of arrays (meta[key][i] is trial i's value).
+
+    For example, the head's maximum speed and the frame of the lowest marker position, for every trial:
+
+        ts = TrialSet.from_store(TrialStore())
+        head_speed = ts.max(np.linalg.norm(ts['vel'][:, 0], axis=1))
+        low_frame = ts.argmin(np.nanmin(ts['pos'][:, 1:, 2], axis=1))
+
+    Parameters
+    ----------
+    arrays : dict
+        quantity name -> list of per-trial arrays (nframes x ...), the same number of frames for every quantity
+    meta : list of dict
+        per-trial metadata dictionaries (e.g. get_raw_data's); their numeric and string scalars become columns
+    dtype : dtype
+        of the buffers (float, so missing values and padding can be nan)
+    """
+
+    def __init__(self, arrays, meta=None, dtype=np.float64):
+        names = list(arrays)
+        if not names:
+            raise ValueError('no arrays given')
+        ntrials = len(arrays[names[0]])
+        lengths = np.array([len(a) for a in arrays[names[0]]], dtype=np.int64)
+
+        data, shapes = {}, {}
+        for name in names:
+            trials = arrays[name]
+            if len(trials) != ntrials or any(len(a) != n for a, n in zip(trials, lengths)):
+                raise ValueError('%s does not have the same trials and frames as %s' % (name, names[0]))
+            shape = np.array([np.shape(a)[1:] for a in trials], dtype=np.int64).reshape(ntrials, -1)
+            buf = np.full((lengths.sum(),)+tuple(shape.max(axis=0) if ntrials else shape.shape[1:]), np.nan,
+                          dtype=dtype)
+            start = 0
+            for a, s in zip(trials, shape):
+                buf[(slice(start, start+len(a)),)+tuple(slice(0, k) for k in s)] = a
+                start += len(a)
+            data[name] = buf
+            shapes[name] = shape
+
+        if meta is None:
+            columns = {}
+        else:
+            if len(meta) != ntrials:
+                raise ValueError('%d metadata dictionaries for %d trials' % (len(meta), ntrials))
+            columns = metadata_columns([scalar_items(m) for m in meta])
+
+        self._setup(data, shapes, lengths, columns)
+
+    def _setup(self, data, shapes, lengths, meta):
+        self.data = data
+        self._shapes = shapes
+        self.lengths = lengths
+        self.offsets = np.r_[0, np.cumsum(lengths)].astype(np.int64)
+        self.meta = meta
+        self._trial_index = None
+
+    @classmethod
+    def _from_buffers(cls, data, shapes, lengths, meta):
+        ts = cls.__new__(cls)
+        ts._setup(data, shapes, lengths, meta)
+        return ts
+
+    @classmethod
+    def from_store(cls, store, names=('pos', 'vel', 'acc', 'times'), trials=None, dtype=np.float64):
+        """the trials of a TrialStore (all of them by default), with its catalog as metadata"""
+        all_trials = store.trials
+        if trials is None:
+            trials = all_trials
+        rows = np.searchsorted(all_trials, trials)
+        arrays = dict((name, store.load_all(name, trials)) for name in names)
+        ts = cls(arrays, dtype=dtype)
+        ts.meta = dict((key, col[rows]) for key, col in store.catalog.items())
+        return ts
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, name):
+        """the buffer of a quantity (total frames x ...)"""
+        return self.data[name]
+
+    @property
+    def nmarkers(self):
+        """number of markers of each trial (from pos, or the first quantity with a marker axis)"""
+        for name in ['pos']+sorted(self._shapes):
+            if name in self._shapes and self._shapes[name].shape[1]:
+                return self._shapes[name][:, 0]
+        raise KeyError('no quantity with a marker axis')
+
+    @property
+    def trial_index(self):
+        """position of the trial each frame belongs to (total frames)"""
+        if self._trial_index is None:
+            self._trial_index = np.repeat(np.arange(len(self)), self.lengths)
+        return self._trial_index
+
+    @property
+    def local_frame(self):
+        """frame number of each frame within its trial (total frames)"""
+        return np.arange(self.offsets[-1])-self.offsets[:-1][self.trial_index]
+
+    def loc(self, tn):
+        """position of trial number tn in the set"""
+        where = np.flatnonzero(self.meta['tn'] == tn)
+        if not len(where):
+            raise KeyError('trial %s is not in the set' % tn)
+        return int(where[0])
+
+    def trial(self, i, name='pos'):
+        """trial i's array (a view into the buffer, without the padding)"""
+        a, b = self.offsets[i], self.offsets[i+1]
+        shape = self._shapes[name][i]
+        return self.data[name][(slice(a, b),)+tuple(slice(0, k) for k in shape)]
+
+    def get(self, tn, name='pos'):
+        """trial number tn's array (a view)"""
+        return self.trial(self.loc(tn), name)
+
+    def where(self, **criteria):
+        """boolean mask of the trials meeting all the criteria on metadata columns
+        (a value, a list of values, or a (low, high) tuple for an inclusive range)"""
+        return match(self.meta, criteria)
+
+    def select(self, mask=None, **criteria):
+        """new TrialSet of the trials picked by a boolean mask or positions, and/or metadata criteria"""
+        keep = np.ones(len(self), dtype=bool)
+        if mask is not None:
+            mask = np.asarray(mask)
+            if mask.dtype == bool:
+                keep &= mask
+            else:
+                keep &= np.isin(np.arange(len(self)), mask)
+        if criteria:
+            keep &= self.where(**criteria)
+        idx = np.flatnonzero(keep)
+
+        lengths = self.lengths[idx]
+        starts = np.r_[0, np.cumsum(lengths)[:-1]].astype(np.int64)
+        frames = np.arange(lengths.sum())+np.repeat(self.offsets[idx]-starts, lengths)
+
+        data = dict((name, buf[frames]) for name, buf in self.data.items())
+        shapes = dict((name, shape[idx]) for name, shape in self._shapes.items())
+        meta = dict((key, col[idx]) for key, col in self.meta.items())
+        return self._from_buffers(data, shapes, lengths, meta)
+
+    def broadcast(self, values):
+        """per-trial values repeated over each trial's frames (e.g. to subtract a per-trial reference)"""
+        return np.asarray(values)[self.trial_index]
+
+    def _values(self, values):
+        values = self.data[values] if isinstance(values, str) else np.asarray(values)
+        if values.shape[0] != self.offsets[-1]:
+            raise ValueError('%d values for %d frames' % (values.shape[0], self.offsets[-1]))
+        return values
+
+    def _reduceat(self, ufunc, values, fill=np.nan):
+        #reduceat over the starts of the non-empty trials (an empty trial would get the next trial's first value)
+        nonempty = self.lengths > 0
+        out = np.full((len(self),)+values.shape[1:], fill,
+                      dtype=np.result_type(values.dtype, np.float64) if fill is np.nan else values.dtype)
+        if nonempty.any():
+            out[nonempty] = ufunc.reduceat(values, self.offsets[:-1][nonempty], axis=0)
+        return out
+
+    def max(self, values):
+        """per-trial maximum of per-frame values (a quantity name or a total frames x ... array), ignoring nans"""
+        return self._reduceat(np.fmax, self._values(values))
+
+    def min(self, values):
+        """per-trial minimum, ignoring nans"""
+        return self._reduceat(np.fmin, self._values(values))
+
+    def sum(self, values):
+        """per-trial sum, ignoring nans"""
+        values = self._values(values)
+        return self._reduceat(np.add, np.where(np.isnan(values), 0, values), fill=0)
+
+    def count(self, values):
+        """per-trial number of values that are not nan"""
+        values = self._values(values)
+        return self._reduceat(np.add, (~np.isnan(values)).astype(np.int64), fill=0)
+
+    def mean(self, values):
+        """per-trial mean, ignoring nans (nan where a trial has no values)"""
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum(values)/self.count(values)
+
+    def _argext(self, values, extreme):
+        #first frame of each trial where the values reach the trial's extreme
+        target = self.broadcast(extreme)
+        total = self.offsets[-1]
+        frames = np.arange(total).reshape((-1,)+(1,)*(values.ndim-1))
+        first = self._reduceat(np.minimum, np.where(values == target, frames, total), fill=total)
+        ends = self.offsets[1:].reshape((-1,)+(1,)*(values.ndim-1))
+        starts = self.offsets[:-1].reshape(ends.shape)
+        return np.where(first < ends, first-starts, -1)
+
+    def argmin(self, values):
+        """per-trial frame (within the trial) of the minimum, ignoring nans; -1 where a trial has no values"""
+        values = self._values(values)
+        return self._argext(values, self.min(values))
+
+    def argmax(self, values):
+        """per-trial frame (within the trial) of the maximum, ignoring nans; -1 where a trial has no values"""
+        values = self._values(values)
+        return self._argext(values, self.max(values))
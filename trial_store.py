@@ -0,0 +1,239 @@
+import os
+import json
+
+import numpy as np
+
+from trial_registry import behavior_code
+
+#relative to the working directory, like the notebooks
+STORE_DIR = 'Processed trials'
+
+
+def _to_json(value):
+    #numpy scalars and arrays don't serialize on their own
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+def _save_array(path, arr):
+    #write to a temporary file first so an interrupted run never leaves a half written array behind
+    np.save(path + '.tmp.npy', np.asarray(arr))
+    os.replace(path + '.tmp.npy', path)
+
+
+def scalar_items(meta):
+    """the numeric and string scalar entries of a metadata dictionary (the ones that go in a catalog)"""
+    return dict((k, _to_json(v)) for k, v in meta.items()
+                if isinstance(v, (bool, int, float, str, np.bool_, np.number)) or v is None)
+
+
+def metadata_columns(rows):
+    """columns (one array per key) from a list of metadata dictionaries, one per trial.
+    Missing values are nan in numeric columns and '' in text columns (e.g. Notes)"""
+    columns = sorted(set(k for r in rows for k in r))
+    table = {}
+    for key in columns:
+        values = [r.get(key) for r in rows]
+        missing = [v is None or (isinstance(v, float) and np.isnan(v)) for v in values]
+        text = [isinstance(v, str) for v in values]
+        if any(text) and all(m or x for x, m in zip(text, missing)):
+            table[key] = np.array(['' if m else v for v, m in zip(values, missing)])
+        else:
+            table[key] = np.array([np.nan if m or isinstance(v, str) else v for v, m in zip(values, missing)])
+    return table
+
+
+def match(columns, criteria, what='metadata'):
+    """boolean mask of the rows of a column dictionary meeting all the criteria
+    (a value, a list of values, or a (low, high) tuple for an inclusive range, by column)"""
+    nrows = len(next(iter(columns.values()))) if columns else 0
+    keep = np.ones(nrows, dtype=bool)
+    for key, value in criteria.items():
+        if key not in columns:
+            raise KeyError('no %s column in the %s' % (key, what))
+        col = columns[key]
+        if isinstance(value, tuple):
+            low, high = value
+            keep &= (col >= low) & (col <= high)
+        elif isinstance(value, (list, np.ndarray)):
+            keep &= np.isin(col, value)
+        else:
+            keep &= col == value
+    return keep
+
+
+class TrialStore(object):
+    """On-disk store of processed trials, one folder per trial, with a columnar catalog.
+
+    Each trial folder holds its arrays as plain .npy files (read back memory mapped, so only the
+    parts that are used get read) and its scalar metadata in meta.json. catalog.npz holds one array
+    per scalar metadata column, one row per trial, so trials can be picked without opening them.
+
+    Parameters
+    ----------
+    root : str
+        folder of the store, created when the first trial is written
+    """
+
+    def __init__(self, root=STORE_DIR):
+        self.root = root
+        self._catalog = None
+
+    def _trial_dir(self, tn):
+        return os.path.join(self.root, '%03d' % tn)
+
+    @property
+    def catalog(self):
+        """dictionary of metadata columns (arrays, one row per trial, sorted by trial number)"""
+        if self._catalog is None:
+            path = os.path.join(self.root, 'catalog.npz')
+            if os.path.exists(path):
+                with np.load(path) as f:
+                    self._catalog = dict((k, f[k]) for k in f.files)
+            else:
+                self._catalog = {'tn': np.array([], dtype=int)}
+        return self._catalog
+
+    @property
+    def trials(self):
+        """trial numbers in the store"""
+        return self.catalog['tn']
+
+    def __len__(self):
+        return len(self.trials)
+
+    def __contains__(self, tn):
+        return tn in set(self.trials.tolist())
+
+    def write(self, meta, **arrays):
+        """add (or replace) a trial.
+
+        input parameters
+        meta = dictionary of trial metadata, e.g. the get_raw_data dictionary with 'tn' the trial number.
+               Array values (frame index, raw data, branch positions...) are stored as arrays, the rest in
+               meta.json. Numeric and string scalars also go in the catalog, along with the behavior codes
+               beh_c and beh (trial_registry.behavior_code) when meta has the drop frame 'dp' but no codes.
+        arrays = the trial's data arrays by name, e.g. pos=..., vel=..., acc=..., times=...
+
+        Every write rewrites the whole catalog; use write_many to save many trials."""
+
+        tn, scalars = self._write_trial(meta, arrays)
+        self._update_catalog({tn: scalars})
+
+    def write_many(self, trials):
+        """add (or replace) many trials, updating the catalog once at the end.
+
+        input parameters
+        trials = iterable of (meta, arrays) pairs, with meta and arrays (a dictionary of arrays by name) as for
+                 write. A generator works too, so only one trial needs to be in memory at a time.
+
+        If a trial fails to write, the trials written before it are still added to the catalog."""
+
+        written = {}
+        try:
+            for meta, arrays in trials:
+                tn, scalars = self._write_trial(meta, arrays)
+                written[tn] = scalars
+        finally:
+            if written:
+                self._update_catalog(written)
+
+    def _write_trial(self, meta, arrays):
+        #the trial's folder (arrays and meta.json); returns its trial number and scalar metadata for the catalog
+        tn = int(meta['tn'])
+        folder = self._trial_dir(tn)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+        scalars = {}
+        array_meta = []
+        for key, value in meta.items():
+            if isinstance(value, np.ndarray) and value.ndim > 0:
+                _save_array(os.path.join(folder, 'meta_%s.npy' % key), value)
+                array_meta.append(key)
+            else:
+                scalars[key] = _to_json(value)
+        if 'dp' in scalars and 'beh' not in scalars:
+            scalars['beh_c'], scalars['beh'] = behavior_code(tn, scalars['dp'])
+
+        for name, arr in arrays.items():
+            _save_array(os.path.join(folder, name + '.npy'), arr)
+
+        #arrays written earlier (e.g. by a previous step) are kept
+        names = set(arrays)
+        if os.path.exists(os.path.join(folder, 'meta.json')):
+            names |= set(self._info(tn)['arrays'])
+
+        info = {'meta': scalars, 'array_meta': array_meta, 'arrays': sorted(names)}
+        with open(os.path.join(folder, 'meta.json.tmp'), 'w') as f:
+            json.dump(info, f)
+        os.replace(os.path.join(folder, 'meta.json.tmp'), os.path.join(folder, 'meta.json'))
+
+        return tn, scalars
+
+    def _info(self, tn):
+        with open(os.path.join(self._trial_dir(tn), 'meta.json'), 'r') as f:
+            return json.load(f)
+
+    def _update_catalog(self, updates):
+        #updates = {trial number: scalar metadata}; rebuilds and saves catalog.npz once for all of them
+        rows = dict((int(t), {}) for t in self.trials)
+        for key, col in self.catalog.items():
+            for t, value in zip(self.trials, col):
+                rows[int(t)][key] = value.item() if isinstance(value, np.generic) else value
+
+        for tn, scalars in updates.items():
+            row = scalar_items(scalars)
+            row['tn'] = tn
+            rows[tn] = row
+
+        order = sorted(rows)
+        catalog = metadata_columns([rows[t] for t in order])
+        catalog['tn'] = np.array(order, dtype=int)
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        np.savez(os.path.join(self.root, 'catalog.tmp.npz'), **catalog)
+        os.replace(os.path.join(self.root, 'catalog.tmp.npz'), os.path.join(self.root, 'catalog.npz'))
+        self._catalog = catalog
+
+    def meta(self, tn):
+        """the trial's metadata dictionary, with array values memory mapped"""
+        info = self._info(tn)
+        meta = dict(info['meta'])
+        for key in info['array_meta']:
+            meta[key] = np.load(os.path.join(self._trial_dir(tn), 'meta_%s.npy' % key), mmap_mode='c')
+        return meta
+
+    def load(self, tn, name):
+        """a trial's array (e.g. 'pos'), memory mapped: nothing is read until it is used.
+        Mapped copy-on-write, so changes made in an analysis stay in memory and never reach the store."""
+        return np.load(os.path.join(self._trial_dir(tn), name + '.npy'), mmap_mode='c')
+
+    def load_all(self, name, trials=None):
+        """list of one array per trial (memory mapped), in trial order, e.g. the old sm_pos list"""
+        if trials is None:
+            trials = self.trials
+        return [self.load(tn, name) for tn in trials]
+
+    def query(self, ID=None, gsr=None, beh=None, **columns):
+        """trial numbers matching all the given conditions.
+
+        input parameters
+        ID = snake ID, or list of IDs
+        gsr = (low, high) range of gap size in %SVL (the 'gs_%' column), inclusive
+        beh = behavior code, or list of codes (0 cantilever, 1 non-cantilever, recovery trials included)
+        columns = other catalog columns: a value, a list of values, or a (low, high) tuple for a range"""
+
+        criteria = dict(columns)
+        if ID is not None:
+            criteria['ID'] = ID
+        if gsr is not None:
+            criteria['gs_%'] = tuple(gsr)
+        if beh is not None:
+            criteria['beh'] = beh
+
+        return self.trials[match(self.catalog, criteria, 'catalog')]